@@ -0,0 +1,233 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "opengaze_implementation"))
+from label_timeline import LabelTimeline
+
+"""
+Generates synthetic gaze sessions that can be shared and used to benchmark the
+pipeline: for each session, a raw OpenGaze output file ([name].txt), an
+OpenFace FeatureExtraction csv ([name].csv) and a truth label tsv
+([name]_truth.tsv), all following the same simulated gaze. The gaze switches
+between left, right and away with log-normally distributed durations; the
+outputs are noisy versions of it, with zero-confidence dropouts, OpenGaze's
+four-row bug pattern and its 1e10 error values.
+"""
+
+FRAME_LENGTH = 1000 / 29.97  # ms per frame of a 29.97 fps video
+LABELS = ["left", "right", "away"]
+LEFT, RIGHT, AWAY = range(len(LABELS))
+
+OPENFACE_COLUMNS = ["frame", "face_id", "timestamp", "confidence", "success",
+                    "gaze_0_x", "gaze_0_y", "gaze_0_z", "gaze_1_x", "gaze_1_y", "gaze_1_z",
+                    "gaze_angle_x", "gaze_angle_y",
+                    "pose_Tx", "pose_Ty", "pose_Tz", "pose_Rx", "pose_Ry", "pose_Rz",
+                    "AU01_r", "AU02_r", "AU04_r", "AU05_r", "AU06_r", "AU12_r", "AU45_r"]
+
+
+"""
+Simulates the gaze of a session: returns the label code (an index into LABELS)
+of every frame. Each look lasts a log-normally distributed time and goes to a
+different label than the one before.
+Args:
+    num_frames (int): the number of frames
+    rng (numpy Generator): the random number generator
+    mean_duration (float): the median duration of a look, in milliseconds
+    frame_length (float): the duration of each frame, in milliseconds
+"""
+
+
+def simulate_labels(num_frames, rng, mean_duration=1500, frame_length=FRAME_LENGTH):
+    lengths = np.zeros(0, dtype=np.int64)
+    while lengths.sum() < num_frames:
+        durations = rng.lognormal(np.log(mean_duration), 0.75, int(num_frames * frame_length / mean_duration) + 16)
+        lengths = np.concatenate((lengths, np.maximum(np.round(durations / frame_length), 1).astype(np.int64)))
+    codes = np.cumsum(rng.integers(1, len(LABELS), len(lengths))) % len(LABELS)
+    return np.repeat(codes, lengths)[:num_frames].astype(np.int8)
+
+
+"""
+Returns the confidence of every frame, with zero-confidence dropouts (runs of
+frames where no face was found) and OpenGaze's bug pattern (four
+zero-confidence frames between two frames with a face).
+Args:
+    num_frames (int): the number of frames
+    rng (numpy Generator): the random number generator
+    dropout_rate (float): the fraction of frames in dropouts
+    bug_rate (float): the number of bug patterns per frame
+"""
+
+
+def simulate_confidence(num_frames, rng, dropout_rate=0.05, bug_rate=0.002):
+    confidence = np.round(rng.uniform(0.5, 1, num_frames), 4)
+
+    # dropouts last 15 frames on average
+    num_dropouts = rng.binomial(num_frames, dropout_rate / 15)
+    for start, length in zip(rng.integers(0, num_frames, num_dropouts), rng.geometric(1 / 15, num_dropouts)):
+        confidence[start:start + length] = 0
+
+    for start in rng.integers(1, max(num_frames - 5, 1), rng.binomial(num_frames, bug_rate)):
+        confidence[start - 1] = confidence[start - 1] or 0.75
+        confidence[start:start + 4] = 0
+        confidence[start + 4] = confidence[start + 4] or 0.75
+    return confidence
+
+
+"""
+Writes a raw OpenGaze output file (comma-separated, no header): frame,
+face id, confidence, the 3D gaze vector, gaze_2d_x, gaze_2d_y and the 2D head
+position. Left looks have a positive gaze_2d_x, right looks a negative one,
+and away looks a low gaze_2d_y.
+Args:
+    path (string): the path to write to
+    labels (numpy array of ints): the label code of every frame
+    rng (numpy Generator): the random number generator
+    noise (float): the standard deviation of the gaze noise
+    dropout_rate, bug_rate: see simulate_confidence
+    error_rate (float): the fraction of gaze values that are OpenGaze's 1e10
+        error value
+"""
+
+
+def write_opengaze(path, labels, rng, noise=0.1, dropout_rate=0.05, bug_rate=0.002, error_rate=0.001):
+    n = len(labels)
+    confidence = simulate_confidence(n, rng, dropout_rate, bug_rate)
+    gaze_2d_x = np.select([labels == LEFT, labels == RIGHT], [0.35, -0.35], 0) + rng.normal(0, noise, n)
+    gaze_2d_y = np.where(labels == AWAY, -0.4, 0.5) + rng.normal(0, noise, n)
+    gaze_2d_x[rng.random(n) < error_rate] = 1e10
+    gaze_2d_y[rng.random(n) < error_rate] = -1e10
+
+    gaze_vector = np.column_stack((gaze_2d_x.clip(-1, 1), gaze_2d_y.clip(-1, 1), -np.ones(n)))
+    head = rng.normal(0, 0.02, (n, 2)) + [0.5, 0.4]
+    data = np.column_stack((np.arange(1, n + 1), np.zeros(n), confidence, gaze_vector, gaze_2d_x, gaze_2d_y, head))
+    np.savetxt(path, data, delimiter=",",
+               fmt=["%d", "%d", "%.4f", "%.6f", "%.6f", "%.6f", "%.6f", "%.6f", "%.4f", "%.4f"])
+
+
+"""
+Writes an OpenFace FeatureExtraction csv (", "-separated, with a header) with
+the gaze, head pose and action unit columns. The gaze follows the labels the
+way process_video.reformat_data reads it: gaze_angle_x of at least 0.22 is
+left, and an away look has gaze_0_x below gaze_1_x.
+Args:
+    path (string): the path to write to
+    labels (numpy array of ints): the label code of every frame
+    rng (numpy Generator): the random number generator
+    noise (float): the standard deviation of the gaze noise
+    dropout_rate (float): the fraction of frames where tracking failed
+    frame_length (float): the duration of each frame, in milliseconds
+"""
+
+
+def write_openface(path, labels, rng, noise=0.1, dropout_rate=0.05, frame_length=FRAME_LENGTH):
+    n = len(labels)
+    success = simulate_confidence(n, rng, dropout_rate, bug_rate=0) > 0
+    confidence = np.where(success, np.round(rng.uniform(0.8, 0.98, n), 2), 0)
+    angle_x = np.select([labels == LEFT, labels == RIGHT], [0.4, 0.0], 0.2) + rng.normal(0, noise, n)
+    eye_offset = np.where(labels == AWAY, -0.05, 0.05) + rng.normal(0, noise / 4, n)
+    gaze_0_x, gaze_1_x = angle_x + eye_offset / 2, angle_x - eye_offset / 2
+
+    columns = [np.arange(1, n + 1), np.zeros(n), np.round(np.arange(n) * frame_length / 1000, 3), confidence,
+               success, gaze_0_x, rng.normal(0.1, 0.05, n), -np.ones(n), gaze_1_x, rng.normal(0.1, 0.05, n),
+               -np.ones(n), angle_x, rng.normal(0.05, 0.05, n)]
+    columns += list(rng.normal([10, 20, 500, 0.1, 0.0, 0.0], [5, 5, 50, 0.1, 0.2, 0.05], (n, 6)).T)
+    columns += list(np.abs(rng.normal(0, 0.8, (7, n))))
+    data = np.column_stack(columns)
+    data[~success, 5:] = 0
+    np.savetxt(path, data, delimiter=", ", header=", ".join(OPENFACE_COLUMNS), comments="",
+               fmt=["%d", "%d", "%.3f", "%.2f", "%d"] + ["%.6f"] * 8 + ["%.3f"] * 6 + ["%.2f"] * 7)
+
+
+"""
+Writes the truth label tsv of the simulated gaze (times in milliseconds, from
+the start of the first frame), ending with an "end" row at the end of the
+video.
+Args:
+    path (string): the path to write to
+    labels (numpy array of ints): the label code of every frame
+    frame_length (float): the duration of each frame, in milliseconds
+"""
+
+
+def write_truth(path, labels, frame_length=FRAME_LENGTH):
+    changes = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+    times = np.rint(changes * frame_length).astype(np.int64)
+    timeline = LabelTimeline(times, labels[changes], LABELS, end=int(round(len(labels) * frame_length)))
+    timeline.write_tsv(path)
+
+
+"""
+Generates one session into a directory, as [name].txt (OpenGaze), [name].csv
+(OpenFace) and [name]_truth.tsv. Returns a dict with the paths, the number of
+frames and the frame length.
+Args:
+    directory (string): the directory to write to
+    name (string): the name of the session
+    minutes (float): the length of the session, in minutes
+    seed (int): the seed of the random number generator
+    noise, dropout_rate, bug_rate, error_rate: see write_opengaze
+"""
+
+
+def generate_session(directory, name, minutes, seed=0, noise=0.1, dropout_rate=0.05, bug_rate=0.002,
+                     error_rate=0.001):
+    rng = np.random.default_rng(seed)
+    num_frames = int(round(minutes * 60000 / FRAME_LENGTH))
+    labels = simulate_labels(num_frames, rng)
+
+    os.makedirs(directory, exist_ok=True)
+    session = {"session": name,
+               "raw_path": os.path.join(directory, name + ".txt"),
+               "openface_path": os.path.join(directory, name + ".csv"),
+               "truth_path": os.path.join(directory, name + "_truth.tsv"),
+               "num_frames": num_frames,
+               "ms_per_frame": FRAME_LENGTH}
+    write_opengaze(session["raw_path"], labels, rng, noise, dropout_rate, bug_rate, error_rate)
+    write_openface(session["openface_path"], labels, rng, noise, dropout_rate)
+    write_truth(session["truth_path"], labels)
+    return session
+
+
+"""
+Takes in a CLI arg (the directory to write to) and generates synthetic
+sessions into it, with a manifest.tsv (raw_path, truth_path, ms_per_frame and
+session) that evaluate_opengaze_batch.py and sweep_thresholds.py can read
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument('directory', type=str, help='The directory to write the sessions to.')
+    argparser.add_argument('--sessions', type=int, default=1, help='The number of sessions. (default is 1)')
+    argparser.add_argument('--minutes', type=float, default=10,
+                           help='The length of each session, in minutes (1 to 600). (default is 10)')
+    argparser.add_argument('--noise', type=float, default=0.1,
+                           help='The standard deviation of the gaze noise. (default is 0.1)')
+    argparser.add_argument('--dropout-rate', type=float, default=0.05,
+                           help='The fraction of frames without a face. (default is 0.05)')
+    argparser.add_argument('--bug-rate', type=float, default=0.002,
+                           help='The number of OpenGaze bug patterns per frame. (default is 0.002)')
+    argparser.add_argument('--error-rate', type=float, default=0.001,
+                           help='The fraction of OpenGaze gaze values that are 1e10 errors. (default is 0.001)')
+    argparser.add_argument('--seed', type=int, default=0, help='The seed of the first session. (default is 0)')
+    parsed_args = argparser.parse_args(args[1:])
+
+    lines = ["raw_path\ttruth_path\tms_per_frame\tsession"]
+    for i in range(parsed_args.sessions):
+        name = "session" + str(i + 1)
+        print("Generating " + name + "...")
+        session = generate_session(parsed_args.directory, name, parsed_args.minutes, parsed_args.seed + i,
+                                   parsed_args.noise, parsed_args.dropout_rate, parsed_args.bug_rate,
+                                   parsed_args.error_rate)
+        lines.append("\t".join([name + ".txt", name + "_truth.tsv", str(session["ms_per_frame"]), name]))
+
+    name = os.path.join(parsed_args.directory, "manifest.tsv")
+    with open(name, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print("Done! Saved to '" + parsed_args.directory + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,293 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "opengaze_implementation"))
+sys.path.append(os.path.join(REPO_DIR, "scripts"))
+
+from generate_data import generate_session
+from convert_opengaze_output import convert_csv_file, find_x_bounds, load_opengaze_output
+from evaluate_opengaze_accuracy import calculate_accuracies, parse_tsv_to_dict
+from make_visualized_comparison import get_intervals
+from process_video import compare_data, reformat_data
+
+"""
+Measures the throughput (frames per second) and peak memory of the pipeline's
+main functions on synthetic sessions from generate_data.py, and appends the
+results to a JSON lines file together with the commit they were measured at,
+so that a run can be compared with the previous one to spot regressions.
+"""
+
+DEFAULT_RESULTS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "results.jsonl")
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "gaze-coding-benchmarks")
+
+# Benchmarks that are skipped for longer sessions (parse_tsv_to_dict builds one
+# dict entry per millisecond), in minutes
+MAX_MINUTES = {"parse_tsv_to_dict": 60}
+
+
+"""
+Each benchmark takes a session from generate_data.generate_session and a
+directory for its outputs, does any preparation that should not be timed, and
+returns the function to time.
+"""
+
+
+def bench_convert_csv_file(session, work_dir):
+    end_time = session["num_frames"] * session["ms_per_frame"]
+    save_name = os.path.join(work_dir, session["session"] + "_converted_MOD3.tsv")
+    return lambda: convert_csv_file(session["raw_path"], session["ms_per_frame"], end_time, use_cache=False,
+                                    save_name=save_name)
+
+
+def bench_find_x_bounds(session, work_dir):
+    gaze_2d_x = load_opengaze_output(session["raw_path"], use_cache=False)[2]
+    gaze_2d_x = gaze_2d_x[np.abs(gaze_2d_x) < 1e10]
+    return lambda: find_x_bounds(gaze_2d_x)
+
+
+def bench_parse_tsv_to_dict(session, work_dir):
+    length_in_ms = int(round(session["num_frames"] * session["ms_per_frame"]))
+    return lambda: parse_tsv_to_dict(session["truth_path"], length_in_ms)
+
+
+def bench_calculate_accuracies(session, work_dir):
+    bench_convert_csv_file(session, work_dir)()
+    prediction_path = os.path.join(work_dir, session["session"] + "_converted_MOD3.tsv")
+    save_name = os.path.join(work_dir, session["session"] + "_accuracy.tsv")
+    return lambda: calculate_accuracies(session["raw_path"], session["truth_path"], prediction_path,
+                                        session["ms_per_frame"], save_name)
+
+
+def bench_reformat_data(session, work_dir):
+    processed_directory = os.path.dirname(session["openface_path"])
+    return lambda: reformat_data(session["session"], work_dir + os.sep, processed_directory=processed_directory)
+
+
+def bench_compare_data(session, work_dir):
+    bench_reformat_data(session, work_dir)()
+    new_tsv_path = os.path.join(work_dir, session["session"] + "_openface_data.tsv")
+    return lambda: compare_data(session["truth_path"], new_tsv_path)
+
+
+def bench_get_intervals(session, work_dir):
+    return lambda: get_intervals(session["truth_path"])
+
+
+BENCHMARKS = {
+    "convert_csv_file": bench_convert_csv_file,
+    "find_x_bounds": bench_find_x_bounds,
+    "parse_tsv_to_dict": bench_parse_tsv_to_dict,
+    "calculate_accuracies": bench_calculate_accuracies,
+    "reformat_data": bench_reformat_data,
+    "compare_data": bench_compare_data,
+    "get_intervals": bench_get_intervals,
+}
+
+
+"""
+Times a function (the best of several runs) and then measures its peak memory
+(the largest amount of memory allocated at once, traced by tracemalloc, which
+also sees numpy's arrays) in a separate run, since tracing slows it down.
+Returns the best time in seconds and the peak memory in bytes.
+Args:
+    function (function): the function to measure
+    repeat (int): the number of timed runs
+"""
+
+
+def measure(function, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+"""
+Returns the synthetic session of the given size, generating it into data_dir
+if it has not been generated before.
+Args:
+    data_dir (string): the directory of the generated sessions
+    minutes (float): the length of the session, in minutes
+    noise (float): the standard deviation of the gaze noise
+    seed (int): the seed of the session
+"""
+
+
+def get_session(data_dir, minutes, noise=0.1, seed=0):
+    name = "bench_{0:g}min_noise{1:g}_seed{2}".format(minutes, noise, seed)
+    directory = os.path.join(data_dir, name)
+    session_path = os.path.join(directory, "session.json")
+    if os.path.isfile(session_path):
+        with open(session_path) as f:
+            return json.load(f)
+
+    session = generate_session(directory, name, minutes, seed, noise)
+    with open(session_path, "w") as f:
+        json.dump(session, f)
+    return session
+
+
+"""
+Runs the benchmarks on one session size and returns a results record: the
+commit, the versions of Python, numpy and pandas, the session settings, and
+for every benchmark the number of frames, the best time, the throughput and
+the peak memory.
+Args:
+    names (list of strings): the benchmarks to run, from BENCHMARKS
+    data_dir (string): the directory of the generated sessions
+    minutes, noise, seed: see get_session
+    repeat (int): the number of timed runs of each benchmark
+"""
+
+
+def run_benchmarks(names, data_dir, minutes, noise=0.1, seed=0, repeat=3):
+    session = get_session(data_dir, minutes, noise, seed)
+    work_dir = os.path.join(data_dir, "work")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = {}
+    for name in names:
+        if minutes > MAX_MINUTES.get(name, float("inf")):
+            continue
+        function = BENCHMARKS[name](session, work_dir)
+        seconds, peak = measure(function, repeat)
+        results[name] = {"frames": session["num_frames"], "seconds": seconds,
+                         "frames_per_second": session["num_frames"] / seconds, "peak_memory_mb": peak / 1024 ** 2}
+        print("{0:<22} {1:>14,.0f} frames/s {2:>10.1f} MB".format(name, results[name]["frames_per_second"],
+                                                                   results[name]["peak_memory_mb"]))
+
+    return {"time": datetime.datetime.now().isoformat(timespec="seconds"), "commit": get_commit(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "minutes": minutes, "noise": noise, "seed": seed, "repeat": repeat, "results": results}
+
+
+"""
+Returns the current git commit of the repository (with "-dirty" if there are
+uncommitted changes), or None if it is not a git checkout.
+"""
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+"""
+Returns the records of a results file, oldest first.
+Args:
+    results_path (string): the path to the JSON lines file
+"""
+
+
+def read_results(results_path):
+    if not os.path.isfile(results_path):
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+"""
+Compares a record with the latest earlier record of the same session settings.
+Returns a list of (benchmark, throughput ratio, peak memory ratio, regressed)
+tuples, where a benchmark has regressed if its throughput dropped or its peak
+memory grew by more than the tolerance; an empty list if there is no earlier
+record.
+Args:
+    record (dict): the record from run_benchmarks
+    previous_records (list of dicts): the earlier records
+    tolerance (float): the relative change that counts as a regression
+"""
+
+
+def compare_results(record, previous_records, tolerance=0.2):
+    settings = ("minutes", "noise", "seed")
+    previous = [old for old in previous_records if all(old.get(key) == record[key] for key in settings)]
+    if len(previous) == 0:
+        return []
+
+    comparison = []
+    for name, result in record["results"].items():
+        old = previous[-1]["results"].get(name)
+        if old is None:
+            continue
+        speed = result["frames_per_second"] / old["frames_per_second"]
+        memory = result["peak_memory_mb"] / old["peak_memory_mb"] if old["peak_memory_mb"] > 0 else 1.0
+        comparison.append((name, speed, memory, speed < 1 - tolerance or memory > 1 + tolerance))
+    return comparison
+
+
+"""
+Takes in the session lengths to benchmark (in minutes), runs the benchmarks on
+a synthetic session of each length, appends the results to the results file
+(benchmarks/results.jsonl by default) and compares them with the previous
+results of the same settings
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument('--minutes', type=float, nargs='+', default=[1, 10],
+                           help='The session lengths to benchmark, in minutes. (default is 1 and 10)')
+    argparser.add_argument('--only', type=str, nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                           help='The benchmarks to run. (default is all)')
+    argparser.add_argument('--noise', type=float, default=0.1,
+                           help='The standard deviation of the gaze noise. (default is 0.1)')
+    argparser.add_argument('--seed', type=int, default=0, help='The seed of the sessions. (default is 0)')
+    argparser.add_argument('--repeat', type=int, default=3,
+                           help='The number of timed runs of each benchmark; the best counts. (default is 3)')
+    argparser.add_argument('--data-dir', type=str, default=DEFAULT_DATA_DIR,
+                           help='The directory the synthetic sessions are generated into and reused from.')
+    argparser.add_argument('--results', type=str, default=DEFAULT_RESULTS,
+                           help='The JSON lines file the results are appended to.')
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help='The relative slowdown or memory growth reported as a regression. (default is 0.2)')
+    parsed_args = argparser.parse_args(args[1:])
+
+    # keeps the frame cache used by calculate_accuracies out of the user's cache
+    os.environ.setdefault("GAZE_CODING_CACHE", os.path.join(parsed_args.data_dir, "cache"))
+
+    previous_records = read_results(parsed_args.results)
+    regressions = 0
+    for minutes in parsed_args.minutes:
+        print("Benchmarking a " + "{0:g}".format(minutes) + " minute session...")
+        record = run_benchmarks(parsed_args.only, parsed_args.data_dir, minutes, parsed_args.noise,
+                                parsed_args.seed, parsed_args.repeat)
+        for name, speed, memory, regressed in compare_results(record, previous_records, parsed_args.tolerance):
+            print("{0:<22} {1:>6.2f}x throughput {2:>6.2f}x peak memory{3}".format(
+                name, speed, memory, "  REGRESSION" if regressed else ""))
+            regressions += regressed
+        with open(parsed_args.results, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    print("Done! Saved to '" + parsed_args.results + "'" +
+          (" (" + str(regressions) + " regressions)" if regressions else ""))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
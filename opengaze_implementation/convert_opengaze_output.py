@@ -1,8 +1,8 @@
+import argparse
 import csv
 import sys
 import os
 import cv2
-import pandas as pd
 import statistics
 import numpy as np
 import numpy.polynomial.polynomial as poly
@@ -10,6 +10,30 @@ import numpy.polynomial.polynomial as poly
 from scipy import stats
 from scipy.signal import find_peaks
 from matplotlib import pyplot as plt
+import frame_cache
+import run_metrics
+from face_spans import has_face
+from label_timeline import LabelTimeline
+from smooth_labels import smooth_rows
+
+# Label codes used by the vectorized engine; LABELS[code] is the label name
+LABELS = ["none", "away", "left", "right"]
+NONE, AWAY, LEFT, RIGHT = range(len(LABELS))
+
+# The OpenGaze output columns used by the conversion, as (name, dtype) pairs in
+# the order of their column indices (0, 2, 6 and 7)
+OPENGAZE_DTYPE = [("frame", np.int64), ("confidence", np.float64),
+                  ("gaze_2d_x", np.float64), ("gaze_2d_y", np.float64)]
+
+# The heuristic parameters of the conversion:
+#   x_step, x_occupancy: the histogram bin width and the fraction of samples a
+#       bin must exceed in find_x_bounds
+#   y_z_score: the z-score of the gaze_2d_y "away" boundary
+#   right_x_max, right_ratio: left vectors with gaze_2d_x below right_x_max and
+#       gaze_2d_y / gaze_2d_x above right_ratio are corrected to right
+#   min_switch_duration: the longest quick switch that is removed, in ms
+DEFAULT_PARAMETERS = {"x_step": 0.15, "x_occupancy": 0.005, "y_z_score": -1.5,
+                      "right_x_max": 0.45, "right_ratio": 4.0, "min_switch_duration": 250}
 
 """
 Takes in the path to the original gaze video and uses cv2 to calculate the
@@ -39,25 +63,80 @@ Takes in the path to the OpenGaze output file, the length of each frame
 (in milliseconds), and the total duration of the corresponding video
 (in milliseconds), and translates that data into label data that indicates
 each time that the gaze direction changes, and what it changes to (either
-left, right, or None_of_the_above)
+left, right, away, or none). The result is written to [name]_converted_MOD3.tsv,
+or to save_name.
 Args:
     path_to_csv (string): the path to the OpenGaze output file
     frame_length (float): the duration of each frame (in milliseconds)
     end_time (float): the duration of the corresponding video (in milliseconds)
+    engine (string): "numpy" (default) to parse the file once into typed arrays
+        and label it with array operations, or "legacy" for the original
+        line-by-line loop; both produce identical output files
+    use_cache (bool): whether the numpy engine should load the parsed columns
+        from (and save them to) the frame cache
+    parameters (dict): heuristic parameters that override DEFAULT_PARAMETERS;
+        the legacy engine only supports the defaults
+    save_name (string): the path to write the result to (default is
+        [name]_converted_MOD3.tsv)
+    face_spans (LabelTimeline): the face spans of the video, from
+        face_spans.py; the time without a face is labeled none (numpy engine
+        only; default is none)
 
 """
 
 
-def convert_csv_file(path_to_csv, frame_length, end_time):
+def convert_csv_file(path_to_csv, frame_length, end_time, engine="numpy", use_cache=True, parameters=None,
+                     save_name=None, face_spans=None):
+    if save_name is None:
+        save_name = path_to_csv[:-4] + '_converted_MOD3.tsv'  # remove .txt from file name
+
+    parameters = get_parameters(parameters)
+
+    if engine == "numpy":
+        list_of_lists = get_label_changes(path_to_csv, frame_length, use_cache, parameters, face_spans)
+    elif engine == "legacy":
+        if parameters != DEFAULT_PARAMETERS:
+            raise ValueError("The legacy engine only supports the default parameters")
+        if face_spans is not None:
+            raise ValueError("The legacy engine does not support face spans")
+        with run_metrics.stage("legacy") as stage:
+            list_of_lists = get_label_changes_legacy(path_to_csv, frame_length)
+            stage.rows = len(list_of_lists)
+    else:
+        raise ValueError("Unknown conversion engine: " + str(engine))
+
+    # Clean the data further by removing very quick switches (i.e. when it
+    # switches to a new label and then switches back in less than 250 ms, or
+    # when it switches to None_of_the_above and then back to left or right in
+    # less than 250)
+    with run_metrics.stage("debounce", rows=len(list_of_lists)):
+        list_of_lists = smooth_rows(list_of_lists, min_duration=parameters["min_switch_duration"],
+                                    transient_labels=("None_of_the_above",), mode="compat")
+
+    # Write out the resulting data to a csv
+    with run_metrics.stage("write", rows=len(list_of_lists)):
+        timeline = LabelTimeline.from_labels([row[0] for row in list_of_lists], [row[2] for row in list_of_lists],
+                                             end=int(end_time))
+        timeline.write_tsv(save_name)
+
+
+"""
+The original, line-by-line implementation of the conversion. Returns the list
+of [time, duration, label, comment] rows at which the label changes, before
+the quick switches are removed.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    frame_length (float): the duration of each frame (in milliseconds)
+"""
+
+
+def get_label_changes_legacy(path_to_csv, frame_length):
 
     f = open(path_to_csv)
     lines = f.readlines()
     f.close()
 
-    name = path_to_csv[:-4]  # remove .txt from file name
-
     list_of_lists = []
-    fieldnames = ['Time', 'Duration', 'Trackname', 'Comments']
 
     # Initial cleanup: Exclude entries that correspond to an OpenGaze bug pattern.
     # (The pattern is four zero-confidence entries sandwiched between two
@@ -141,67 +220,237 @@ def convert_csv_file(path_to_csv, frame_length, end_time):
             list_of_lists.append([time, 0, label, "(null)"])
             prev_label = label
 
-    # Clean the data further by removing very quick switches (i.e. when it
-    # switches to a new label and then switches back in less than 250 ms, or
-    # when it switches to None_of_the_above and then back to left or right in
-    # less than 250)
-    i = 0
-    while(i < len(list_of_lists)-2):
-        row1 = list_of_lists[i]
-        row2 = list_of_lists[i+1]
-        row3 = list_of_lists[i+2]
-
-        label1 = row1[2]
-        label2 = row2[2]
-        label3 = row3[2]
-
-        time2 = row2[0]
-        time3 = row3[0]
-
-        # remove instances where it switches to a new label and then switches
-        # back in less than 250 ms
-        if label1 == label3 and label2 != label1:
-            if time3 - time2 <= 250:
-                list_of_lists.pop(i+1)
-                list_of_lists.pop(i+1)
-            else:
-                i += 1
-        # remove instances where it switches to None_of_the_above and then
-        # back to left or right in less than 250 ms
-        elif label2 == "None_of_the_above" and label1 != label2 and label3 != label2:
-            if time3 - time2 <= 250:
-                list_of_lists.pop(i+1)
-            else:
-                i += 1
+    return list_of_lists
+
+
+"""
+The vectorized implementation of the conversion: the OpenGaze output is parsed
+once into typed arrays, and the bug pattern, labels and label changes are all
+found with array operations. Returns the same rows as get_label_changes_legacy.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    frame_length (float): the duration of each frame (in milliseconds)
+    use_cache (bool): whether to use the frame cache
+    parameters (dict): heuristic parameters that override DEFAULT_PARAMETERS
+    face_spans (LabelTimeline): the face spans of the video (see
+        label_face_spans; default is none)
+"""
+
+
+def get_label_changes(path_to_csv, frame_length, use_cache=True, parameters=None, face_spans=None):
+    parameters = get_parameters(parameters)
+    with run_metrics.stage("parse") as stage:
+        frames, confidence, gaze_2d_x, gaze_2d_y = load_clean_frames(path_to_csv, use_cache)
+        stage.rows = len(frames)
+
+    with run_metrics.stage("thresholds", rows=len(frames)):
+        thresholds = find_thresholds(gaze_2d_x, gaze_2d_y, parameters)
+    with run_metrics.stage("label", rows=len(frames)):
+        codes = assign_labels(confidence, gaze_2d_x, gaze_2d_y, *thresholds,
+                              right_x_max=parameters["right_x_max"], right_ratio=parameters["right_ratio"])
+        if face_spans is None:
+            times, change_codes = find_label_changes(frames, codes, frame_length)
         else:
-            i += 1
+            times, change_codes = label_face_spans(frames, codes, frame_length, face_spans)
+        return [[time, 0, LABELS[code], "(null)"] for time, code in zip(times.tolist(), change_codes.tolist())]
 
-    # Write out the resulting data to a csv
-    list_of_lists.append([int(end_time), 0, "end", "(null)"])
-    df = pd.DataFrame(list_of_lists, columns=fieldnames)
-    df.to_csv(name+'_converted_MOD3.tsv', index=False, sep="\t")
+
+"""
+Returns DEFAULT_PARAMETERS, updated with the given parameters.
+Args:
+    parameters (dict): heuristic parameters that override DEFAULT_PARAMETERS
+"""
+
+
+def get_parameters(parameters=None):
+    merged = dict(DEFAULT_PARAMETERS)
+    if parameters is not None:
+        unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError("Unknown conversion parameters: " + ", ".join(sorted(unknown)))
+        merged.update(parameters)
+    return merged
+
+
+"""
+Loads the OpenGaze output and excludes the entries that correspond to the
+OpenGaze bug pattern. Returns (frame, confidence, gaze_2d_x, gaze_2d_y) arrays.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    use_cache (bool): whether to use the frame cache
+"""
+
+
+def load_clean_frames(path_to_csv, use_cache=True):
+    frames, confidence, gaze_2d_x, gaze_2d_y = load_opengaze_output(path_to_csv, use_cache)
+    keep = find_clean_rows(confidence)
+    return frames[keep], confidence[keep], gaze_2d_x[keep], gaze_2d_y[keep]
+
+
+"""
+Calculates the thresholds used to assign labels, omitting OpenGaze's error
+outputs. Returns (x_away_lower_bound, x_away_upper_bound, y_away_upper_bound).
+Args:
+    gaze_2d_x, gaze_2d_y (numpy arrays of floats): the cleaned OpenGaze columns
+    parameters (dict): the heuristic parameters (see DEFAULT_PARAMETERS)
+"""
+
+
+def find_thresholds(gaze_2d_x, gaze_2d_y, parameters=DEFAULT_PARAMETERS):
+    x_away_lower_bound, x_away_upper_bound = find_x_bounds(gaze_2d_x[np.abs(gaze_2d_x) < 1e10],
+                                                           parameters["x_step"], parameters["x_occupancy"])
+    y_away_upper_bound = get_fast_boundary_value(parameters["y_z_score"],
+                                                 gaze_2d_y[np.abs(gaze_2d_y) < 1e10], gaze_2d_y)
+    return x_away_lower_bound, x_away_upper_bound, y_away_upper_bound
+
+
+"""
+Finds the frames at which the label changes (including the first frame), and
+returns the times of those frames (in milliseconds) and their label codes.
+Args:
+    frames (numpy array of ints): the frame numbers
+    codes (numpy array of ints): the label code of each frame
+    frame_length (float): the duration of each frame (in milliseconds)
+"""
+
+
+def find_label_changes(frames, codes, frame_length):
+    if len(codes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=codes.dtype)
+    change_indices = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+    times = np.rint((frames[change_indices] - 1) * frame_length).astype(np.int64)
+    return times, codes[change_indices]
+
+
+"""
+Like find_label_changes, but every frame without a face in the face spans is
+labeled none, and each span without a face starts with a change to none (the
+OpenGaze output may have no frames there, if the extraction skipped them).
+Args:
+    frames (numpy array of ints): the frame numbers
+    codes (numpy array of ints): the label code of each frame
+    frame_length (float): the duration of each frame (in milliseconds)
+    face_spans (LabelTimeline): the face spans of the video, from face_spans.py
+"""
+
+
+def label_face_spans(frames, codes, frame_length, face_spans):
+    times = np.rint((frames - 1) * frame_length).astype(np.int64)
+    codes = np.where(has_face(face_spans, times), codes, NONE).astype(codes.dtype)
+
+    gap_starts = face_spans.times[~has_face(face_spans, face_spans.times)]
+    if len(face_spans) == 0 or face_spans.times[0] > 0:
+        gap_starts = np.concatenate(([0], gap_starts))
+    times = np.concatenate((gap_starts, times))
+    codes = np.concatenate((np.full(len(gap_starts), NONE, dtype=codes.dtype), codes))
+    order = np.argsort(times, kind="stable")
+    times, codes = times[order], codes[order]
+
+    changes = np.ones(len(codes), dtype=bool)
+    changes[1:] = codes[1:] != codes[:-1]
+    return times[changes], codes[changes]
+
+
+"""
+Reads the columns of an OpenGaze output file that the conversion needs, and
+returns them as arrays: (frame, confidence, gaze_2d_x, gaze_2d_y). With the
+cache, the columns are memory-mapped from the frame cache, and the file is
+only parsed if it has not been parsed before (or has changed since).
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    use_cache (bool): whether to use the frame cache
+"""
+
+
+def load_opengaze_output(path_to_csv, use_cache=True):
+    if use_cache:
+        data = frame_cache.load_columns(path_to_csv, frame_cache.DEFAULT_COLUMNS)
+    else:
+        data = frame_cache.parse_columns(path_to_csv, frame_cache.DEFAULT_COLUMNS)
+    return data["frame"], data["confidence"], data["gaze_2d_x"], data["gaze_2d_y"]
+
+
+"""
+Returns a boolean mask of the rows that survive the initial cleanup: rows that
+are part of the OpenGaze bug pattern are dropped, as are the last four rows of
+the file (which the original loop never reaches).
+The original loop skips four rows starting at row i whenever rows i, i+1 and
+i+2 have zero confidence and row i+4 does not, i.e. at the run of zeros that
+ends at i+2 or i+3. Two consecutive starts can only occur at the end of a run
+of four or more zeros; the scan takes the first and skips over the second.
+Args:
+    confidence (numpy array of floats): the confidence column of the output
+"""
+
+
+def find_clean_rows(confidence):
+    n = len(confidence)
+    keep = np.zeros(n, dtype=bool)
+    if n <= 4:
+        return keep
+
+    zero = confidence == 0
+    m = n - 4
+    starts = zero[:m] & zero[1:m+1] & zero[2:m+2] & ~zero[4:]
+    pattern_starts = starts.copy()
+    pattern_starts[1:] &= ~starts[:-1]
+
+    skipped = pattern_starts.copy()
+    for offset in range(1, 4):
+        skipped[offset:] |= pattern_starts[:-offset]
+    keep[:m] = ~skipped
+    return keep
+
+
+"""
+Assigns a label code (an index into LABELS) to every frame, using the same
+rules as the original loop in get_label_changes_legacy.
+Args:
+    confidence, gaze_2d_x, gaze_2d_y (numpy arrays of floats): the OpenGaze columns
+    x_away_lower_bound, x_away_upper_bound (floats): the "away" thresholds for gaze_2d_x
+    y_away_upper_bound (float): the "away" threshold for gaze_2d_y
+    right_x_max, right_ratio (floats): left vectors with gaze_2d_x below right_x_max
+        and gaze_2d_y / gaze_2d_x above right_ratio are corrected to right
+"""
+
+
+def assign_labels(confidence, gaze_2d_x, gaze_2d_y, x_away_lower_bound, x_away_upper_bound, y_away_upper_bound,
+                  right_x_max=0.45, right_ratio=4.0):
+    codes = np.full(len(confidence), RIGHT, dtype=np.int8)
+
+    # Left vectors that are close to vertical and very long are corrected to right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        right_correction = (gaze_2d_x < right_x_max) & (gaze_2d_y / gaze_2d_x > right_ratio)
+    codes[(gaze_2d_x > (x_away_lower_bound + x_away_upper_bound)/2) & ~right_correction] = LEFT
+
+    away = (gaze_2d_y < max(y_away_upper_bound, 0)) | (gaze_2d_x < x_away_lower_bound) | (gaze_2d_x > x_away_upper_bound)
+    codes[away] = AWAY
+    codes[confidence == 0] = NONE
+    return codes
 
 
 """
 Calculate the upper and lower  "away" thresholds for the gaze_num_x component.
 Args:
-    input_data (list of floats): gaze_num_x data
+    input_data (list or numpy array of floats): gaze_num_x data
+    step (float): the width of the histogram bins
+    occupancy (float): the fraction of all samples a bin must exceed to lie
+        within the bounds
 """
 
 
-def find_x_bounds(input_data):
+def find_x_bounds(input_data, step=0.15, occupancy=0.005):
     # First bin data into buckets, where bins have size `step`
-    start = round(min(input_data), 1)
-    stop = round(max(input_data), 1)
-    step = 0.15
+    start = round(float(np.min(input_data)), 1)
+    stop = round(float(np.max(input_data)), 1)
     bin_left_edges = [round(start + step * i, 2) for i in range(round((stop - start) / step + 2))]
     counts, _ = np.histogram(input_data, bin_left_edges)
 
     # Threshold based on the count of samples in each bin
-    maximum_samples = len(input_data) * 0.005
-    indices_above_max = [i for i in range(len(counts)) if counts[i] > maximum_samples]
-    lower_index = min(indices_above_max)
-    upper_index = max(indices_above_max)
+    maximum_samples = len(input_data) * occupancy
+    indices_above_max = np.flatnonzero(counts > maximum_samples)
+    lower_index = indices_above_max.min()
+    upper_index = indices_above_max.max()
 
     # Find the midpoints of each bin, and get the data values at the thresholds
     x_data = [round(bin_edge + step / 2, 3) for bin_edge in bin_left_edges][:-1]
@@ -243,39 +492,103 @@ def get_boundary_value(z_score, input_data):
     return stdev * z_score + mean
 
 
+"""
+Same as get_boundary_value, but computed with numpy instead of the exact
+(and slow) rational arithmetic of the statistics module. The two results can
+only differ by rounding error, which only matters if a value that is compared
+against the boundary lies within that error of it; in that case the exact
+computation is used instead, so the labels are always the same.
+Args:
+    z_score (float): the desired z-score
+    input_data (numpy array of floats): the sequence in which to find the raw score
+    compared_data (numpy array of floats): the values that will be compared
+        against max(boundary, 0)
+"""
+
+
+def get_fast_boundary_value(z_score, input_data, compared_data):
+    mean = np.mean(input_data)
+    stdev = np.std(input_data, ddof=1)
+    boundary = float(stdev * z_score + mean)
+
+    # Rounding error of numpy's pairwise summation is far below this tolerance
+    tolerance = 1e-9 * (np.mean(np.abs(input_data)) + abs(z_score) * stdev)
+    if np.any(np.abs(compared_data - max(boundary, 0)) <= tolerance):
+        return get_boundary_value(z_score, input_data.tolist())
+    return boundary
+
+
 """
 Takes in CLI arguments (the path to the original gaze video, and the path to
 the raw OpenGaze output csv (i.e. [name].txt) and writes the cleaned & converted
 OpenGaze output to a new tsv file ([name]_converted.tsv) in the same format as
-the original, manually labeled gaze data
+the original, manually labeled gaze data. The optional --engine flag chooses
+between the vectorized engine (default) and the original loop; --face-spans
+labels the time without a face (see face_spans.py) none.
 """
 
 
 def main(args):
 
     # first arg should be path to video, second should be path to output file
-    if len(args) < 3:
-        print("Not enough arguments")
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'video_path',
+        type=str,
+        help='The path to the original gaze video.')
+    argparser.add_argument(
+        'csv_path',
+        type=str,
+        help='The path to the raw OpenGaze output file.')
+    argparser.add_argument(
+        '--engine',
+        choices=['numpy', 'legacy'],
+        default='numpy',
+        help='The conversion engine to use: the vectorized "numpy" engine (default) or the original '
+             '"legacy" loop. Both produce identical output.')
+    argparser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not load the parsed OpenGaze output from (or save it to) the frame cache.')
+    argparser.add_argument(
+        '--face-spans',
+        type=str,
+        default=None,
+        help='The path to the face spans of the video ([video name]_faces.tsv, from face_spans.py); the time '
+             'without a face is labeled none.')
+    run_metrics.add_arguments(argparser, hot_stage='convert')
+    parsed_args = argparser.parse_args(args[1:])
+    video_path = parsed_args.video_path
+    csv_path = parsed_args.csv_path
+
+    if not os.path.isfile(video_path):
+        print("Invalid path to video")
         return
-    else:
-        video_path = args[1]
-        csv_path = args[2]
 
-        if not os.path.isfile(video_path):
-            print("Invalid path to video")
-            return
+    if not os.path.isfile(csv_path):
+        print("Invalid path to OpenGaze output file")
+        return
 
-        if not os.path.isfile(csv_path):
-            print("Invalid path to OpenGaze output file")
+    face_spans = None
+    if parsed_args.face_spans is not None:
+        if not os.path.isfile(parsed_args.face_spans):
+            print("Invalid path to face spans")
             return
+        face_spans = LabelTimeline.read_tsv(parsed_args.face_spans)
 
-        frame_len, duration = get_vid_info(video_path)
+    with run_metrics.RunMetrics("convert_opengaze_output", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["csv_path"] = os.path.abspath(csv_path)
+        metrics.info["engine"] = parsed_args.engine
+        with metrics.stage("video_info"):
+            frame_len, duration = get_vid_info(video_path)
         print("Frame length:", frame_len)
         print("\n")
         print("Converting video...")
-        convert_csv_file(csv_path, frame_len, duration)
-        name = csv_path[:-4] + '_converted.tsv'
-        print("Done! Output saved to "+name)
+        with metrics.stage("convert"):
+            convert_csv_file(csv_path, frame_len, duration, engine=parsed_args.engine,
+                             use_cache=not parsed_args.no_cache, face_spans=face_spans)
+    name = csv_path[:-4] + '_converted.tsv'
+    print("Done! Output saved to "+name)
 
 
 if __name__ == "__main__":
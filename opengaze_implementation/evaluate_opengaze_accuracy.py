@@ -2,11 +2,18 @@ import numpy as np
 import pandas as pd
 import sys
 import os
+import frame_cache
+import run_metrics
+from label_timeline import LabelTimeline
+
+# The labels that are evaluated; every other label counts as "away"
+EVALUATED_LABELS = ["left", "right", "away"]
 
 """
 Calculates accuracies for each of left/right/away and saves the output locally.
 Accuracy is calculated by comparing the actual and predicted label at each
-millisecond across the length of the original video.
+millisecond across the length of the original video. The milliseconds are not
+visited one by one; they are counted per interval between label changes.
 Args:
     original_path (str): the path to the raw OpenGaze output txt/csv file
     truth_path (str): the path to the label truth tsv
@@ -17,76 +24,92 @@ Args:
 
 
 def calculate_accuracies(original_path, truth_path, prediction_path, ms_per_frame, save_name):
-    f = open(original_path)
-    lines = f.readlines()
-    f.close()
-
-    # Calculate the length of the original video in ms
-    length_in_frames = lines[-1].split(",")[0]
-    length_in_ms = round(float(length_in_frames) * ms_per_frame)
-
-    # Create dictionaries that map each millisecond to the labels [truth, predicted]
-    # at that time for each ms in the length of the video
-    truth_dict = parse_tsv_to_dict(truth_path, length_in_ms)
-    prediction_dict = parse_tsv_to_dict(prediction_path, length_in_ms)
+    confusion, length_in_ms = calculate_confusion(original_path, truth_path, prediction_path, ms_per_frame)
 
     # Create dictionaries for each truth label that map each label to
     # the number of times that label is predicted with that truth label
-    left_predictions = {"left": 0, "right": 0, "away": 0}
-    right_predictions = {"left": 0, "right": 0, "away": 0}
-    away_predictions = {"left": 0, "right": 0, "away": 0}
-
-    for t in range(length_in_ms):
-        truth_label = truth_dict[t]
-        predicted_label = prediction_dict[t]
-
-        if truth_label == "left":
-            left_predictions[predicted_label] += 1
-        elif truth_label == "right":
-            right_predictions[predicted_label] += 1
-        else:
-            away_predictions[predicted_label] += 1
+    left_predictions = dict(zip(EVALUATED_LABELS, confusion[EVALUATED_LABELS.index("left")].tolist()))
+    right_predictions = dict(zip(EVALUATED_LABELS, confusion[EVALUATED_LABELS.index("right")].tolist()))
+    away_predictions = dict(zip(EVALUATED_LABELS, confusion[EVALUATED_LABELS.index("away")].tolist()))
 
     total_left_truth = sum(left_predictions.values())
     total_right_truth = sum(right_predictions.values())
     total_away_truth = sum(away_predictions.values())
 
+    # Proportions with a zero denominator (e.g. no "right" in the truth) are "n/a"
     row_fieldnames = ["Truth", "% of video", "Correct prediction", "Confused with", "Confusion proportion"]
     row_left = ["left",
-                "{:.0%}".format(total_left_truth/length_in_ms),
-                "left: {:.0%}".format(left_predictions["left"]/total_left_truth),
-                "right: {0:.0%} / away: {1:.0%}".format(
-                    left_predictions["right"]/total_left_truth,
-                    left_predictions["away"]/total_left_truth),
-                "{0:.0%} / {1:.0%}".format(
-                    left_predictions["right"]/(left_predictions["right"]+left_predictions["away"]),
-                    left_predictions["away"]/(left_predictions["right"]+left_predictions["away"]))]
+                _percent(total_left_truth, length_in_ms),
+                "left: " + _percent(left_predictions["left"], total_left_truth),
+                "right: {0} / away: {1}".format(
+                    _percent(left_predictions["right"], total_left_truth),
+                    _percent(left_predictions["away"], total_left_truth)),
+                "{0} / {1}".format(
+                    _percent(left_predictions["right"], left_predictions["right"]+left_predictions["away"]),
+                    _percent(left_predictions["away"], left_predictions["right"]+left_predictions["away"]))]
     row_right = ["right",
-                 "{:.0%}".format(total_right_truth/length_in_ms),
-                 "right: {:.0%}".format(right_predictions["right"]/total_right_truth),
-                 "left: {0:.0%} / away: {1:.0%}".format(
-                     right_predictions["left"]/total_right_truth,
-                     right_predictions["away"]/total_right_truth),
-                 "{0:.0%} / {1:.0%}".format(
-                     right_predictions["left"]/(right_predictions["left"]+right_predictions["away"]),
-                     right_predictions["away"]/(right_predictions["left"]+right_predictions["away"]))]
+                 _percent(total_right_truth, length_in_ms),
+                 "right: " + _percent(right_predictions["right"], total_right_truth),
+                 "left: {0} / away: {1}".format(
+                     _percent(right_predictions["left"], total_right_truth),
+                     _percent(right_predictions["away"], total_right_truth)),
+                 "{0} / {1}".format(
+                     _percent(right_predictions["left"], right_predictions["left"]+right_predictions["away"]),
+                     _percent(right_predictions["away"], right_predictions["left"]+right_predictions["away"]))]
     row_away = ["away",
-                "{:.0%}".format(total_away_truth/length_in_ms),
-                "away: {:.0%}".format(away_predictions["away"]/total_away_truth),
-                "left: {:.0%} / right: {:.0%}".format(
-                    away_predictions["left"]/total_away_truth,
-                    away_predictions["right"]/total_away_truth),
-                "{0:.0%} / {1:.0%}".format(
-                    away_predictions["left"]/(away_predictions["left"]+away_predictions["right"]),
-                    away_predictions["right"]/(away_predictions["left"]+away_predictions["right"]))]
+                _percent(total_away_truth, length_in_ms),
+                "away: " + _percent(away_predictions["away"], total_away_truth),
+                "left: {0} / right: {1}".format(
+                    _percent(away_predictions["left"], total_away_truth),
+                    _percent(away_predictions["right"], total_away_truth)),
+                "{0} / {1}".format(
+                    _percent(away_predictions["left"], away_predictions["left"]+away_predictions["right"]),
+                    _percent(away_predictions["right"], away_predictions["left"]+away_predictions["right"]))]
 
     df = pd.DataFrame([row_left, row_right, row_away], columns=row_fieldnames)
     df.to_csv(save_name, index=False, sep="\t")
 
 
+def _percent(numerator, denominator):
+    return "{:.0%}".format(numerator/denominator) if denominator != 0 else "n/a"
+
+
+"""
+Calculates the confusion matrix (in milliseconds) between the truth and the
+predicted labels of a video. Returns the 3x3 confusion matrix (rows are truth
+labels and columns are predicted labels, in EVALUATED_LABELS order) and the
+length of the video in milliseconds.
+Args:
+    original_path (str): the path to the raw OpenGaze output txt/csv file
+    truth_path (str): the path to the label truth tsv
+    prediction_path (str): the path to the label predictions (OpenGaze) tsv
+    ms_per_frame (float): the length of 1 frame in the original video, in milliseconds
+"""
+
+
+def calculate_confusion(original_path, truth_path, prediction_path, ms_per_frame):
+    # Calculate the length of the original video in ms from the last frame number
+    # (the frame column is loaded from the frame cache when possible)
+    with run_metrics.stage("video_length"):
+        length_in_frames = frame_cache.load_columns(original_path, ["frame"])["frame"][-1]
+        length_in_ms = round(float(length_in_frames) * ms_per_frame)
+
+    # Count the milliseconds with each combination of [truth, predicted] labels
+    with run_metrics.stage("read_labels") as stage:
+        truth_times, truth_codes = read_change_points(truth_path)
+        prediction_times, prediction_codes = read_change_points(prediction_path)
+        stage.rows = len(truth_times) + len(prediction_times)
+    with run_metrics.stage("confusion", rows=len(truth_times) + len(prediction_times)):
+        confusion = confusion_from_change_points(truth_times, truth_codes, prediction_times, prediction_codes,
+                                                 length_in_ms)
+    return confusion, length_in_ms
+
+
 """
 Convert a time/label tsv to a dictionary with keys being the time (in ms)
 for each ms in length_in_ms, and values being the corresponding label at that time.
+This builds one entry per millisecond; calculate_accuracies uses
+read_change_points instead, which gives the same labels.
 Args:
     file_path (string): path to the labels file (original or OpenGaze)
     length_in_ms: length of the original video, in milliseconds
@@ -94,28 +117,81 @@ Args:
 
 
 def parse_tsv_to_dict(file_path, length_in_ms, delimiter='\t'):
-    f = open(file_path)
-    lines = f.readlines()[1:]  # ignore the header line
-    f.close()
-
-    # Parse the timestamp and label columns of the raw tsv into a dict
-    timestamp_to_label = dict()
-    for line in lines:
-        entries = line.split(delimiter)
-        timestamp_to_label[int(entries[0])] = entries[2]
-
-    # Convert the timestamps dict into a continuous time dict, with a
-    # [time: label] entry for each ms in the video
-    time_to_label = dict()
-    current_label = 'away'
-    for t in range(length_in_ms):
-        # Update the current label when there is a time stamp
-        if t in timestamp_to_label:
-            current_label = timestamp_to_label[t]
-        # Map time to label, converting all labels that aren't "left" or "right" to "away"
-        time_to_label[t] = current_label if current_label == "left" or current_label == "right" else "away"
-
-    return time_to_label
+    times, codes = _drop_negative_times(*read_change_points(file_path, delimiter))
+    labels = np.asarray(EVALUATED_LABELS)[_codes_at(times, codes, np.arange(length_in_ms))]
+    return dict(zip(range(length_in_ms), labels.tolist()))
+
+
+"""
+Reads the change points of a time/label tsv: the times (in ms) at which the
+label changes and the labels they change to, as indices into EVALUATED_LABELS
+(all labels that aren't "left" or "right" are "away"). The times are sorted,
+keeping the order of the file for equal times.
+Args:
+    file_path (string): path to the labels file (original or OpenGaze)
+"""
+
+
+def read_change_points(file_path, delimiter='\t'):
+    timeline = LabelTimeline.read_tsv(file_path, delimiter).remap({"left": "left", "right": "right"}, "away")
+    times = timeline.times
+    codes = np.asarray([EVALUATED_LABELS.index(label) for label in timeline.vocabulary], dtype=np.int8)[timeline.codes]
+    # The "end" row is a change to "away" as well
+    if timeline.end is not None:
+        times = np.append(times, timeline.end)
+        codes = np.append(codes, np.int8(EVALUATED_LABELS.index("away")))
+
+    order = np.argsort(times, kind="stable")
+    return times[order], codes[order]
+
+
+"""
+Calculates the confusion matrix between the truth and the predicted labels,
+counting the milliseconds in [0, length_in_ms) that have each combination of
+labels. Both label sequences are given as sorted change points, which are
+merged, so the cost depends on the number of label changes and not on the
+length of the video. Before its first change, a sequence is "away"; when
+several changes have the same time, the last one counts, and changes before
+time 0 are ignored.
+Returns a 3x3 array of ints: rows are truth labels and columns are predicted
+labels, in EVALUATED_LABELS order.
+Args:
+    truth_times, prediction_times (numpy arrays of ints): the sorted times (in
+        milliseconds) at which the labels change
+    truth_codes, prediction_codes (numpy arrays of ints): the labels they change
+        to, as indices into EVALUATED_LABELS
+    length_in_ms (int): length of the original video, in milliseconds
+"""
+
+
+def confusion_from_change_points(truth_times, truth_codes, prediction_times, prediction_codes, length_in_ms):
+    truth_times, truth_codes = _drop_negative_times(truth_times, truth_codes)
+    prediction_times, prediction_codes = _drop_negative_times(prediction_times, prediction_codes)
+    boundaries = np.union1d(np.concatenate((truth_times, prediction_times)), [0, length_in_ms])
+    boundaries = boundaries[(boundaries >= 0) & (boundaries <= length_in_ms)]
+    starts = boundaries[:-1]
+    durations = np.diff(boundaries)
+
+    truth = _codes_at(truth_times, truth_codes, starts)
+    prediction = _codes_at(prediction_times, prediction_codes, starts)
+    n = len(EVALUATED_LABELS)
+    confusion = np.bincount(truth * n + prediction, weights=durations, minlength=n * n)
+    return confusion.astype(np.int64).reshape(n, n)
+
+
+def _drop_negative_times(times, codes):
+    times = np.asarray(times)
+    start = np.searchsorted(times, 0, side="left")
+    return times[start:], np.asarray(codes)[start:]
+
+
+def _codes_at(times, codes, query_times):
+    # The label at each query time is the last change at or before it
+    away = EVALUATED_LABELS.index("away")
+    if len(times) == 0:
+        return np.full(len(query_times), away, dtype=np.int64)
+    indices = np.searchsorted(times, query_times, side="right") - 1
+    return np.where(indices >= 0, np.asarray(codes)[np.maximum(indices, 0)], away).astype(np.int64)
 
 
 """
@@ -125,7 +201,7 @@ and what mistakes are made, when predicting each of the labels and saves the out
 """
 
 
-def main(original_path, truth_path, prediction_path, ms_per_frame):
+def main(original_path, truth_path, prediction_path, ms_per_frame, metrics=None, profile=None):
     if not os.path.isfile(original_path):
         print("Invalid path to opengaze raw output")
         return
@@ -139,7 +215,10 @@ def main(original_path, truth_path, prediction_path, ms_per_frame):
         return
 
     name = prediction_path[: -4] + "_accuracy.tsv"
-    calculate_accuracies(original_path, truth_path, prediction_path, ms_per_frame, name)
+    with run_metrics.RunMetrics("evaluate_opengaze_accuracy", metrics, profile) as run:
+        run.info["prediction_path"] = os.path.abspath(prediction_path)
+        with run.stage("evaluate"):
+            calculate_accuracies(original_path, truth_path, prediction_path, ms_per_frame, name)
     print("Done! Saved to '" + name + "'")
 
 
@@ -166,5 +245,6 @@ if __name__ == "__main__":
         nargs='?',
         default=33.3333,
         help='The length of 1 frame in the original video, in milliseconds. (default is 33.3333 ms)')
+    run_metrics.add_arguments(argparser, hot_stage='evaluate')
 
     main(**argparser.parse_args().__dict__)
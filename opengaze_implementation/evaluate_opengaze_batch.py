@@ -0,0 +1,271 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from evaluate_opengaze_accuracy import EVALUATED_LABELS, calculate_confusion
+import run_metrics
+
+"""
+Reads a manifest of sessions: a tsv with the columns raw_path (the raw OpenGaze
+output), truth_path (the label truth tsv) and, optionally, prediction_path (the
+converted OpenGaze label tsv; default [raw name]_converted_MOD3.tsv),
+ms_per_frame (default 33.3333), session (default: the name of the raw output
+file, also for a blank cell) and duration_ms (the length of the video, which the sweep ends the
+predictions at; default: the time of the last OpenGaze frame). Relative paths
+are relative to the manifest. Returns a list of session dicts.
+Args:
+    manifest_path (string): the path to the manifest tsv
+"""
+
+
+def read_manifest(manifest_path):
+    # session names are read as strings, so that e.g. "007" stays "007"
+    manifest = pd.read_csv(manifest_path, sep="\t", dtype={"session": str})
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    sessions = []
+    for row in manifest.to_dict("records"):
+        raw_path = os.path.join(directory, row["raw_path"])
+        prediction_path = row.get("prediction_path")
+        if not isinstance(prediction_path, str):
+            prediction_path = raw_path[:-4] + "_converted_MOD3.tsv"
+        ms_per_frame = row.get("ms_per_frame")
+        duration_ms = row.get("duration_ms")
+        session = row.get("session")
+        sessions.append({
+            "session": session if isinstance(session, str) else os.path.splitext(os.path.basename(raw_path))[0],
+            "raw_path": raw_path,
+            "truth_path": os.path.join(directory, row["truth_path"]),
+            "prediction_path": os.path.join(directory, prediction_path),
+            "ms_per_frame": 33.3333 if ms_per_frame is None or pd.isna(ms_per_frame) else float(ms_per_frame),
+            "duration_ms": None if duration_ms is None or pd.isna(duration_ms) else float(duration_ms),
+        })
+    return sessions
+
+
+"""
+Finds the sessions in a directory: every raw OpenGaze output file [name].txt
+that has a truth tsv [name][truth_suffix] next to it. The predictions are read
+from [name]_converted_MOD3.tsv. Returns a list of session dicts, like
+read_manifest.
+Args:
+    directory (string): the directory to search
+    truth_suffix (string): the suffix that replaces ".txt" in the truth tsv name
+    ms_per_frame (float): the length of 1 frame in the videos, in milliseconds
+"""
+
+
+def find_sessions(directory, truth_suffix="_truth.tsv", ms_per_frame=33.3333):
+    sessions = []
+    for raw_path in sorted(glob.glob(os.path.join(directory, "*.txt"))):
+        truth_path = raw_path[:-4] + truth_suffix
+        if os.path.isfile(truth_path):
+            sessions.append({
+                "session": os.path.splitext(os.path.basename(raw_path))[0],
+                "raw_path": raw_path,
+                "truth_path": truth_path,
+                "prediction_path": raw_path[:-4] + "_converted_MOD3.tsv",
+                "ms_per_frame": ms_per_frame,
+            })
+    return sessions
+
+
+"""
+Evaluates one session. Returns a dict with the session name, the length of the
+video, the confusion matrix (in milliseconds; rows are truth labels and columns
+are predicted labels, in EVALUATED_LABELS order), the scores from
+summarize_confusion, and the error message if the session could not be
+evaluated.
+Args:
+    session (dict): a session from read_manifest or find_sessions
+"""
+
+
+def evaluate_session(session):
+    result = {"session": session["session"]}
+    try:
+        confusion, length_in_ms = calculate_confusion(session["raw_path"], session["truth_path"],
+                                                      session["prediction_path"], session["ms_per_frame"])
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+        return result
+    result["length_ms"] = length_in_ms
+    result["confusion"] = confusion.tolist()
+    result.update(summarize_confusion(confusion))
+    return result
+
+
+"""
+Calculates the scores of a confusion matrix: the overall accuracy, and for
+each truth label its share of the video, its accuracy and the proportions it
+was confused with each other label. Scores whose denominator is zero (e.g. the
+accuracy of "right" when there is no "right" in the truth) are None, and a
+warning says why.
+Args:
+    confusion (numpy array of ints): a 3x3 confusion matrix
+"""
+
+
+def summarize_confusion(confusion):
+    confusion = np.asarray(confusion)
+    total = int(confusion.sum())
+    warnings = []
+    if total == 0:
+        warnings.append("the video has no length")
+    summary = {"accuracy": _ratio(np.trace(confusion), total), "labels": {}}
+
+    for t, truth_label in enumerate(EVALUATED_LABELS):
+        truth_total = int(confusion[t].sum())
+        if truth_total == 0 and total > 0:
+            warnings.append("no '" + truth_label + "' in the truth")
+        summary["labels"][truth_label] = {
+            "truth_ms": truth_total,
+            "share_of_video": _ratio(truth_total, total),
+            "accuracy": _ratio(confusion[t, t], truth_total),
+            "predicted_as": {predicted_label: _ratio(confusion[t, p], truth_total)
+                             for p, predicted_label in enumerate(EVALUATED_LABELS)},
+        }
+    summary["warnings"] = warnings
+    return summary
+
+
+def _ratio(numerator, denominator):
+    return float(numerator) / denominator if denominator != 0 else None
+
+
+"""
+Evaluates every session, spread over a pool of processes, and pools the
+confusion matrices of the sessions that could be evaluated. Returns a dict
+with the labels, the per-session results and the pooled result.
+Args:
+    sessions (list of dicts): the sessions from read_manifest or find_sessions
+    processes (int): the number of worker processes (default is the number of CPUs)
+"""
+
+
+def evaluate_sessions(sessions, processes=None):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(evaluate_session, sessions))
+
+    pooled_confusion = np.zeros((len(EVALUATED_LABELS), len(EVALUATED_LABELS)), dtype=np.int64)
+    for result in results:
+        if "confusion" in result:
+            pooled_confusion += np.array(result["confusion"], dtype=np.int64)
+    pooled = {"sessions": sum("confusion" in result for result in results),
+              "failed": sum("error" in result for result in results),
+              "length_ms": int(pooled_confusion.sum()),
+              "confusion": pooled_confusion.tolist()}
+    pooled.update(summarize_confusion(pooled_confusion))
+    return {"labels": EVALUATED_LABELS, "sessions": results, "pooled": pooled}
+
+
+"""
+Flattens the result of evaluate_sessions into a table with one row per session
+(and a final "pooled" row), holding the raw confusion counts.
+Args:
+    evaluation (dict): the result of evaluate_sessions
+"""
+
+
+def make_counts_table(evaluation):
+    rows = []
+    for result in evaluation["sessions"] + [dict(evaluation["pooled"], session="pooled")]:
+        row = {"session": result["session"], "length_ms": result.get("length_ms"),
+               "accuracy": result.get("accuracy")}
+        confusion = result.get("confusion")
+        for t, truth_label in enumerate(EVALUATED_LABELS):
+            for p, predicted_label in enumerate(EVALUATED_LABELS):
+                row[truth_label + "_as_" + predicted_label] = confusion[t][p] if confusion else None
+        row["error"] = result.get("error")
+        rows.append(row)
+    table = pd.DataFrame(rows)
+    # failed sessions have no counts, which must not turn the counts into floats
+    counts = [column for column in table.columns if column == "length_ms" or "_as_" in column]
+    return table.astype({column: "Int64" for column in counts})
+
+
+"""
+Takes in a CLI arg (the path to a manifest tsv of sessions, or to a directory
+of sessions) and evaluates every session in parallel. Saves the per-session
+confusion counts and scores and the pooled result as JSON (or the counts as a
+tsv, with --format tsv).
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'sessions_path',
+        type=str,
+        help='The path to a manifest tsv (columns raw_path, truth_path and, optionally, prediction_path, '
+             'ms_per_frame and session), or to a directory with [name].txt, [name]_converted_MOD3.tsv and '
+             'truth tsv files.')
+    argparser.add_argument(
+        '--truth-suffix',
+        type=str,
+        default='_truth.tsv',
+        help='For a directory: the suffix that replaces ".txt" in the truth tsv names. (default is _truth.tsv)')
+    argparser.add_argument(
+        '--ms-per-frame',
+        type=float,
+        default=33.3333,
+        help='For a directory: the length of 1 frame in the videos, in milliseconds. (default is 33.3333 ms)')
+    argparser.add_argument(
+        '--format',
+        choices=['json', 'tsv'],
+        default='json',
+        help='The output format. (default is json)')
+    argparser.add_argument(
+        '--output',
+        type=str,
+        default=None,
+        help='The path to save the output to. (default is [manifest or directory]_evaluation.[format])')
+    argparser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='The number of worker processes. (default is the number of CPUs)')
+    run_metrics.add_arguments(argparser, hot_stage='evaluate')
+    parsed_args = argparser.parse_args(args[1:])
+
+    sessions_path = parsed_args.sessions_path.rstrip(os.sep)
+    if os.path.isdir(sessions_path):
+        sessions = find_sessions(sessions_path, parsed_args.truth_suffix, parsed_args.ms_per_frame)
+        name = sessions_path + "_evaluation." + parsed_args.format
+    elif os.path.isfile(sessions_path):
+        sessions = read_manifest(sessions_path)
+        name = sessions_path[:-4] + "_evaluation." + parsed_args.format
+    else:
+        print("Invalid path to manifest or directory")
+        return
+    if parsed_args.output is not None:
+        name = parsed_args.output
+
+    print("Evaluating", len(sessions), "sessions...")
+    with run_metrics.RunMetrics("evaluate_opengaze_batch", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["sessions_path"] = os.path.abspath(sessions_path)
+        with metrics.stage("evaluate", rows=len(sessions)):
+            evaluation = evaluate_sessions(sessions, parsed_args.processes)
+        metrics.info["failed"] = evaluation["pooled"]["failed"]
+        with metrics.stage("write", rows=len(sessions)):
+            if parsed_args.format == "json":
+                with open(name, "w") as f:
+                    json.dump(evaluation, f, indent=2)
+            else:
+                make_counts_table(evaluation).to_csv(name, index=False, sep="\t")
+
+    for result in evaluation["sessions"]:
+        if "error" in result:
+            print("Failed:", result["session"], "-", result["error"])
+        elif result["warnings"]:
+            print("Warning:", result["session"], "-", "; ".join(result["warnings"]))
+    print("Pooled accuracy:", evaluation["pooled"]["accuracy"])
+    print("Done! Saved to '" + name + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
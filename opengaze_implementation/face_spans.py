@@ -0,0 +1,407 @@
+import argparse
+import functools
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from label_timeline import LabelTimeline
+import run_metrics
+
+"""
+A cheap pre-pass that finds the spans of a video in which a face is visible,
+so the expensive stages can skip the rest: one thread decodes the frames into
+a bounded queue, and a pool of threads runs an OpenCV cascade face detector on
+downscaled grayscale copies of them (OpenCV releases the GIL while it works,
+so the threads run in parallel). The spans are kept as a LabelTimeline with
+the labels "face" and "no_face" (times in milliseconds, ending at the end of
+the video), so they can be saved as a label tsv ([video name]_faces.tsv). A
+cascade misses faces now and then (e.g. in profile), so short gaps are closed
+and every span is padded; a gap is only "no_face" if no face is found for a
+while.
+"""
+
+FACE_LABEL = "face"
+NO_FACE_LABEL = "no_face"
+
+DEFAULT_CASCADE = "haarcascade_frontalface_default.xml"
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 4)
+QUEUE_SIZE = 64
+
+# The default detection settings (see detect_face_spans)
+DEFAULT_DETECTION = {"scale": 0.25, "step": 1, "min_gap_seconds": 1.0, "padding_seconds": 0.5}
+
+# Put on the queue once per worker after the last frame
+_DONE = None
+
+
+"""
+Creates a face detector that takes a downscaled grayscale frame and returns
+whether it contains a face. Each detection thread creates its own, since a
+CascadeClassifier must not be shared between threads.
+Args:
+    cascade_path (string): the path to the cascade xml (default is OpenCV's
+        frontal face cascade, if this OpenCV build bundles it)
+    min_neighbors (int): the detections a face needs to be accepted
+    min_size (int): the smallest face, in pixels of the downscaled frame
+"""
+
+
+def make_cascade_detector(cascade_path=None, min_neighbors=3, min_size=12):
+    if not hasattr(cv2, "CascadeClassifier"):
+        raise RuntimeError("This OpenCV build (" + cv2.__version__ + ") has no CascadeClassifier; install "
+                           "OpenCV 3 or 4 (e.g. pip install \"opencv-python-headless<5\")")
+    if cascade_path is None:
+        if not hasattr(cv2, "data"):
+            raise ValueError("This OpenCV build does not bundle its cascades; pass the path to a face cascade")
+        cascade_path = os.path.join(cv2.data.haarcascades, DEFAULT_CASCADE)
+    cascade = cv2.CascadeClassifier(cascade_path)
+    if cascade.empty():
+        raise ValueError("Could not load the face cascade '" + cascade_path + "'")
+
+    def detect(gray):
+        faces = cascade.detectMultiScale(cv2.equalizeHist(gray), scaleFactor=1.1, minNeighbors=min_neighbors,
+                                         minSize=(min_size, min_size))
+        return len(faces) > 0
+    return detect
+
+
+"""
+Checks that the face cascade can be loaded, so that a script can stop with one
+message before it starts decoding (or a pool of sessions). Returns the reason
+it cannot, or None if it can.
+Args:
+    cascade_path (string): the path to the cascade xml (default is OpenCV's
+        frontal face cascade)
+"""
+
+
+def check_face_detector(cascade_path=None):
+    try:
+        make_cascade_detector(cascade_path)
+    except (RuntimeError, ValueError) as e:
+        return str(e)
+    return None
+
+
+"""
+Decodes a video and runs a face detector on its frames. Returns a boolean
+array with whether each frame has a face, and the frame rate of the video.
+Args:
+    video_path (string): the path to the video
+    scale (float): the factor the frames are downscaled by before detection
+    step (int): detect every step-th frame only; the frames in between take
+        the result of the last detected frame
+    workers (int): the number of detection threads
+    detector_factory (function): creates a detector (see
+        make_cascade_detector, the default); called once per thread
+    queue_size (int): the most decoded frames waiting for detection
+"""
+
+
+def detect_presence(video_path, scale=0.25, step=1, workers=DEFAULT_WORKERS, detector_factory=None,
+                    queue_size=QUEUE_SIZE):
+    if detector_factory is None:
+        detector_factory = make_cascade_detector
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError("Could not open the video '" + video_path + "'")
+    fps = capture.get(cv2.CAP_PROP_FPS)
+
+    frames = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_detect_faces, frames, stop, detector_factory, scale) for _ in range(workers)]
+        try:
+            num_frames = _decode_frames(capture, frames, stop, step)
+        finally:
+            capture.release()
+            for _ in range(workers):
+                _put(frames, _DONE, stop)
+        found = {}
+        for future in futures:
+            found.update(future.result())
+
+    detected = np.array([found[index] for index in range(0, num_frames, step)], dtype=bool)
+    return np.repeat(detected, step)[:num_frames], fps
+
+
+# Decodes the frames into the queue (only every step-th frame is retrieved)
+# until the video ends or a detection thread fails; returns the frame count
+def _decode_frames(capture, frames, stop, step):
+    index = 0
+    while True:
+        if index % step == 0:
+            ok, frame = capture.read()
+            if not ok or not _put(frames, (index, frame), stop):
+                break
+        elif not capture.grab():
+            break
+        index += 1
+    return index
+
+
+def _put(frames, item, stop):
+    while not stop.is_set():
+        try:
+            frames.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _detect_faces(frames, stop, detector_factory, scale):
+    try:
+        detect = detector_factory()
+        found = {}
+        while True:
+            try:
+                item = frames.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return found
+                continue
+            if item is _DONE:
+                return found
+            index, frame = item
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+            found[index] = bool(detect(cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)))
+    except BaseException:
+        stop.set()  # stops the decoding
+        raise
+
+
+"""
+Turns per-frame face presence into spans: gaps shorter than min_gap frames
+between faces are closed, and every span is padded by padding frames on both
+sides. Returns the start and end (exclusive) frame of each span.
+Args:
+    presence (numpy array of bools): whether each frame has a face
+    min_gap (int): the shortest gap that is kept, in frames
+    padding (int): the frames added before and after each span
+"""
+
+
+def find_spans(presence, min_gap, padding):
+    edges = np.diff(np.concatenate(([0], np.asarray(presence, dtype=np.int8), [0])))
+    starts, ends = _merge_spans(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1), min_gap)
+    starts, ends = np.maximum(starts - padding, 0), np.minimum(ends + padding, len(presence))
+    # the padding can make neighbouring spans overlap
+    return _merge_spans(starts, ends, 1)
+
+
+def _merge_spans(starts, ends, min_gap):
+    keep = np.ones(len(starts), dtype=bool)
+    keep[1:] = starts[1:] - ends[:-1] >= min_gap
+    last = np.ones(len(starts), dtype=bool)
+    last[:-1] = keep[1:]
+    return starts[keep], ends[last]
+
+
+"""
+Returns the face spans of a video as a LabelTimeline of "face" and "no_face"
+(times in milliseconds, frame i starting at i * the frame length).
+Args:
+    starts, ends (numpy arrays of ints): the spans, from find_spans
+    num_frames (int): the number of frames of the video
+    frame_length (float): the duration of each frame (in milliseconds)
+"""
+
+
+def spans_to_timeline(starts, ends, num_frames, frame_length):
+    frames = np.stack((starts, ends), axis=1).reshape(-1)
+    labels = np.tile([FACE_LABEL, NO_FACE_LABEL], len(starts))
+    if len(starts) == 0 or starts[0] > 0:
+        frames, labels = np.concatenate(([0], frames)), np.concatenate(([NO_FACE_LABEL], labels))
+    keep = frames < num_frames
+    times = np.rint(frames[keep] * frame_length).astype(np.int64)
+    return LabelTimeline.from_labels(times, labels[keep], end=int(round(num_frames * frame_length)))
+
+
+"""
+Runs the pre-pass on a video and returns its face spans as a LabelTimeline
+(see spans_to_timeline).
+Args:
+    video_path (string): the path to the video
+    scale, step, workers, detector_factory: see detect_presence
+    min_gap_seconds (float): the shortest gap without a face that is kept
+    padding_seconds (float): the time added before and after each span
+    cascade_path, min_neighbors: see make_cascade_detector (used when no
+        detector_factory is given)
+"""
+
+
+def detect_face_spans(video_path, scale=0.25, step=1, min_gap_seconds=1.0, padding_seconds=0.5,
+                      workers=DEFAULT_WORKERS, detector_factory=None, cascade_path=None, min_neighbors=3):
+    if detector_factory is None:
+        detector_factory = functools.partial(make_cascade_detector, cascade_path, min_neighbors)
+    with run_metrics.stage("detect") as stage:
+        presence, fps = detect_presence(video_path, scale, step, workers, detector_factory)
+        stage.rows = len(presence)
+    starts, ends = find_spans(presence, int(round(min_gap_seconds * fps)), int(round(padding_seconds * fps)))
+    return spans_to_timeline(starts, ends, len(presence), 1000.0 / fps)
+
+
+"""
+Returns the fraction of a face timeline's duration that has a face.
+Args:
+    face_spans (LabelTimeline): the face spans
+"""
+
+
+def face_fraction(face_spans):
+    starts, durations, labels = face_spans.segments()
+    total = durations.sum()
+    return float(durations[labels == FACE_LABEL].sum() / total) if total > 0 else 0.0
+
+
+"""
+Returns a boolean array with whether a face is visible at each of the given
+times (a time before the first span counts as no face).
+Args:
+    face_spans (LabelTimeline): the face spans
+    times (numpy array of ints): the times, in milliseconds
+"""
+
+
+def has_face(face_spans, times):
+    if FACE_LABEL not in face_spans.vocabulary:
+        return np.zeros(len(times), dtype=bool)
+    return face_spans.codes_at(times) == face_spans.vocabulary.index(FACE_LABEL)
+
+
+"""
+Writes the frames of a video that have a face to a new (MJPG) video, so the
+gaze extractor only processes those. Returns the index of every written frame
+in the original video, to map the extractor's frame numbers back with
+restore_frame_numbers.
+Args:
+    video_path (string): the path to the video
+    face_spans (LabelTimeline): the face spans of the video
+    save_name (string): the path of the new video (.avi)
+"""
+
+
+def write_face_video(video_path, face_spans, save_name):
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError("Could not open the video '" + video_path + "'")
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    writer = cv2.VideoWriter(save_name, cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+
+    indices = []
+    index = 0
+    try:
+        while True:
+            # frames without a face are skipped without being retrieved
+            if has_face(face_spans, [int(round(index * 1000.0 / fps))])[0]:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                writer.write(frame)
+                indices.append(index)
+            elif not capture.grab():
+                break
+            index += 1
+    finally:
+        capture.release()
+        writer.release()
+    return np.array(indices, dtype=np.int64)
+
+
+"""
+Rewrites the frame numbers (the first column) of an OpenGaze output file
+extracted from a video written by write_face_video, so they number the frames
+of the original video. Lines that do not start with a frame number are copied
+as they are.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    frame_indices (numpy array of ints): the original index of every frame of
+        the extracted video, from write_face_video
+    save_name (string): the path to write the result to
+"""
+
+
+def restore_frame_numbers(path_to_csv, frame_indices, save_name):
+    with open(path_to_csv) as src, open(save_name, "w") as out:
+        for line in src:
+            frame, separator, rest = line.partition(",")
+            if separator and frame.strip().isdigit():
+                line = str(frame_indices[int(frame) - 1] + 1) + separator + rest
+            out.write(line)
+
+
+"""
+Takes in a CLI arg (the path to a gaze video) and saves the spans of the video
+in which a face is visible to [video name]_faces.tsv, a label tsv with the
+labels "face" and "no_face" that convert_opengaze_output.py (--face-spans)
+can use to label the no-face spans "none"
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument('video_path', type=str, help='The path to the gaze video.')
+    argparser.add_argument(
+        '--scale',
+        type=float,
+        default=DEFAULT_DETECTION["scale"],
+        help='The factor the frames are downscaled by before detection. (default is 0.25)')
+    argparser.add_argument(
+        '--step',
+        type=int,
+        default=DEFAULT_DETECTION["step"],
+        help='Only detect faces in every step-th frame. (default is 1)')
+    argparser.add_argument(
+        '--min-gap',
+        type=float,
+        default=DEFAULT_DETECTION["min_gap_seconds"],
+        help='The shortest time without a face that counts as a gap, in seconds. (default is 1)')
+    argparser.add_argument(
+        '--padding',
+        type=float,
+        default=DEFAULT_DETECTION["padding_seconds"],
+        help='The time added before and after each face span, in seconds. (default is 0.5)')
+    argparser.add_argument(
+        '--workers',
+        type=int,
+        default=DEFAULT_WORKERS,
+        help='The number of detection threads. (default is ' + str(DEFAULT_WORKERS) + ')')
+    argparser.add_argument(
+        '--cascade',
+        type=str,
+        default=None,
+        help='The path to the face cascade xml. (default is OpenCV\'s ' + DEFAULT_CASCADE + ')')
+    run_metrics.add_arguments(argparser, hot_stage='detect')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if not os.path.isfile(parsed_args.video_path):
+        print("Invalid path to video")
+        return
+
+    error = check_face_detector(parsed_args.cascade)
+    if error is not None:
+        print("Face detection is not available: " + error)
+        return
+
+    print("Detecting faces...")
+    with run_metrics.RunMetrics("face_spans", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["video_path"] = os.path.abspath(parsed_args.video_path)
+        face_spans = detect_face_spans(parsed_args.video_path, parsed_args.scale, parsed_args.step,
+                                       parsed_args.min_gap, parsed_args.padding, parsed_args.workers,
+                                       cascade_path=parsed_args.cascade)
+        metrics.info["face_fraction"] = face_fraction(face_spans)
+    name = os.path.splitext(parsed_args.video_path)[0] + "_faces.tsv"
+    face_spans.write_tsv(name)
+    print("Face visible in " + "{:.0%}".format(face_fraction(face_spans)) + " of the video")
+    print("Done! Saved to '" + name + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
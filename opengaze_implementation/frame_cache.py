@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+"""
+A cache of parsed OpenGaze output. The columns of an output file are stored
+as .npy files (one per column) in a cache entry, so that later runs can
+memory-map them instead of parsing the text file again. Each entry belongs to
+one source file and records the size and modification time the file had when
+it was parsed; if the file has changed since, the entry is discarded. Columns
+are parsed the first time they are requested and added to the entry. When the
+cache grows beyond its size limit, the least recently used entries are removed.
+"""
+
+# The OpenGaze output columns with known meaning, and their column indices.
+# Other columns can be requested by their index.
+OPENGAZE_COLUMNS = {"frame": 0, "confidence": 2, "gaze_2d_x": 6, "gaze_2d_y": 7}
+DEFAULT_COLUMNS = ["frame", "confidence", "gaze_2d_x", "gaze_2d_y"]
+
+# The cache directory can be set with the GAZE_CODING_CACHE environment variable
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gaze-coding", "opengaze")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+META_FILE = "meta.json"
+
+
+"""
+Returns the given columns of an OpenGaze output file as a dict of read-only,
+memory-mapped numpy arrays, parsing (and caching) only the columns that are
+not cached yet. The frame column is returned as ints, all others as floats.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    columns (list of strings or ints): names from OPENGAZE_COLUMNS, or column
+        indices; a column index is returned under the name "column_<index>"
+    cache_dir (string): the cache directory (default is $GAZE_CODING_CACHE, or
+        ~/.cache/gaze-coding/opengaze)
+    max_bytes (int): the size limit of the cache, in bytes
+"""
+
+
+def load_columns(path_to_csv, columns=DEFAULT_COLUMNS, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    cache_dir = get_cache_dir(cache_dir)
+    names = [column_name(column) for column in columns]
+    entry_dir = os.path.join(cache_dir, _entry_key(path_to_csv))
+
+    stat = os.stat(path_to_csv)
+    meta = _read_meta(entry_dir)
+    if meta is not None and (meta["size"] != stat.st_size or meta["mtime_ns"] != stat.st_mtime_ns):
+        shutil.rmtree(entry_dir, ignore_errors=True)  # the source file has changed
+        meta = None
+    if meta is None:
+        meta = {"source": os.path.abspath(path_to_csv), "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns, "columns": []}
+
+    missing = [name for name in dict.fromkeys(names) if name not in meta["columns"]]
+    if len(missing) > 0:
+        os.makedirs(entry_dir, exist_ok=True)
+        parsed = parse_columns(path_to_csv, missing)
+        for name in missing:
+            _atomic_save(os.path.join(entry_dir, name + ".npy"), parsed[name])
+        meta["columns"] = meta["columns"] + missing
+        meta["num_rows"] = len(parsed[missing[0]])
+        _atomic_write_meta(entry_dir, meta)
+        evict(cache_dir, max_bytes, keep=entry_dir)
+    else:
+        os.utime(os.path.join(entry_dir, META_FILE))  # mark the entry as recently used
+
+    return {name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r") for name in names}
+
+
+"""
+Parses the given columns of an OpenGaze output file, without using the cache.
+Returns a dict of numpy arrays.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    columns (list of strings or ints): see load_columns
+"""
+
+
+def parse_columns(path_to_csv, columns=DEFAULT_COLUMNS):
+    names = [column_name(column) for column in columns]
+    indices = sorted(set(column_index(name) for name in names))
+    dtype = [(column_name(index), np.int64 if index == OPENGAZE_COLUMNS["frame"] else np.float64)
+             for index in indices]
+    data = np.loadtxt(path_to_csv, delimiter=",", usecols=indices, dtype=dtype, ndmin=1)
+    return {name: np.ascontiguousarray(data[column_name(column_index(name))]) for name in names}
+
+
+"""
+Returns the name a column is cached under.
+Args:
+    column (string or int): a name from OPENGAZE_COLUMNS, or a column index
+"""
+
+
+def column_name(column):
+    if isinstance(column, str):
+        column_index(column)  # check that the name is valid
+        return column
+    for name, index in OPENGAZE_COLUMNS.items():
+        if index == column:
+            return name
+    return "column_" + str(column)
+
+
+"""
+Returns the index in the OpenGaze output of a cached column.
+Args:
+    name (string): a name from OPENGAZE_COLUMNS, or "column_<index>"
+"""
+
+
+def column_index(name):
+    if name in OPENGAZE_COLUMNS:
+        return OPENGAZE_COLUMNS[name]
+    if name.startswith("column_") and name[len("column_"):].isdigit():
+        return int(name[len("column_"):])
+    raise ValueError("Unknown OpenGaze column: " + name)
+
+
+"""
+Removes the least recently used cache entries until the cache is no larger
+than max_bytes.
+Args:
+    cache_dir (string): the cache directory
+    max_bytes (int): the size limit of the cache, in bytes
+    keep (string): the path of an entry that must not be removed
+"""
+
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES, keep=None):
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, key)
+        try:
+            last_used = os.stat(os.path.join(entry_dir, META_FILE)).st_mtime
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+        except OSError:
+            continue  # not a (complete) cache entry
+        entries.append((last_used, size, entry_dir))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.samefile(entry_dir, keep):
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+
+
+"""
+Removes every entry from the cache.
+Args:
+    cache_dir (string): the cache directory (default is $GAZE_CODING_CACHE, or
+        ~/.cache/gaze-coding/opengaze)
+"""
+
+
+def clear_cache(cache_dir=None):
+    shutil.rmtree(get_cache_dir(cache_dir), ignore_errors=True)
+
+
+def get_cache_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get("GAZE_CODING_CACHE", DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _entry_key(path_to_csv):
+    return hashlib.sha1(os.path.abspath(path_to_csv).encode("utf-8")).hexdigest()
+
+
+def _read_meta(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _atomic_write_meta(entry_dir, meta):
+    tmp_path = os.path.join(entry_dir, META_FILE + ".tmp" + str(os.getpid()))
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(entry_dir, META_FILE))
+
+
+def _atomic_save(path, array):
+    tmp_path = path + ".tmp" + str(os.getpid()) + ".npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
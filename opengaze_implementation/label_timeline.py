@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+"""
+A sequence of labels over time, as stored in the label tsv format
+(Time/Duration/Trackname/Comments, one row per label change). The change
+times are kept in an int64 array and the labels as int8 codes into a small
+vocabulary, so a timeline with hundreds of thousands of changes takes a few
+megabytes and every lookup is a binary search. A final "end" row is not a
+label change; its time is kept as the end of the timeline.
+Args:
+    times (numpy array of ints): the sorted times at which the label changes
+    codes (numpy array of ints): the labels they change to, as indices into
+        vocabulary
+    vocabulary (list of strings): the label names
+    end (int): the time at which the last label ends (default is none)
+"""
+
+END_LABEL = "end"
+MAX_LABELS = np.iinfo(np.int8).max
+
+
+class LabelTimeline:
+
+    __slots__ = ("times", "codes", "vocabulary", "end")
+
+    def __init__(self, times, codes, vocabulary, end=None):
+        if len(vocabulary) > MAX_LABELS:
+            raise ValueError("A timeline can have at most " + str(MAX_LABELS) + " labels")
+        self.times = np.asarray(times, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.int8)
+        if len(self.times) != len(self.codes):
+            raise ValueError("There should be one label code per change time")
+        self.vocabulary = tuple(str(label) for label in vocabulary)
+        self.end = None if end is None else int(end)
+
+    """
+    Creates a timeline from change times and label names. The changes are
+    sorted by time, keeping the given order for equal times.
+    Args:
+        times (list or numpy array of ints): the times at which the label changes
+        labels (list or numpy array of strings): the labels they change to
+        end (int): the time at which the last label ends (default is none)
+    """
+
+    @classmethod
+    def from_labels(cls, times, labels, end=None):
+        times = np.asarray(times, dtype=np.int64)
+        vocabulary, codes = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+        order = np.argsort(times, kind="stable")
+        return cls(times[order], codes.reshape(-1)[order], vocabulary.tolist(), end)
+
+    """
+    Reads a label tsv. Only the Time and Trackname columns are used; labels are
+    stripped of surrounding whitespace. If the last row is labeled "end", its
+    time becomes the end of the timeline.
+    Args:
+        path (string): the path to the label tsv
+        delimiter (string): the delimiter used in the file; default = "\\t"
+        time_scale (float): the factor that converts the times in the file to
+            the timeline's integer units (e.g. 1000 for a file in seconds, to
+            get milliseconds); default = 1
+    """
+
+    @classmethod
+    def read_tsv(cls, path, delimiter="\t", time_scale=1):
+        data = pd.read_csv(path, sep=delimiter, usecols=[0, 2], keep_default_na=False)
+        times = np.round(data.iloc[:, 0].to_numpy(dtype=np.float64) * time_scale).astype(np.int64)
+        labels = data.iloc[:, 1].astype(str).str.strip().to_numpy()
+
+        end = None
+        if len(labels) > 0 and labels[-1] == END_LABEL:
+            end = times[-1]
+            times, labels = times[:-1], labels[:-1]
+        return cls.from_labels(times, labels, end)
+
+    """
+    Writes the timeline as a label tsv, with an "end" row if the timeline has
+    an end.
+    Args:
+        path (string): the path to write to
+        delimiter (string): the delimiter to use; default = "\\t"
+        time_scale (float): the factor the times were scaled by when the file
+            was read (the written times are divided by it); default = 1
+        comment (string): the value of the Comments column; default = "(null)"
+    """
+
+    def write_tsv(self, path, delimiter="\t", time_scale=1, comment="(null)"):
+        times = self.times if self.end is None else np.append(self.times, self.end)
+        labels = self.labels if self.end is None else np.append(self.labels, END_LABEL)
+        if time_scale != 1:
+            times = times / time_scale
+        df = pd.DataFrame({"Time": times, "Duration": 0, "Trackname": labels, "Comments": comment})
+        df.to_csv(path, index=False, sep=delimiter)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return "LabelTimeline({0} changes, labels={1}, end={2})".format(len(self), list(self.vocabulary), self.end)
+
+    @property
+    def labels(self):
+        return np.asarray(self.vocabulary, dtype=str)[self.codes] if len(self.vocabulary) > 0 \
+            else np.zeros(0, dtype=str)
+
+    """
+    Returns the code of the label active at each of the given times (the last
+    change at or before it), or -1 for times before the first change.
+    Args:
+        times (int, float or numpy array): the query times
+    """
+
+    def codes_at(self, times):
+        indices = np.searchsorted(self.times, times, side="right") - 1
+        return np.where(indices >= 0, self.codes[np.maximum(indices, 0)] if len(self.codes) > 0 else -1,
+                        -1).astype(np.int8)
+
+    """
+    Returns the label active at a time, or at each of an array of times.
+    Args:
+        times (int, float or numpy array): the query times
+        default (string): the label before the first change (default is none)
+    """
+
+    def label_at(self, times, default=None):
+        codes = self.codes_at(times)
+        # code -1 picks the default, which is appended after the vocabulary
+        labels = np.asarray(list(self.vocabulary) + [default], dtype=object)[codes]
+        return labels
+
+    """
+    Returns the segments of the timeline as three numpy arrays: the start time
+    of each segment, its duration, and its label. Each change lasts until the
+    next one; the last change lasts until the end of the timeline, and is left
+    out if the timeline has no end.
+    """
+
+    def segments(self):
+        boundaries = self.times if self.end is None else np.append(self.times, self.end)
+        num_segments = max(len(boundaries) - 1, 0)
+        return boundaries[:num_segments], np.diff(boundaries), self.labels[:num_segments]
+
+    """
+    Returns the part of the timeline in [start, stop): the label active at
+    start (if any) becomes a change at start, and stop becomes the end.
+    Args:
+        start (int): the start of the range
+        stop (int): the end of the range
+    """
+
+    def slice(self, start, stop):
+        first = np.searchsorted(self.times, start, side="right")
+        last = np.searchsorted(self.times, stop, side="left")
+        times, codes = self.times[first:last], self.codes[first:last]
+        if first > 0:
+            times = np.concatenate(([start], times))
+            codes = np.concatenate((self.codes[first - 1:first], codes))
+        return LabelTimeline(times, codes, self.vocabulary, stop)
+
+    """
+    Returns the code of the label active at each frame of a regular frame grid
+    (see codes_at), frame i being at offset + i * frame_length.
+    Args:
+        frame_length (float): the time between frames
+        num_frames (int): the number of frames (default is every frame before
+            the end of the timeline or, without an end, up to its last change)
+        offset (float): the time of the first frame; default = 0
+    """
+
+    def resample(self, frame_length, num_frames=None, offset=0):
+        if num_frames is None and self.end is not None:
+            num_frames = max(int(np.ceil((self.end - offset) / frame_length)), 0)
+        elif num_frames is None:
+            last = self.times[-1] if len(self.times) > 0 else offset - frame_length
+            num_frames = max(int(np.floor((last - offset) / frame_length)) + 1, 0)
+        return self.codes_at(offset + np.arange(num_frames) * frame_length)
+
+    """
+    Returns a timeline with the labels renamed.
+    Args:
+        mapping (dict): the new name of each label
+        default (string): the name of the labels that are not in mapping
+            (default is to keep their names)
+    """
+
+    def remap(self, mapping, default=None):
+        names = [mapping.get(label, label if default is None else default) for label in self.vocabulary]
+        vocabulary, new_codes = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        return LabelTimeline(self.times, new_codes.reshape(-1)[self.codes] if len(self.codes) > 0 else self.codes,
+                             vocabulary.tolist(), self.end)
+
+    """
+    Returns a timeline without the changes to the label that is already
+    active (e.g. after remap has merged labels).
+    """
+
+    def drop_repeats(self):
+        keep = np.ones(len(self.codes), dtype=bool)
+        keep[1:] = self.codes[1:] != self.codes[:-1]
+        return LabelTimeline(self.times[keep], self.codes[keep], self.vocabulary, self.end)
@@ -3,13 +3,16 @@ Created on Wed May 20 14:56:33 2020
 
 @author: mayan and kjin
 """
+import argparse
 import numpy as np
 import pandas as pd
 import sys
 import os
-import matplotlib.pyplot as plt
-from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
-                               AutoMinorLocator)
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.ticker import (MultipleLocator, AutoMinorLocator)
+
+from label_timeline import LabelTimeline
+import run_metrics
 
 """
 Takes in a path to a csv and returns 3 lists: one containing the durations of 
@@ -23,40 +26,84 @@ Args:
 
 
 def get_intervals(path_to_csv, delimiter="\t"):
+    starts, durations, labels = get_segments(path_to_csv, delimiter)
+    return durations.tolist(), labels.tolist(), starts.tolist()
+
+
+"""
+Takes in a path to a csv and returns 3 numpy arrays with the same segments as
+get_intervals: the start times of the segments, their durations, and their
+labels
+
+Args:
+    csv (string): path to csv file containing label data
+    delimiter (string): the delimiter used in the csv file; default = "\t"
+"""
+
 
-    f = open(path_to_csv)
-    lines = f.readlines()
-    f.close()
+def get_segments(path_to_csv, delimiter="\t"):
+    # each label lasts from its time until the next label's time (or the end)
+    return LabelTimeline.read_tsv(path_to_csv, delimiter).segments()
 
-    interval_list = []
-    label_list = []
-    starts = []
 
-    prev_timestamp = 0
-    for i in range(1, len(lines)):
+# the colors of the label tracks, and of the disagreement track
+LABEL_COLORS = {'left': (0.5, 0.6, 0.9), 'right': (0.6, 0.8, 0), 'away': (0.95, 0.5, 0.4)}
+DISAGREEMENT_COLOR = (0.2, 0.2, 0.2)
+
+"""
+Finds where two label tracks disagree, by merging their segments: the
+boundaries of both tracks split time into intervals that each have a single
+label in each track. Only the time covered by both tracks is compared, and
+the labels are compared the way evaluate_opengaze_accuracy scores them: every
+label that isn't "left" or "right" counts as "away" (e.g. "none" and "away"
+agree). Returns the start times and durations of the intervals where the labels differ
+(with adjacent intervals merged).
+
+Args:
+    truth (tuple of numpy arrays): the starts, durations and labels of the
+        first track, as returned by get_segments
+    prediction (tuple of numpy arrays): the same for the second track
+"""
 
-        line = lines[i]
-        line_list = line.strip().split(delimiter)
-        timestamp = int(line_list[0])
-        label = line_list[2].strip()
 
-        interval = timestamp - prev_timestamp
-        interval_list.append(interval)
-        label_list.append(label)
-        starts.append(prev_timestamp)
+def find_disagreements(truth, prediction):
+    (truth_starts, truth_durations, truth_labels) = truth
+    (prediction_starts, prediction_durations, prediction_labels) = prediction
+    if len(truth_starts) == 0 or len(prediction_starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-        prev_timestamp = timestamp
+    begin = max(truth_starts[0], prediction_starts[0])
+    end = min(truth_starts[-1] + truth_durations[-1], prediction_starts[-1] + prediction_durations[-1])
+    boundaries = np.union1d(truth_starts, prediction_starts)
+    if end <= begin:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    boundaries = np.concatenate(([begin], boundaries[(boundaries > begin) & (boundaries < end)], [end]))
 
-    return interval_list[1:], label_list[:-1], starts[1:]
+    # the label of each track at the start of each interval
+    starts = boundaries[:-1]
+    truth_at = truth_labels[np.searchsorted(truth_starts, starts, side='right') - 1]
+    prediction_at = prediction_labels[np.searchsorted(prediction_starts, starts, side='right') - 1]
+    differs = _evaluated_labels(truth_at) != _evaluated_labels(prediction_at)
+
+    # merges runs of disagreeing intervals
+    edges = np.diff(np.concatenate(([False], differs, [False])).astype(np.int8))
+    run_starts = boundaries[:-1][edges[:-1] == 1]
+    run_ends = boundaries[1:][edges[1:] == -1]
+    return run_starts, run_ends - run_starts
+
+
+def _evaluated_labels(labels):
+    return np.where(np.isin(labels, ["left", "right"]), labels, "away")
 
 
 """
 Takes in a path to a csv and creates a plot of the interval durations for the 
-contained label data
+contained label data, as a row of the axis named name (so that calls with
+different names stack). Each label is drawn with a single barh call.
 
 Args:
     csv (string): path to csv file containing label data
-    fig (matplotlib.axis.Axis): the axis to add the plot to
+    ax (matplotlib.axes.Axes): the axis to add the plot to
     name (str): the title of the plot
     delim (string): the delimiter used in the csv file; default = "\t"
 
@@ -64,71 +111,249 @@ Args:
 
 
 def make_visualization(csv, ax, name, delim="\t"):
-    durations, labels, times = get_intervals(csv, delim)
-
-    # split the data into left, right, and neither
-    left_durations = []
-    left_starts = []
-    right_durations = []
-    right_starts = []
-    away_durations = []
-    away_starts = []
-    for i in range(len(durations)):
-        if labels[i] == 'left':
-            left_durations.append(durations[i])
-            left_starts.append(times[i])
-        elif labels[i] == 'right':
-            right_durations.append(durations[i])
-            right_starts.append(times[i])
-        elif labels[i] == 'away':
-            away_durations.append(durations[i])
-            away_starts.append(times[i])
-
-    # plot each of the left, right, and neither data onto the same horizontal figure
-    ax.barh(name, left_durations, left=left_starts, height=1, label='left', color=(0.5, 0.6, 0.9))
-    ax.barh(name, right_durations, left=right_starts, height=1, label='right', color=(0.6, 0.8, 0))
-    ax.barh(name, away_durations, left=away_starts, height=1, label='away', color=(0.95, 0.5, 0.4))
+    starts, durations, labels = get_segments(csv, delim)
+    for label, color in LABEL_COLORS.items():
+        selected = labels == label
+        ax.barh(name, durations[selected], left=starts[selected], height=1, label=label, color=color)
+
+
+"""
+Draws one track of labeled segments, with a single broken_barh per label
+(rather than one bar per segment)
+
+Args:
+    ax (matplotlib.axes.Axes): the axis to add the track to
+    y (int): the row of the track on the y axis
+    starts, durations, labels (numpy arrays): the segments, as returned by
+        get_segments
+    colors (dict): the color of each label to draw; other labels are skipped
+"""
+
+
+def draw_track(ax, y, starts, durations, labels, colors=LABEL_COLORS):
+    for label, color in colors.items():
+        selected = labels == label
+        ax.broken_barh(np.column_stack((starts[selected], durations[selected])), (y - 0.5, 1),
+                       facecolors=color, label=label)
+
+
+"""
+Creates the comparison figure of one session: the truth track, the prediction
+track and, optionally, a track of the times where they disagree. The figure
+is created without pyplot, so that many can be rendered at once.
+
+Args:
+    original_csv (string): path to the truth label tsv
+    opengaze_csv (string): path to the OpenGaze label tsv
+    title (string): the title of the figure (default is none)
+    disagreement (bool): whether to add the disagreement track
+"""
+
+
+def make_comparison_figure(original_csv, opengaze_csv, title=None, disagreement=False):
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Patch
+
+    truth = get_segments(original_csv)
+    prediction = get_segments(opengaze_csv)
+
+    fig = Figure(figsize=(30, 8))
+    ax = fig.add_subplot(1, 1, 1)
+    track_names = ["Original Data", "OpenGaze Data"]
+    draw_track(ax, 0, *truth)
+    draw_track(ax, 1, *prediction)
+    handles = [Patch(color=color, label=label) for label, color in LABEL_COLORS.items()]
+    if disagreement:
+        starts, durations = find_disagreements(truth, prediction)
+        track_names.append("Disagreement")
+        draw_track(ax, 2, starts, durations, np.full(len(starts), "disagreement"),
+                   colors={"disagreement": DISAGREEMENT_COLOR})
+        handles.append(Patch(color=DISAGREEMENT_COLOR, label="disagreement"))
+    ax.set_yticks(range(len(track_names)))
+    ax.set_yticklabels(track_names)
+    ax.set_ylim(len(track_names) - 0.5, -0.5)  # the first track is at the top
+    ax.legend(handles=handles, loc='upper right')
+    ax.set_xlabel("Time (ms)")
+    # a major tick every 10 seconds, or, for sessions over about 8 minutes, at
+    # most 50 major ticks (thousands of ticks take longer to draw than the bars)
+    end = max([track[0][-1] + track[1][-1] for track in (truth, prediction) if len(track[0])] + [1])
+    ax.xaxis.set_major_locator(MultipleLocator(10000 * int(np.ceil(end / 500000))))
+    ax.xaxis.set_minor_locator(AutoMinorLocator(10))
+    ax.tick_params(which='minor', length=2)
+    ax.tick_params(axis='x', labelrotation=45)
+    if title is not None:
+        ax.set_title(title)
+    return fig
+
+
+"""
+Renders the comparison figure of one session to an image file.
+
+Args:
+    session (dict): the truth_path, prediction_path, session name and
+        output_path of the session
+    disagreement (bool): whether to add the disagreement track
+"""
+
+
+def render_session(session, disagreement=False):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with run_metrics.stage("figure"):
+        fig = make_comparison_figure(session["truth_path"], session["prediction_path"], session.get("session"),
+                                     disagreement)
+    with run_metrics.stage("save"):
+        FigureCanvasAgg(fig)
+        fig.savefig(session["output_path"])
+    return session["output_path"]
+
+
+def _render_session_star(args):
+    return render_session(*args)
+
+
+"""
+Renders the comparison figures of many sessions to image files in parallel,
+across a pool of processes. Returns the paths of the images.
+
+Args:
+    sessions (list of dicts): see render_session
+    disagreement (bool): whether to add the disagreement tracks
+    processes (int): the number of worker processes (default is the number of CPUs)
+"""
+
+
+def render_sessions(sessions, disagreement=False, processes=None):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_render_session_star, [(session, disagreement) for session in sessions]))
+
+
+"""
+Renders the comparison figures of many sessions into one multi-page PDF, one
+page per session.
+
+Args:
+    sessions (list of dicts): see render_session (output_path is not used)
+    pdf_path (string): the path of the PDF
+    disagreement (bool): whether to add the disagreement tracks
+"""
+
+
+def render_pdf(sessions, pdf_path, disagreement=False):
+    from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
+
+    with PdfPages(pdf_path) as pdf:
+        for session in sessions:
+            fig = make_comparison_figure(session["truth_path"], session["prediction_path"],
+                                         session.get("session"), disagreement)
+            FigureCanvasPdf(fig)
+            pdf.savefig(fig)
+
+
+"""
+Reads a manifest of sessions to render: a tsv with the columns truth_path and
+prediction_path and, optionally, session (default: the name of the prediction
+file). Relative paths are relative to the manifest. Each image is saved next
+to its prediction tsv, as [name]_visualization.png.
+
+Args:
+    manifest_path (string): the path to the manifest tsv
+"""
+
+
+def read_sessions(manifest_path):
+    manifest = pd.read_csv(manifest_path, sep="\t")
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    sessions = []
+    for row in manifest.to_dict("records"):
+        prediction_path = os.path.join(directory, row["prediction_path"])
+        sessions.append({
+            "session": str(row.get("session", os.path.splitext(os.path.basename(prediction_path))[0])),
+            "truth_path": os.path.join(directory, row["truth_path"]),
+            "prediction_path": prediction_path,
+            "output_path": prediction_path[:-4] + "_visualization.png",
+        })
+    return sessions
 
 
 """
 Takes in CLI arguments (the path to the truth label tsv, and the path to the 
 processed OpenGaze output label tsv) and creates the plot and saves it locally to
-"<OpenGaze_tsv_name>_visualization.png"
+"<OpenGaze_tsv_name>_visualization.png". With --manifest, renders every session
+in a manifest instead (in parallel), or, with --pdf, one page per session in a
+single PDF.
 """
 
 
 def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument('original_csv', type=str, nargs='?', help='The path to the truth label tsv.')
+    argparser.add_argument('opengaze_csv', type=str, nargs='?', help='The path to the OpenGaze label tsv.')
+    argparser.add_argument(
+        '--manifest',
+        type=str,
+        default=None,
+        help='The path to a tsv with the columns truth_path, prediction_path and, optionally, session.')
+    argparser.add_argument(
+        '--pdf',
+        type=str,
+        default=None,
+        help='With --manifest: the path of a PDF to render every session into, one page each.')
+    argparser.add_argument(
+        '--disagreement',
+        action='store_true',
+        help='Add a track showing where the two label tsvs disagree.')
+    argparser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='With --manifest: the number of worker processes. (default is the number of CPUs)')
+    run_metrics.add_arguments(argparser, hot_stage='render')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if parsed_args.manifest is not None:
+        if not os.path.isfile(parsed_args.manifest):
+            print("Invalid path to manifest")
+            return
+        sessions = read_sessions(parsed_args.manifest)
+        print("Creating Visualizations...")
+        with run_metrics.RunMetrics("make_visualized_comparison", parsed_args.metrics,
+                                    parsed_args.profile) as metrics:
+            metrics.info["manifest"] = os.path.abspath(parsed_args.manifest)
+            with metrics.stage("render", rows=len(sessions)):
+                if parsed_args.pdf is not None:
+                    render_pdf(sessions, parsed_args.pdf, parsed_args.disagreement)
+                else:
+                    render_sessions(sessions, parsed_args.disagreement, parsed_args.processes)
+        if parsed_args.pdf is not None:
+            print("Done! Saved to '" + parsed_args.pdf + "'")
+        else:
+            print("Done! Saved", len(sessions), "visualizations next to the OpenGaze label tsvs")
+        return
+
     # first arg should be path to truth csv, second should be path to opengaze csv
-    if len(args) < 3:
+    if parsed_args.opengaze_csv is None:
         print("Not enough arguments")
         return
-    else:
-        original_csv = args[1]
-        opengaze_csv = args[2]
+    original_csv = parsed_args.original_csv
+    opengaze_csv = parsed_args.opengaze_csv
 
-        if not os.path.isfile(original_csv):
-            print("Invalid path to truth labels")
-            return
+    if not os.path.isfile(original_csv):
+        print("Invalid path to truth labels")
+        return
 
-        if not os.path.isfile(opengaze_csv):
-            print("Invalid path to OpenGaze labels")
-            return
+    if not os.path.isfile(opengaze_csv):
+        print("Invalid path to OpenGaze labels")
+        return
 
-        print("Creating Visualization...")
-        fig = plt.figure(figsize=(30, 8))
-        ax = fig.add_subplot(1, 1, 1)
-        ax.invert_yaxis()
-        make_visualization(original_csv, ax, "Original Data")
-        make_visualization(opengaze_csv, ax, "OpenGaze Data")
-        ax.legend(loc='upper right')
-        ax.set_xlabel("Time (ms)")
-        ax.xaxis.set_major_locator(MultipleLocator(10000))
-        ax.xaxis.set_minor_locator(AutoMinorLocator(10))
-        ax.tick_params(which='minor', length=2)
-        ax.tick_params(axis='x', labelrotation=45)
-        name = opengaze_csv[:-4] + "_visualization.png"
-        fig.savefig(name)
-        print("Done! Saved to '" + name + "'")
+    print("Creating Visualization...")
+    name = opengaze_csv[:-4] + "_visualization.png"
+    with run_metrics.RunMetrics("make_visualized_comparison", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["prediction_path"] = os.path.abspath(opengaze_csv)
+        with metrics.stage("render", rows=1):
+            render_session({"truth_path": original_csv, "prediction_path": opengaze_csv, "output_path": name},
+                           parsed_args.disagreement)
+    print("Done! Saved to '" + name + "'")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import platform
+import pstats
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+"""
+Run metrics shared by the command line scripts. A RunMetrics records the wall
+time, the number of rows processed, the throughput and the growth of the peak
+resident memory (RSS) of each named stage of a run, with the peak RSS of the
+whole run, and appends them as one JSON lines record per run to a metrics
+file, so the cost of the pipeline can be tracked per session. Functions mark
+their stages with stage(), which records into the active run and does nothing
+outside of one (e.g. in worker processes). With a profile stage, that stage
+(every time it runs) is run under cProfile.
+"""
+
+# The metrics file can be set with the GAZE_CODING_METRICS environment variable
+DEFAULT_METRICS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gaze-coding", "metrics.jsonl")
+
+# The number of functions printed from a profile
+PROFILE_LINES = 25
+
+# The runs that are active, innermost last
+_active_runs = []
+
+
+"""
+Adds the --metrics and --profile options to a script's argument parser.
+Args:
+    argparser (ArgumentParser): the argument parser of the script
+    hot_stage (string): the stage that --profile profiles when no stage is
+        given
+"""
+
+
+def add_arguments(argparser, hot_stage):
+    argparser.add_argument(
+        '--metrics',
+        type=str,
+        default=None,
+        help='The JSON lines file the run metrics are appended to. '
+             '(default is $GAZE_CODING_METRICS, or ~/.cache/gaze-coding/metrics.jsonl)')
+    argparser.add_argument(
+        '--profile',
+        type=str,
+        nargs='?',
+        const=hot_stage,
+        default=None,
+        metavar='STAGE',
+        help='Profile a stage with cProfile, saving the profile to [script]_[stage].prof and printing the '
+             'most expensive functions. (default stage is ' + hot_stage + ')')
+
+
+"""
+Returns the peak resident memory of this process so far, in megabytes, or
+None where it is not available.
+Args:
+    children (bool): whether to return the peak of the largest finished child
+        process (e.g. a pool worker) instead
+"""
+
+
+def get_peak_rss(children=False):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+"""
+The measurements of one stage. The rows can be set while the stage runs
+(e.g. once a file has been parsed). The operating system only keeps the peak
+RSS of the whole process, so a stage records how far it raised that peak (0
+for a stage that stayed below the peak of the stages before it), rather than
+its own peak.
+Args:
+    name (string): the name of the stage, prefixed by the names of the stages
+        it is nested in (e.g. "convert/parse")
+    rows (int): the number of rows the stage processes (default is none)
+"""
+
+
+class Stage:
+
+    __slots__ = ("name", "rows", "seconds", "peak_rss_growth_mb")
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.seconds = None
+        self.peak_rss_growth_mb = None
+
+    def to_dict(self):
+        throughput = None
+        if self.rows is not None and self.seconds:
+            throughput = self.rows / self.seconds
+        return {"name": self.name, "seconds": self.seconds, "rows": self.rows, "rows_per_second": throughput,
+                "peak_rss_growth_mb": self.peak_rss_growth_mb}
+
+
+"""
+Records the stages of one run of a script, as a context manager: the record
+is appended to the metrics file when the run ends, with the status "error"
+(and the error) if it ends with an exception.
+Args:
+    command (string): the name of the script
+    metrics_path (string): the JSON lines file to append the record to
+        (default is $GAZE_CODING_METRICS, or ~/.cache/gaze-coding/metrics.jsonl)
+    profile (string): the name of the stage to profile (default is none); the
+        full name of a nested stage or its own name both match
+"""
+
+
+class RunMetrics:
+
+    def __init__(self, command, metrics_path=None, profile=None):
+        self.command = command
+        self.metrics_path = metrics_path or os.environ.get("GAZE_CODING_METRICS", DEFAULT_METRICS_PATH)
+        self.profile = profile
+        self.profile_path = None
+        self.stages = []
+        self.info = {}
+        self._names = []
+        self._profiler = None
+        self._profiling = False
+        self._start = None
+        self._start_time = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._start_time = datetime.datetime.now().isoformat(timespec="seconds")
+        _active_runs.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_runs.remove(self)
+        if self._profiler is not None:
+            self._save_profile()
+        elif self.profile is not None:
+            print("No stage named '" + self.profile + "' ran; the stages were: " +
+                  ", ".join(stage.name for stage in self.stages), file=sys.stderr)
+        record = self.to_dict(time.perf_counter() - self._start)
+        if exc_type is not None:
+            record["status"] = "error"
+            record["error"] = exc_type.__name__ + ": " + str(exc_value)
+        self.write(record)
+        return False
+
+    """
+    Records a stage, as a context manager that yields its Stage.
+    Args:
+        name (string): the name of the stage
+        rows (int): the number of rows the stage processes (default is none)
+    """
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        self._names.append(name)
+        stage = Stage("/".join(self._names), rows)
+        # a stage nested in a profiled stage is already being profiled
+        profiling = self.profile in (name, stage.name) and not self._profiling
+        if profiling:
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiling = True
+        start = time.perf_counter()
+        start_peak_rss = get_peak_rss()
+        try:
+            if profiling:
+                self._profiler.enable()
+            yield stage
+        finally:
+            if profiling:
+                self._profiler.disable()
+                self._profiling = False
+            stage.seconds = time.perf_counter() - start
+            if start_peak_rss is not None:
+                stage.peak_rss_growth_mb = get_peak_rss() - start_peak_rss
+            self._names.pop()
+            self.stages.append(stage)
+
+    def _save_profile(self):
+        self.profile_path = self.command + "_" + self.profile.replace("/", "_") + ".prof"
+        self._profiler.dump_stats(self.profile_path)
+        print("Profile of stage '" + self.profile + "' saved to '" + self.profile_path + "'", file=sys.stderr)
+        pstats.Stats(self._profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(PROFILE_LINES)
+
+    def to_dict(self, seconds):
+        return {"command": self.command, "argv": sys.argv, "host": platform.node(), "pid": os.getpid(),
+                "start": self._start_time, "seconds": seconds, "status": "ok",
+                "peak_rss_mb": get_peak_rss(), "children_peak_rss_mb": get_peak_rss(children=True),
+                "stages": [stage.to_dict() for stage in self.stages], "info": self.info,
+                "profile": self.profile_path}
+
+    """
+    Appends a record to the metrics file. A run whose metrics cannot be
+    written is not failed because of it.
+    Args:
+        record (dict): the record from to_dict
+    """
+
+    def write(self, record):
+        try:
+            directory = os.path.dirname(os.path.abspath(self.metrics_path))
+            os.makedirs(directory, exist_ok=True)
+            # one write per record, so records of concurrent runs do not interleave
+            with open(self.metrics_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as error:
+            print("Could not write the run metrics to '" + self.metrics_path + "': " + str(error),
+                  file=sys.stderr)
+
+
+"""
+Records a stage into the innermost active run, as a context manager that
+yields its Stage; outside of a run, the Stage is yielded but not recorded.
+Args:
+    name (string): the name of the stage
+    rows (int): the number of rows the stage processes (default is none)
+"""
+
+
+def stage(name, rows=None):
+    if len(_active_runs) == 0:
+        return contextlib.nullcontext(Stage(name, rows))
+    return _active_runs[-1].stage(name, rows)
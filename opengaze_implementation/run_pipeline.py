@@ -0,0 +1,481 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from convert_opengaze_output import DEFAULT_PARAMETERS, convert_csv_file, get_parameters, get_vid_info
+from evaluate_opengaze_accuracy import calculate_accuracies
+from evaluate_opengaze_batch import evaluate_session
+from face_spans import (DEFAULT_DETECTION, check_face_detector, detect_face_spans, face_fraction,
+                        restore_frame_numbers, write_face_video)
+from label_timeline import LabelTimeline
+from make_visualized_comparison import render_session
+import run_metrics
+
+"""
+Runs the OpenGaze path (optional face detection and extraction, video info,
+conversion, evaluation and visualization) for many sessions, as a graph of
+stages:
+
+    video --> faces --> extract --> raw output --.
+      |         '------------------------------- convert --> evaluate
+      '-----> info (ms per frame, duration) -----'  truth --'--> visualize
+
+With face gating, the faces stage finds the spans of the video with a face
+(see face_spans.py); the extraction then only processes those frames, and the
+conversion labels the rest none.
+
+Every stage result is stored in a content-addressed store: its key is a hash
+of the stage name and version, the hashes of its input files and its
+parameters, and a stage whose key is already in the store is not run again.
+The keys of later stages use the hashes of the files earlier stages produced,
+so changing a heuristic parameter reruns the conversion and then only the
+stages whose input actually changed. Sessions run in parallel in a pool of
+processes.
+"""
+
+# Bump a stage's version when its code changes, so that its stored results are
+# not reused
+STAGE_VERSIONS = {"faces": 1, "extract": 1, "info": 1, "convert": 1, "evaluate": 1, "visualize": 1}
+
+META_FILE = "meta.json"
+DIGESTS_DIR = "digests"
+OBJECTS_DIR = "objects"
+
+# The file name of each stage output, and the suffix it gets when exported next
+# to the session's other outputs
+EXPORTS = {"faces": ("faces.tsv", "_faces.tsv"),
+           "convert": ("converted.tsv", "_converted_MOD3.tsv"),
+           "evaluate": ("accuracy.tsv", "_accuracy.tsv"),
+           "visualize": ("visualization.png", "_visualization.png")}
+
+
+"""
+Returns the SHA-1 hash of a file's contents. Hashes are remembered in the
+store together with the file's size and modification time, so an unchanged
+file (e.g. a multi-gigabyte video) is only read once.
+Args:
+    path (string): the path to the file
+    store_dir (string): the pipeline store directory
+"""
+
+
+def file_digest(path, store_dir):
+    stat = os.stat(path)
+    fingerprint = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    record_path = os.path.join(store_dir, DIGESTS_DIR, _hash_json(fingerprint["path"]) + ".json")
+    record = _read_json(record_path)
+    if record is not None and record["fingerprint"] == fingerprint:
+        return record["digest"]
+
+    digest = _hash_file(path)
+    _write_json(record_path, {"fingerprint": fingerprint, "digest": digest})
+    return digest
+
+
+"""
+Returns the key of a stage result: a hash of the stage name and version and
+of its inputs (file hashes and parameters).
+Args:
+    stage (string): the stage name, from STAGE_VERSIONS
+    inputs (dict): the input file hashes and the parameters of the stage
+"""
+
+
+def stage_key(stage, inputs):
+    return _hash_json({"stage": stage, "version": STAGE_VERSIONS[stage], "inputs": inputs})
+
+
+"""
+Returns the stored result of a stage, running the stage first if the store
+does not have it. The stage writes its output files into a new directory,
+which is moved into the store (with a meta.json holding the hashes of the
+files and the values the stage returned) only once the stage has finished, so
+a failed or interrupted stage leaves nothing behind. Returns the meta dict,
+plus the directory of the files ("dir") and whether the stage ran ("ran").
+Args:
+    store_dir (string): the pipeline store directory
+    stage (string): the stage name, from STAGE_VERSIONS
+    inputs (dict): the input file hashes and the parameters of the stage
+    run (function): takes the output directory, writes the output files into
+        it and returns a JSON-serializable dict of values (or None)
+"""
+
+
+def run_stage(store_dir, stage, inputs, run):
+    key = stage_key(stage, inputs)
+    entry_dir = os.path.join(store_dir, OBJECTS_DIR, key[:2], key)
+    meta = _read_json(os.path.join(entry_dir, META_FILE))
+    if meta is not None:
+        meta.update({"dir": entry_dir, "ran": False})
+        return meta
+
+    temp_dir = entry_dir + ".tmp-" + str(os.getpid())
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    try:
+        values = run(temp_dir)
+        files = {name: _hash_file(os.path.join(temp_dir, name)) for name in sorted(os.listdir(temp_dir))}
+        meta = {"stage": stage, "key": key, "inputs": inputs, "files": files, "values": values or {}}
+        _write_json(os.path.join(temp_dir, META_FILE), meta)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # another process may have stored the same result first, which is just as good
+            if _read_json(os.path.join(entry_dir, META_FILE)) is None:
+                raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    meta.update({"dir": entry_dir, "ran": True})
+    return meta
+
+
+"""
+Runs OpenGaze's GazeVisualization on a video. OpenGaze writes its output next
+to the video, as [name]_gaze_output.txt; it is moved into out_dir as raw.txt.
+With face spans, only the frames with a face are extracted (from a video of
+just those frames, written into out_dir and removed afterwards), and their
+frame numbers are mapped back to the original video.
+Args:
+    video_path (string): the path to the video
+    extractor (string): the path to the GazeVisualization executable
+    out_dir (string): the directory to move the output into
+    timeout (float): the longest the extractor may run, in seconds (default
+        is no limit)
+    face_spans (LabelTimeline): the face spans of the video (default is to
+        extract every frame)
+"""
+
+
+def extract_raw_output(video_path, extractor, out_dir, timeout=None, face_spans=None):
+    if face_spans is None:
+        subprocess.run([extractor, "-t", "video", "-i", video_path], check=True, timeout=timeout)
+        shutil.move(os.path.splitext(video_path)[0] + "_gaze_output.txt", os.path.join(out_dir, "raw.txt"))
+        return
+
+    face_video = os.path.join(out_dir, "faces.avi")
+    face_output = os.path.join(out_dir, "faces_gaze_output.txt")
+    try:
+        frame_indices = write_face_video(video_path, face_spans, face_video)
+        subprocess.run([extractor, "-t", "video", "-i", face_video], check=True, timeout=timeout)
+        restore_frame_numbers(face_output, frame_indices, os.path.join(out_dir, "raw.txt"))
+    finally:
+        for path in (face_video, face_output):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+"""
+Runs every stage of one session, reusing stored results where possible, and
+copies the outputs next to each other into output_dir, as
+[session]_converted_MOD3.tsv, [session]_accuracy.tsv and
+[session]_visualization.png. Returns a dict with the session name, whether
+each stage ran or was reused and how long it took (in seconds), the
+evaluation of the session (see evaluate_opengaze_batch.evaluate_session), and
+the error message if the session failed.
+Args:
+    session (dict): a session from read_manifest
+    store_dir (string): the pipeline store directory
+    output_dir (string): the directory the outputs are copied to
+    parameters (dict): heuristic parameters that override DEFAULT_PARAMETERS
+    extractor (string): the path to the GazeVisualization executable; if
+        given, the raw output is extracted from the video (and raw_path is
+        not used)
+    disagreement (bool): whether the visualization has a disagreement track
+    timeout (float): the longest the extractor may run, in seconds
+    face_gate (bool): whether to detect the spans of the video with a face
+        first, extract only those and label the rest none
+"""
+
+
+def run_session(session, store_dir, output_dir, parameters=None, extractor=None, disagreement=False, timeout=None,
+                face_gate=False):
+    result = {"session": session["session"], "stages": {}, "seconds": {}}
+    try:
+        _run_session(session, store_dir, output_dir, get_parameters(parameters), extractor, disagreement,
+                     timeout, face_gate, result)
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+    return result
+
+
+def _run_session(session, store_dir, output_dir, parameters, extractor, disagreement, timeout, face_gate, result):
+    def stage(name, inputs, run):
+        start = time.perf_counter()
+        meta = run_stage(store_dir, name, inputs, run)
+        result["stages"][name] = "ran" if meta["ran"] else "reused"
+        result["seconds"][name] = time.perf_counter() - start
+        return meta
+
+    video_path = session["video_path"]
+    video = file_digest(video_path, store_dir)
+    outputs = {}
+
+    # the faces are only part of the later stages' inputs with face gating,
+    # so the results stored without it stay valid
+    gate = {}
+    face_spans = None
+    if face_gate:
+        def run_faces(out_dir):
+            spans = detect_face_spans(video_path, **DEFAULT_DETECTION)
+            spans.write_tsv(os.path.join(out_dir, "faces.tsv"))
+            return {"face_fraction": face_fraction(spans)}
+
+        outputs["faces"] = stage("faces", {"video": video, "detection": DEFAULT_DETECTION}, run_faces)
+        face_spans = LabelTimeline.read_tsv(os.path.join(outputs["faces"]["dir"], "faces.tsv"))
+        gate = {"faces": outputs["faces"]["files"]["faces.tsv"]}
+        result["face_fraction"] = outputs["faces"]["values"]["face_fraction"]
+
+    if extractor is not None:
+        extracted = stage("extract", dict({"video": video, "extractor": os.path.basename(extractor)}, **gate),
+                          lambda out_dir: extract_raw_output(video_path, extractor, out_dir, timeout, face_spans))
+        raw_path = os.path.join(extracted["dir"], "raw.txt")
+        raw = extracted["files"]["raw.txt"]
+    else:
+        raw_path = session["raw_path"]
+        raw = file_digest(raw_path, store_dir)
+
+    def run_info(out_dir):
+        ms_per_frame, duration_ms = get_vid_info(video_path)
+        return {"ms_per_frame": ms_per_frame, "duration_ms": duration_ms}
+
+    info = stage("info", {"video": video}, run_info)["values"]
+
+    converted = stage("convert", dict({"raw": raw, "ms_per_frame": info["ms_per_frame"],
+                                       "duration_ms": info["duration_ms"], "parameters": parameters}, **gate),
+                      lambda out_dir: convert_csv_file(raw_path, info["ms_per_frame"], info["duration_ms"],
+                                                       parameters=parameters,
+                                                       save_name=os.path.join(out_dir, "converted.tsv"),
+                                                       face_spans=face_spans))
+    prediction_path = os.path.join(converted["dir"], "converted.tsv")
+    outputs["convert"] = converted
+
+    if session.get("truth_path") is not None:
+        truth_path = session["truth_path"]
+        truth = file_digest(truth_path, store_dir)
+        prediction = converted["files"]["converted.tsv"]
+        evaluated_session = {"session": session["session"], "raw_path": raw_path, "truth_path": truth_path,
+                             "prediction_path": prediction_path, "ms_per_frame": info["ms_per_frame"]}
+
+        def run_evaluate(out_dir):
+            calculate_accuracies(raw_path, truth_path, prediction_path, info["ms_per_frame"],
+                                 os.path.join(out_dir, "accuracy.tsv"))
+            return evaluate_session(evaluated_session)
+
+        outputs["evaluate"] = stage("evaluate", {"raw": raw, "truth": truth, "prediction": prediction,
+                                                 "ms_per_frame": info["ms_per_frame"]}, run_evaluate)
+        # the evaluation is stored by content, so it may come from a session with another name
+        result["evaluation"] = dict(outputs["evaluate"]["values"], session=session["session"])
+
+        def run_visualize(out_dir):
+            render_session({"truth_path": truth_path, "prediction_path": prediction_path,
+                            "session": session["session"], "output_path": os.path.join(out_dir, "visualization.png")},
+                           disagreement)
+
+        outputs["visualize"] = stage("visualize", {"session": session["session"], "truth": truth,
+                                                   "prediction": prediction, "disagreement": disagreement},
+                                     run_visualize)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, meta in outputs.items():
+        file_name, suffix = EXPORTS[name]
+        export_path = os.path.join(output_dir, session["session"] + suffix)
+        if not os.path.isfile(export_path) or file_digest(export_path, store_dir) != meta["files"][file_name]:
+            shutil.copyfile(os.path.join(meta["dir"], file_name), export_path)
+
+
+def _run_session_star(args):
+    return run_session(*args)
+
+
+"""
+Runs the pipeline for many sessions in a pool of processes. Returns the
+result of run_session for each session.
+Args:
+    sessions (list of dicts): the sessions from read_manifest
+    processes (int): the number of worker processes (default is the number of CPUs)
+    other args: see run_session
+"""
+
+
+def run_sessions(sessions, store_dir, output_dir, parameters=None, extractor=None, disagreement=False,
+                 timeout=None, processes=None, face_gate=False):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_run_session_star,
+                                 [(session, store_dir, output_dir, parameters, extractor, disagreement, timeout,
+                                   face_gate) for session in sessions]))
+
+
+"""
+Reads a manifest of sessions: a tsv with the columns video_path (the gaze
+video) and, optionally, raw_path (the raw OpenGaze output; default
+[video name]_gaze_output.txt, where OpenGaze writes it), truth_path (the label
+truth tsv; sessions without one are only converted) and session (default: the
+name of the video, also for a blank cell). Relative paths are relative to the
+manifest.
+Args:
+    manifest_path (string): the path to the manifest tsv
+"""
+
+
+def read_manifest(manifest_path):
+    # session names are read as strings, so that e.g. "007" stays "007"
+    manifest = pd.read_csv(manifest_path, sep="\t", dtype={"session": str})
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    sessions = []
+    for row in manifest.to_dict("records"):
+        video_path = os.path.join(directory, row["video_path"])
+        raw_path = row.get("raw_path")
+        if not isinstance(raw_path, str):
+            raw_path = os.path.splitext(video_path)[0] + "_gaze_output.txt"
+        truth_path = row.get("truth_path")
+        session = row.get("session")
+        sessions.append({
+            "session": session if isinstance(session, str) else os.path.splitext(os.path.basename(video_path))[0],
+            "video_path": video_path,
+            "raw_path": os.path.join(directory, raw_path),
+            "truth_path": os.path.join(directory, truth_path) if isinstance(truth_path, str) else None,
+        })
+    return sessions
+
+
+def _hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _hash_json(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp-" + str(os.getpid())
+    with open(temp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(temp_path, path)
+
+
+"""
+Takes in a CLI arg (the path to a manifest of sessions) and the conversion's
+heuristic parameters, runs the pipeline for every session and saves the
+outputs to the output directory, with a summary of which stages ran and the
+evaluation of each session in [output directory]/pipeline.json
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'manifest_path',
+        type=str,
+        help='The path to a tsv with the column video_path and, optionally, raw_path, truth_path and session.')
+    argparser.add_argument(
+        '--output-dir',
+        type=str,
+        default=None,
+        help='The directory to save the outputs to. (default is [manifest name]_pipeline next to the manifest)')
+    argparser.add_argument(
+        '--store',
+        type=str,
+        default=None,
+        help='The directory of the stored stage results. (default is .pipeline_store next to the manifest)')
+    argparser.add_argument(
+        '--extractor',
+        type=str,
+        default=None,
+        help='The path to OpenGaze\'s GazeVisualization, to extract the raw output from the videos.')
+    argparser.add_argument(
+        '--timeout',
+        type=float,
+        default=None,
+        help='The longest the extractor may run on one video, in seconds. (default is no limit)')
+    argparser.add_argument(
+        '--disagreement',
+        action='store_true',
+        help='Add a track showing where the truth and the predictions disagree to the visualizations.')
+    argparser.add_argument(
+        '--face-gate',
+        action='store_true',
+        help='Detect the spans of each video with a face first, only extract those and label the rest none.')
+    argparser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='The number of sessions to run at once. (default is the number of CPUs)')
+    for name, default in DEFAULT_PARAMETERS.items():
+        argparser.add_argument(
+            '--' + name.replace('_', '-'),
+            type=type(default),
+            default=default,
+            help='The ' + name + ' heuristic parameter of the conversion. (default is ' + str(default) + ')')
+    run_metrics.add_arguments(argparser, hot_stage='sessions')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if not os.path.isfile(parsed_args.manifest_path):
+        print("Invalid path to manifest")
+        return
+
+    if parsed_args.face_gate:
+        error = check_face_detector()
+        if error is not None:
+            print("Face detection (for --face-gate) is not available: " + error)
+            return
+
+    directory = os.path.dirname(os.path.abspath(parsed_args.manifest_path))
+    output_dir = parsed_args.output_dir or os.path.splitext(parsed_args.manifest_path)[0] + "_pipeline"
+    store_dir = parsed_args.store or os.path.join(directory, ".pipeline_store")
+    parameters = {name: getattr(parsed_args, name) for name in DEFAULT_PARAMETERS}
+
+    sessions = read_manifest(parsed_args.manifest_path)
+    # the outputs of every session are exported by session name into one directory
+    names = [session["session"] for session in sessions]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        print("Duplicate session names in manifest: " + ", ".join(duplicates))
+        return
+    print("Running " + str(len(sessions)) + " sessions...")
+    start = time.time()
+    with run_metrics.RunMetrics("run_pipeline", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["manifest_path"] = os.path.abspath(parsed_args.manifest_path)
+        with metrics.stage("sessions", rows=len(sessions)):
+            results = run_sessions(sessions, store_dir, output_dir, parameters, parsed_args.extractor,
+                                   parsed_args.disagreement, parsed_args.timeout, parsed_args.processes,
+                                   parsed_args.face_gate)
+        # the cost of each session, by pipeline stage
+        metrics.info["sessions"] = [{key: result[key] for key in ("session", "stages", "seconds")}
+                                    for result in results]
+
+    ran = sum(list(result["stages"].values()).count("ran") for result in results)
+    reused = sum(list(result["stages"].values()).count("reused") for result in results)
+    for result in results:
+        if "error" in result:
+            print("Session " + result["session"] + " failed: " + result["error"])
+    print("Ran " + str(ran) + " stages and reused " + str(reused) + " in " + str(round(time.time() - start, 1)) + " s")
+
+    name = os.path.join(output_dir, "pipeline.json")
+    os.makedirs(output_dir, exist_ok=True)
+    with open(name, "w") as f:
+        json.dump({"parameters": parameters, "sessions": results}, f, indent=2)
+    print("Done! Saved to '" + name + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,188 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+import run_metrics
+
+"""
+Finds the label changes that survive the removal of very quick switches, in a
+single pass over the change points. A switch is "quick" when the label it
+switches to lasts min_duration milliseconds or less; it is removed when the
+label switches back to the previous label afterwards, or when the label it
+switches to is one of the transient labels.
+There are two modes:
+    "compat" reproduces the original filter in convert_opengaze_output exactly,
+        including its quirks: it never looks back after a removal, and repeated
+        labels split a segment into shorter ones.
+    "cascade" first merges repeated labels into one segment, and after every
+        removal re-checks the previous segment against its new neighbour, so
+        that short segments exposed by a removal are removed as well.
+Returns a numpy array with the indices of the change points to keep.
+Args:
+    times (numpy array of ints): the time (in milliseconds) of each label change
+    labels (list or numpy array of strings): the label each change switches to
+    min_duration (int): the longest duration (in milliseconds) of a quick switch
+    transient_labels (collection of strings): labels that are removed when they
+        last min_duration or less, whatever they switch back to
+    mode (string): "compat" or "cascade"
+"""
+
+
+def find_kept_changes(times, labels, min_duration=250, transient_labels=("None_of_the_above",), mode="compat"):
+    times = np.asarray(times).tolist()
+    labels = list(labels)
+    transient_labels = set(transient_labels)
+    if mode == "compat":
+        kept = _find_kept_changes_compat(times, labels, min_duration, transient_labels)
+    elif mode == "cascade":
+        kept = _find_kept_changes_cascade(times, labels, min_duration, transient_labels)
+    else:
+        raise ValueError("Unknown smoothing mode: " + str(mode))
+    return np.array(kept, dtype=np.int64)
+
+
+def _find_kept_changes_compat(times, labels, min_duration, transient_labels):
+    # The original filter looks at rows i, i+1 and i+2 and never moves i back, so
+    # the rows up to i are final (kept) and rows after i are still to be read (upcoming)
+    n = len(times)
+    if n == 0:
+        return []
+    kept = [0]
+    upcoming = 1
+    while upcoming + 1 < n:
+        label1 = labels[kept[-1]]
+        label2 = labels[upcoming]
+        label3 = labels[upcoming + 1]
+        quick = times[upcoming + 1] - times[upcoming] <= min_duration
+
+        # remove instances where it switches to a new label and then switches
+        # back quickly (both changes are removed)
+        if label1 == label3 and label2 != label1:
+            if quick:
+                upcoming += 2
+                continue
+        # remove instances where it switches to a transient label and then to
+        # another label quickly
+        elif label2 in transient_labels and label1 != label2 and label3 != label2:
+            if quick:
+                upcoming += 1
+                continue
+        kept.append(upcoming)
+        upcoming += 1
+    kept.extend(range(upcoming, n))
+    return kept
+
+
+def _find_kept_changes_cascade(times, labels, min_duration, transient_labels):
+    kept = []
+    for upcoming in range(len(times)):
+        # A repeated label does not start a new segment
+        if len(kept) > 0 and labels[upcoming] == labels[kept[-1]]:
+            continue
+
+        # The last kept segment now has a known duration; remove it if it is a
+        # quick switch, and keep checking the segments it uncovers
+        merged = False
+        while len(kept) >= 2 and times[upcoming] - times[kept[-1]] <= min_duration:
+            if labels[kept[-2]] == labels[upcoming]:
+                kept.pop()
+                merged = True  # the next change switches back to the same label
+                break
+            if labels[kept[-1]] in transient_labels:
+                kept.pop()
+            else:
+                break
+        if not merged:
+            kept.append(upcoming)
+    return kept
+
+
+"""
+Removes very quick switches from a list of [time, duration, label, comment]
+rows, as in find_kept_changes, and returns the rows that are kept.
+Args:
+    list_of_lists (list of lists): the rows at which the label changes
+    min_duration, transient_labels, mode: see find_kept_changes
+"""
+
+
+def smooth_rows(list_of_lists, min_duration=250, transient_labels=("None_of_the_above",), mode="compat"):
+    kept = find_kept_changes([row[0] for row in list_of_lists], [row[2] for row in list_of_lists],
+                             min_duration, transient_labels, mode)
+    return [list_of_lists[i] for i in kept.tolist()]
+
+
+"""
+Removes very quick switches from a label tsv (in the Time/Duration/Trackname/
+Comments format) and saves the result. A final "end" row is kept as it is.
+Args:
+    path_to_tsv (string): the path to the label tsv
+    save_name (string): the path to which the output will be saved
+    min_duration, transient_labels, mode: see find_kept_changes
+"""
+
+
+def smooth_tsv(path_to_tsv, save_name, min_duration=250, transient_labels=("None_of_the_above",), mode="cascade"):
+    with run_metrics.stage("read") as stage:
+        df = pd.read_csv(path_to_tsv, sep="\t")
+        labels = df['Trackname'].astype(str).str.strip().to_numpy()
+        stage.rows = len(df)
+
+    end = len(df)
+    if end > 0 and labels[-1] == "end":
+        end -= 1
+    with run_metrics.stage("smooth", rows=end):
+        kept = find_kept_changes(df['Time'].to_numpy()[:end], labels[:end], min_duration, transient_labels, mode)
+        kept = np.concatenate((kept, np.arange(end, len(df))))
+
+    with run_metrics.stage("write", rows=len(kept)):
+        df.iloc[kept].to_csv(save_name, index=False, sep="\t")
+
+
+"""
+Takes in a CLI arg (the path to a label tsv) and saves the label tsv with very
+quick switches removed to [name]_smoothed.tsv
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'tsv_path',
+        type=str,
+        help='The path to the label tsv.')
+    argparser.add_argument(
+        '--min-duration',
+        type=int,
+        default=250,
+        help='The longest duration of a quick switch, in milliseconds. (default is 250)')
+    argparser.add_argument(
+        '--transient',
+        type=str,
+        nargs='*',
+        default=['None_of_the_above'],
+        help='Labels that are removed whenever they last no longer than the minimum duration. '
+             '(default is None_of_the_above)')
+    argparser.add_argument(
+        '--mode',
+        choices=['cascade', 'compat'],
+        default='cascade',
+        help='"cascade" (default) merges repeated labels and re-checks segments uncovered by a removal; '
+             '"compat" reproduces the filter in convert_opengaze_output.py exactly.')
+    run_metrics.add_arguments(argparser, hot_stage='smooth')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if not os.path.isfile(parsed_args.tsv_path):
+        print("Invalid path to label tsv")
+        return
+
+    name = parsed_args.tsv_path[:-4] + "_smoothed.tsv"
+    with run_metrics.RunMetrics("smooth_labels", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["tsv_path"] = os.path.abspath(parsed_args.tsv_path)
+        smooth_tsv(parsed_args.tsv_path, name, parsed_args.min_duration, parsed_args.transient, parsed_args.mode)
+    print("Done! Saved to '" + name + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,455 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+from convert_opengaze_output import (LABELS, OPENGAZE_DTYPE, assign_labels, convert_csv_file,
+                                     find_clean_rows, get_vid_info)
+import run_metrics
+
+"""
+A mergeable histogram of gaze_2d_x values with a fixed, fine bin width, that
+can be re-binned into the coarser bins used by find_x_bounds at any time.
+find_x_bounds starts its bins at the minimum rounded to 0.1 and uses a step of
+0.15, so every one of its bin edges is a multiple of 0.05; with the default
+bin width the re-binned counts are the same as find_x_bounds' counts (except
+for values that lie exactly on a bin edge).
+Args:
+    bin_width (float): the width of the fine bins; must divide the step used
+        in x_bounds and 0.1
+"""
+
+
+class StreamingHistogram:
+
+    def __init__(self, bin_width=0.05):
+        self.bin_width = bin_width
+        self.counts = {}
+        self.count = 0
+        self.minimum = float('inf')
+        self.maximum = float('-inf')
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        bins, counts = np.unique(np.floor(values / self.bin_width).astype(np.int64), return_counts=True)
+        for b, c in zip(bins.tolist(), counts.tolist()):
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.count += len(values)
+        self.minimum = min(self.minimum, float(np.min(values)))
+        self.maximum = max(self.maximum, float(np.max(values)))
+
+    def merge(self, other):
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    """
+    Calculates the upper and lower "away" thresholds for gaze_2d_x the same way
+    as find_x_bounds, from the counts seen so far. Returns None if no bin is
+    occupied enough yet.
+    Args:
+        step (float): the width of the bins used to find the thresholds
+        occupancy (float): the fraction of all samples a bin must exceed
+    """
+
+    def x_bounds(self, step=0.15, occupancy=0.005):
+        if self.count == 0:
+            return None
+        start = round(self.minimum, 1)
+        stop = round(self.maximum, 1)
+        bin_left_edges = [round(start + step * i, 2) for i in range(round((stop - start) / step + 2))]
+
+        # Sum the fine bins that make up each coarse bin
+        fine_edges = [int(round(edge / self.bin_width)) for edge in bin_left_edges]
+        counts = np.array([sum(self.counts.get(b, 0) for b in range(lower, upper))
+                           for lower, upper in zip(fine_edges[:-1], fine_edges[1:])])
+
+        indices_above_max = np.flatnonzero(counts > self.count * occupancy)
+        if len(indices_above_max) == 0:
+            return None
+        x_data = [round(bin_edge + step / 2, 3) for bin_edge in bin_left_edges][:-1]
+        return x_data[indices_above_max.min()], x_data[indices_above_max.max()]
+
+
+"""
+Running mean and variance of gaze_2d_y values (Welford's algorithm, extended to
+add a whole batch of values at a time), used to find the z-score boundary
+incrementally. Two instances can be merged.
+"""
+
+
+class RunningStats:
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        batch_count = len(values)
+        batch_mean = float(np.mean(values))
+        batch_m2 = float(np.sum((values - batch_mean) ** 2))
+        self._combine(batch_count, batch_mean, batch_m2)
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    """
+    Calculates the raw score corresponding to a z-score, like get_boundary_value.
+    Returns None if fewer than two values have been seen.
+    Args:
+        z_score (float): the desired z-score
+    """
+
+    def boundary(self, z_score):
+        if self.count < 2:
+            return None
+        return (self.m2 / (self.count - 1)) ** 0.5 * z_score + self.mean
+
+
+"""
+Converts OpenGaze output incrementally, as it is being written. Rows are fed in
+as they arrive; once the warm-up period has passed, every new frame is labeled
+with the current thresholds and each label change is emitted as a
+[time, duration, label, comment] row.
+The thresholds keep being updated as data arrives. When they have moved by
+more than settle_tolerance from the thresholds that were used for the emitted
+rows, and have then stayed within settle_tolerance for settle_frames frames,
+every frame seen so far is relabeled and the rows that changed are emitted
+again with the comment "(correction)". A correction row replaces every
+previously emitted row at or after its time.
+Unlike convert_csv_file, quick switches are not removed, since that would hold
+back every label change; run convert_csv_file on the finished file for that.
+Args:
+    frame_length (float): the duration of each frame (in milliseconds)
+    warmup_frames (int): the number of frames to collect before labeling
+    settle_tolerance (float): how far the thresholds may move before the
+        emitted labels are corrected
+    settle_frames (int): how many frames the thresholds must stay put before
+        a correction is emitted
+"""
+
+
+class StreamingConverter:
+
+    def __init__(self, frame_length, warmup_frames=1800, settle_tolerance=0.01, settle_frames=300):
+        self.frame_length = frame_length
+        self.warmup_frames = warmup_frames
+        self.settle_tolerance = settle_tolerance
+        self.settle_frames = settle_frames
+
+        # Rows are stored in arrays that grow by doubling, so each row is copied a
+        # bounded number of times however often data arrives
+        self.size = 0
+        self._data = np.zeros(1024, dtype=OPENGAZE_DTYPE)
+        self._keep = np.zeros(1024, dtype=bool)
+        self.x_histogram = StreamingHistogram()
+        self.y_stats = RunningStats()
+        self.final_rows = 0  # rows whose bug-pattern check can no longer change
+
+        self.thresholds = None  # thresholds used for the emitted rows
+        self.candidate_thresholds = None
+        self.candidate_since = 0
+        self.labeled_rows = 0
+        self.emitted = []  # [time, label] of every label change emitted so far
+
+    """
+    Adds new lines of OpenGaze output and returns the rows to emit.
+    Args:
+        lines (list of strings): complete lines of the OpenGaze output file
+    """
+
+    def feed(self, lines):
+        if len(lines) == 0:
+            return []
+        new_data = np.loadtxt(lines, delimiter=",", usecols=(0, 2, 6, 7), dtype=OPENGAZE_DTYPE, ndmin=1)
+        self._append(new_data)
+
+        # The bug pattern looks four rows ahead, so only rows that are followed by
+        # four more are final (the last four rows of a file are always dropped).
+        # Whether a row is skipped depends on at most the eight rows before it.
+        window_start = max(self.final_rows - 8, 0)
+        final_rows = max(self.size - 4, 0)
+        window_keep = find_clean_rows(self._data["confidence"][window_start:self.size])
+        self._keep[self.final_rows:final_rows] = window_keep[self.final_rows - window_start:final_rows - window_start]
+
+        new_rows = self._data[self.final_rows:final_rows][self._keep[self.final_rows:final_rows]]
+        self.final_rows = final_rows
+        x = new_rows["gaze_2d_x"]
+        y = new_rows["gaze_2d_y"]
+        self.x_histogram.add(x[np.abs(x) < 1e10])
+        self.y_stats.add(y[np.abs(y) < 1e10])
+
+        thresholds = self.current_thresholds()
+        if thresholds is None or self.x_histogram.count < self.warmup_frames:
+            return []
+        if self.thresholds is None:
+            self.thresholds = thresholds
+            self.candidate_thresholds = thresholds
+            self.candidate_since = self.final_rows
+
+        rows = self._label_new_rows()
+        rows.extend(self._correct_if_settled(thresholds))
+        return rows
+
+    """
+    Returns the thresholds (x lower bound, x upper bound, y upper bound) for the
+    data seen so far, or None if they cannot be calculated yet.
+    """
+
+    def current_thresholds(self):
+        x_bounds = self.x_histogram.x_bounds()
+        y_bound = self.y_stats.boundary(-1.5)
+        if x_bounds is None or y_bound is None:
+            return None
+        return x_bounds[0], x_bounds[1], y_bound
+
+    """
+    Labels every frame seen so far with the current thresholds and re-emits
+    the rows that differ from what was emitted. Used when the stream ends.
+    """
+
+    def finish(self):
+        thresholds = self.current_thresholds()
+        if thresholds is None:
+            return []
+        if self.thresholds is None:
+            self.thresholds = thresholds
+            return self._label_new_rows()
+        return self._correct(thresholds)
+
+    def _append(self, new_data):
+        if self.size + len(new_data) > len(self._data):
+            capacity = max(2 * len(self._data), self.size + len(new_data))
+            self._data = np.resize(self._data, capacity)
+            self._keep = np.resize(self._keep, capacity)
+        self._data[self.size:self.size + len(new_data)] = new_data
+        self.size += len(new_data)
+
+    def _label_changes(self, start, thresholds):
+        rows = self._data[start:self.final_rows][self._keep[start:self.final_rows]]
+        codes = assign_labels(rows["confidence"], rows["gaze_2d_x"], rows["gaze_2d_y"], *thresholds)
+        if len(codes) == 0:
+            return []
+        change_indices = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+        times = np.rint((rows["frame"][change_indices] - 1) * self.frame_length).astype(np.int64)
+        return [[t, LABELS[c]] for t, c in zip(times.tolist(), codes[change_indices].tolist())]
+
+    def _label_new_rows(self):
+        changes = self._label_changes(self.labeled_rows, self.thresholds)
+        self.labeled_rows = self.final_rows
+        if len(changes) > 0 and len(self.emitted) > 0 and changes[0][1] == self.emitted[-1][1]:
+            changes = changes[1:]
+        self.emitted.extend(changes)
+        return [[t, 0, label, "(null)"] for t, label in changes]
+
+    def _correct_if_settled(self, thresholds):
+        if _distance(thresholds, self.candidate_thresholds) > self.settle_tolerance:
+            self.candidate_thresholds = thresholds
+            self.candidate_since = self.final_rows
+            return []
+        if (self.final_rows - self.candidate_since >= self.settle_frames
+                and _distance(self.candidate_thresholds, self.thresholds) > self.settle_tolerance):
+            return self._correct(self.candidate_thresholds)
+        return []
+
+    def _correct(self, thresholds):
+        self.thresholds = thresholds
+        changes = self._label_changes(0, thresholds)
+        self.labeled_rows = self.final_rows
+
+        # Find the first row that differs from what was emitted
+        first = 0
+        while first < min(len(changes), len(self.emitted)) and changes[first] == self.emitted[first]:
+            first += 1
+        old_rows = self.emitted[first:]
+        self.emitted = changes
+        if first == len(changes) and len(old_rows) == 0:
+            return []
+
+        # A correction has to start no later than the first row it replaces, so
+        # start it at the last unchanged row if that row was removed
+        corrected = changes[first:]
+        if len(old_rows) > 0 and (len(corrected) == 0 or old_rows[0][0] < corrected[0][0]):
+            corrected = changes[max(first - 1, 0):]
+        return [[t, 0, label, "(correction)"] for t, label in corrected]
+
+
+def _distance(thresholds, other_thresholds):
+    return max(abs(a - b) for a, b in zip(thresholds, other_thresholds))
+
+
+"""
+Follows a file that is being written, yielding lists of the complete lines that
+were added since the last check. Stops once the file has not grown for
+idle_timeout seconds.
+Args:
+    path (string): the path to the file to follow
+    poll_interval (float): how often to check the file for new data, in seconds
+    idle_timeout (float): how long to wait for new data before stopping, in seconds
+"""
+
+
+def follow(path, poll_interval=0.5, idle_timeout=30.0):
+    last_change = time.monotonic()
+    while not os.path.isfile(path):
+        if time.monotonic() - last_change > idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+    partial_line = ""
+    with open(path) as f:
+        last_change = time.monotonic()
+        while True:
+            data = f.read()
+            if data:
+                last_change = time.monotonic()
+                lines = (partial_line + data).split("\n")
+                partial_line = lines.pop()
+                lines = [line for line in lines if line.strip()]
+                if lines:
+                    yield lines
+            elif time.monotonic() - last_change > idle_timeout:
+                if partial_line.strip():
+                    yield [partial_line]
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+"""
+Converts an OpenGaze output file while it is being written, appending the
+emitted rows to [name]_live.tsv as they become available.
+Args:
+    path_to_csv (string): the path to the OpenGaze output file
+    frame_length (float): the duration of each frame (in milliseconds)
+    warmup_seconds (float): how much video to collect before labeling, in seconds
+    settle_tolerance (float): how far the thresholds may move before the
+        emitted labels are corrected
+    settle_seconds (float): how long the thresholds must stay put before a
+        correction is emitted, in seconds
+    poll_interval (float): how often to check the file for new data, in seconds
+    idle_timeout (float): how long to wait for new data before stopping, in seconds
+"""
+
+
+def stream_csv_file(path_to_csv, frame_length, warmup_seconds=60, settle_tolerance=0.01,
+                    settle_seconds=10, poll_interval=0.5, idle_timeout=30.0):
+    name = path_to_csv[:-4]  # remove .txt from file name
+    converter = StreamingConverter(frame_length,
+                                   warmup_frames=int(warmup_seconds * 1000 / frame_length),
+                                   settle_tolerance=settle_tolerance,
+                                   settle_frames=int(settle_seconds * 1000 / frame_length))
+
+    with run_metrics.stage("stream", rows=0) as stage, open(name + '_live.tsv', 'w') as out:
+        out.write("Time\tDuration\tTrackname\tComments\n")
+        out.flush()
+        for lines in follow(path_to_csv, poll_interval, idle_timeout):
+            stage.rows += len(lines)
+            _write_rows(out, converter.feed(lines))
+        _write_rows(out, converter.finish())
+
+    return name + '_live.tsv'
+
+
+def _write_rows(out, rows):
+    for row in rows:
+        out.write("\t".join(str(value) for value in row) + "\n")
+    if rows:
+        out.flush()
+
+
+"""
+Takes in CLI arguments (the path to the original gaze video, and the path to
+the OpenGaze output file that is being written) and writes preliminary labels
+to [name]_live.tsv while OpenGaze is still running. With --finalize, the
+finished file is also converted with convert_csv_file once it stops growing.
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'video_path',
+        type=str,
+        help='The path to the original gaze video.')
+    argparser.add_argument(
+        'csv_path',
+        type=str,
+        help='The path to the OpenGaze output file (it does not need to exist yet).')
+    argparser.add_argument(
+        '--warmup-seconds',
+        type=float,
+        default=60,
+        help='How much video to collect before emitting labels, in seconds. (default is 60)')
+    argparser.add_argument(
+        '--settle-tolerance',
+        type=float,
+        default=0.01,
+        help='How far the thresholds may move before the emitted labels are corrected. (default is 0.01)')
+    argparser.add_argument(
+        '--settle-seconds',
+        type=float,
+        default=10,
+        help='How long the thresholds must stay put before a correction is emitted, in seconds. '
+             '(default is 10)')
+    argparser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=0.5,
+        help='How often to check the OpenGaze output for new data, in seconds. (default is 0.5)')
+    argparser.add_argument(
+        '--idle-timeout',
+        type=float,
+        default=30,
+        help='Stop once the OpenGaze output has not grown for this many seconds. (default is 30)')
+    argparser.add_argument(
+        '--finalize',
+        action='store_true',
+        help='Convert the finished file with convert_opengaze_output once it stops growing.')
+    run_metrics.add_arguments(argparser, hot_stage='stream')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if not os.path.isfile(parsed_args.video_path):
+        print("Invalid path to video")
+        return
+
+    with run_metrics.RunMetrics("stream_opengaze_output", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["csv_path"] = os.path.abspath(parsed_args.csv_path)
+        with metrics.stage("video_info"):
+            frame_len, duration = get_vid_info(parsed_args.video_path)
+        print("Frame length:", frame_len)
+        print("\n")
+        print("Following OpenGaze output...")
+        name = stream_csv_file(parsed_args.csv_path, frame_len,
+                               warmup_seconds=parsed_args.warmup_seconds,
+                               settle_tolerance=parsed_args.settle_tolerance,
+                               settle_seconds=parsed_args.settle_seconds,
+                               poll_interval=parsed_args.poll_interval,
+                               idle_timeout=parsed_args.idle_timeout)
+        print("Done! Live labels saved to " + name)
+
+        if parsed_args.finalize and os.path.isfile(parsed_args.csv_path):
+            print("Converting finished output...")
+            with metrics.stage("finalize"):
+                convert_csv_file(parsed_args.csv_path, frame_len, duration)
+            print("Done! Output saved to " + parsed_args.csv_path[:-4] + '_converted_MOD3.tsv')
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,245 @@
+import argparse
+import itertools
+import os
+import sys
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from convert_opengaze_output import (DEFAULT_PARAMETERS, LABELS, assign_labels, find_clean_rows,
+                                     find_label_changes, find_thresholds, load_opengaze_output)
+from evaluate_opengaze_accuracy import EVALUATED_LABELS, confusion_from_change_points, read_change_points
+from evaluate_opengaze_batch import read_manifest
+from smooth_labels import find_kept_changes
+import run_metrics
+
+# Maps the conversion's label codes (indices into LABELS) to the evaluated label
+# codes (indices into EVALUATED_LABELS): everything but left and right is away
+LABEL_TO_EVALUATED = np.array([EVALUATED_LABELS.index(label) if label in EVALUATED_LABELS
+                               else EVALUATED_LABELS.index("away") for label in LABELS], dtype=np.int8)
+
+"""
+Returns every combination of the given parameter values, as a list of
+parameter dicts.
+Args:
+    values_by_parameter (dict): maps each parameter name (see DEFAULT_PARAMETERS)
+        to the list of values to try; missing parameters keep their default
+"""
+
+
+def make_grid(values_by_parameter):
+    names = list(DEFAULT_PARAMETERS)
+    values = [values_by_parameter.get(name, [DEFAULT_PARAMETERS[name]]) for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+"""
+Converts one session with every parameter combination in the grid and
+evaluates each conversion against the truth labels. The OpenGaze output is
+loaded once, and every intermediate result (thresholds, labels, smoothed label
+changes) is shared between the combinations that lead to it. Like the files
+convert_opengaze_output writes, the predictions end (change to "away") at the
+end of the video: the session's duration_ms, or else its last frame. Returns
+an array of shape (len(grid), 3, 3) with the confusion matrix (in
+milliseconds, rows are truth and columns are predictions, in EVALUATED_LABELS
+order) of each combination; combinations for which no thresholds can be found
+get zeros.
+Args:
+    session (dict): a session from read_manifest
+    grid (list of dicts): the parameter combinations
+    use_cache (bool): whether to use the frame cache
+"""
+
+
+def sweep_session(session, grid, use_cache=True):
+    frames, confidence, gaze_2d_x, gaze_2d_y = load_opengaze_output(session["raw_path"], use_cache)
+    length_in_ms = round(float(frames[-1]) * session["ms_per_frame"])
+    end_time = session.get("duration_ms")
+    end_time = int(end_time) if end_time is not None else int(float(frames[-1]) * session["ms_per_frame"])
+    keep = find_clean_rows(confidence)
+    frames, confidence, gaze_2d_x, gaze_2d_y = frames[keep], confidence[keep], gaze_2d_x[keep], gaze_2d_y[keep]
+    truth_times, truth_codes = read_change_points(session["truth_path"])
+
+    thresholds_cache = {}
+    changes_cache = {}
+    confusions = np.zeros((len(grid), 3, 3), dtype=np.int64)
+    for i, parameters in enumerate(grid):
+        threshold_key = (parameters["x_step"], parameters["x_occupancy"], parameters["y_z_score"])
+        if threshold_key not in thresholds_cache:
+            try:
+                thresholds_cache[threshold_key] = find_thresholds(gaze_2d_x, gaze_2d_y, parameters)
+            except ValueError:
+                thresholds_cache[threshold_key] = None  # no histogram bin is occupied enough
+        thresholds = thresholds_cache[threshold_key]
+        if thresholds is None:
+            continue
+
+        label_key = threshold_key + (parameters["right_x_max"], parameters["right_ratio"])
+        if label_key not in changes_cache:
+            codes = assign_labels(confidence, gaze_2d_x, gaze_2d_y, *thresholds,
+                                  right_x_max=parameters["right_x_max"], right_ratio=parameters["right_ratio"])
+            changes_cache[label_key] = find_label_changes(frames, codes, session["ms_per_frame"])
+        times, codes = changes_cache[label_key]
+
+        kept = find_kept_changes(times, [LABELS[code] for code in codes.tolist()],
+                                 min_duration=parameters["min_switch_duration"], mode="compat")
+        # the "end" row, sorted after the changes like read_change_points does
+        prediction_times = np.append(times[kept], end_time)
+        prediction_codes = np.append(LABEL_TO_EVALUATED[codes[kept]], EVALUATED_LABELS.index("away"))
+        order = np.argsort(prediction_times, kind="stable")
+        confusions[i] = confusion_from_change_points(truth_times, truth_codes, prediction_times[order],
+                                                     prediction_codes[order], length_in_ms)
+    return confusions
+
+
+def _sweep_session_star(args):
+    return sweep_session(*args)
+
+
+"""
+Runs sweep_session for every session, spread over a pool of processes.
+Returns an array of shape (len(sessions), len(grid), 3, 3).
+Args:
+    sessions (list of dicts): the sessions from read_manifest
+    grid (list of dicts): the parameter combinations
+    processes (int): the number of worker processes (default is the number of CPUs)
+    use_cache (bool): whether to use the frame cache
+"""
+
+
+def sweep_sessions(sessions, grid, processes=None, use_cache=True):
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        confusions = list(executor.map(_sweep_session_star,
+                                       [(session, grid, use_cache) for session in sessions]))
+    return np.stack(confusions) if confusions else np.zeros((0, len(grid), 3, 3), dtype=np.int64)
+
+
+"""
+Calculates the accuracy (the fraction of milliseconds labeled correctly) and
+the balanced accuracy (the mean of the per-label accuracies, over the labels
+that occur in the truth) of confusion matrices. Returns two arrays.
+Args:
+    confusions (numpy array of ints): confusion matrices, with shape (..., 3, 3)
+"""
+
+
+def score_confusions(confusions):
+    correct = np.trace(confusions, axis1=-2, axis2=-1)
+    total = confusions.sum(axis=(-2, -1))
+    truth_totals = confusions.sum(axis=-1)
+    occurs = truth_totals > 0
+    recalls = np.where(occurs, np.diagonal(confusions, axis1=-2, axis2=-1) / np.maximum(truth_totals, 1), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = correct / total
+        balanced_accuracy = recalls.sum(axis=-1) / occurs.sum(axis=-1)
+    return accuracy, balanced_accuracy
+
+
+"""
+Builds a table with one row per session and parameter combination (and one
+"pooled" row per combination, from the summed confusion matrices), holding the
+parameters, the scores and the confusion counts.
+Args:
+    sessions (list of dicts): the sessions from read_manifest
+    grid (list of dicts): the parameter combinations
+    confusions (numpy array of ints): the result of sweep_sessions
+"""
+
+
+def make_results_table(sessions, grid, confusions):
+    names = [session["session"] for session in sessions] + ["pooled"]
+    all_confusions = np.concatenate((confusions, confusions.sum(axis=0, keepdims=True)))
+    accuracy, balanced_accuracy = score_confusions(all_confusions)
+
+    rows = []
+    for s, name in enumerate(names):
+        for g, parameters in enumerate(grid):
+            row = {"session": name}
+            row.update(parameters)
+            row["accuracy"] = accuracy[s, g]
+            row["balanced_accuracy"] = balanced_accuracy[s, g]
+            for t, truth_label in enumerate(EVALUATED_LABELS):
+                for p, predicted_label in enumerate(EVALUATED_LABELS):
+                    row[truth_label + "_as_" + predicted_label] = all_confusions[s, g, t, p]
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+"""
+Returns the row with the best score for each session (and for "pooled").
+Args:
+    results (pandas DataFrame): the result of make_results_table
+    metric (string): "accuracy" or "balanced_accuracy"
+"""
+
+
+def find_best(results, metric="accuracy"):
+    scored = results.dropna(subset=[metric])
+    return scored.loc[scored.groupby("session", sort=False)[metric].idxmax()]
+
+
+"""
+Takes in a CLI arg (the path to a manifest of sessions) and lists of values to
+try for each of the conversion's heuristic parameters, and saves the scores of
+every combination to [manifest]_sweep.tsv and the best combination per session
+(and pooled over all sessions) to [manifest]_sweep_best.tsv
+"""
+
+
+def main(args):
+    argparser = argparse.ArgumentParser(args[0])
+    argparser.add_argument(
+        'manifest_path',
+        type=str,
+        help='The path to a tsv with the columns raw_path, truth_path and, optionally, ms_per_frame and session.')
+    for name, default in DEFAULT_PARAMETERS.items():
+        argparser.add_argument(
+            '--' + name.replace('_', '-'),
+            type=type(default),
+            nargs='+',
+            default=[default],
+            help='The values of ' + name + ' to try. (default is ' + str(default) + ')')
+    argparser.add_argument(
+        '--metric',
+        choices=['accuracy', 'balanced_accuracy'],
+        default='accuracy',
+        help='The score used to pick the best parameters. (default is accuracy)')
+    argparser.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        help='The number of worker processes. (default is the number of CPUs)')
+    argparser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not load the parsed OpenGaze output from (or save it to) the frame cache.')
+    run_metrics.add_arguments(argparser, hot_stage='sweep')
+    parsed_args = argparser.parse_args(args[1:])
+
+    if not os.path.isfile(parsed_args.manifest_path):
+        print("Invalid path to manifest")
+        return
+
+    sessions = read_manifest(parsed_args.manifest_path)
+    grid = make_grid({name: getattr(parsed_args, name) for name in DEFAULT_PARAMETERS})
+    print("Evaluating", len(grid), "parameter combinations on", len(sessions), "sessions...")
+    name = parsed_args.manifest_path[:-4] + "_sweep.tsv"
+    best_name = parsed_args.manifest_path[:-4] + "_sweep_best.tsv"
+    with run_metrics.RunMetrics("sweep_thresholds", parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info["manifest_path"] = os.path.abspath(parsed_args.manifest_path)
+        metrics.info["combinations"] = len(grid)
+        # one row per session and parameter combination
+        with metrics.stage("sweep", rows=len(sessions) * len(grid)):
+            confusions = sweep_sessions(sessions, grid, parsed_args.processes, not parsed_args.no_cache)
+
+        with metrics.stage("write", rows=len(sessions) * len(grid)):
+            results = make_results_table(sessions, grid, confusions)
+            best = find_best(results, parsed_args.metric)
+            results.to_csv(name, index=False, sep="\t")
+            best.to_csv(best_name, index=False, sep="\t")
+    print(best[["session"] + list(DEFAULT_PARAMETERS) + [parsed_args.metric]].to_string(index=False))
+    print("Done! Saved to '" + name + "' and '" + best_name + "'")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
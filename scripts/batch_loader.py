@@ -0,0 +1,223 @@
+import queue, threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from feature_store import load_manifest, open_shard
+
+def compute_feature_stats(store_dir, split, columns, chunksize=100000):
+    """
+    Computes the mean and standard deviation of each feature over a split of a feature store in one pass over
+    the memory-mapped shards, ignoring NaNs. Features with no spread get a standard deviation of 1 (like
+    sklearn.preprocessing.scale).
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        split (String): name of the split
+        columns (list of ints): indices of the features to use
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        numpy array: the mean of each feature
+        numpy array: the standard deviation of each feature
+    """
+    count = np.zeros(len(columns))
+    total = np.zeros(len(columns))
+    squares = np.zeros(len(columns))
+    shift = None
+    for session_id in load_manifest(store_dir)['splits'][split]:
+        features = open_shard(store_dir, session_id)[0]
+        for start in range(0, len(features), chunksize):
+            chunk = features[start:start + chunksize, columns].astype(np.float64)
+            if shift is None:
+                shift = np.nan_to_num(chunk[0])  #shifting by any value keeps the sums small
+            present = ~np.isnan(chunk)
+            values = np.where(present, chunk - shift, 0)
+            count += present.sum(axis=0)
+            total += values.sum(axis=0)
+            squares += (values * values).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean ** 2, 0))
+    mean = np.nan_to_num(mean + (shift if shift is not None else 0))
+    std[~(std > 0)] = 1
+    return mean.astype(np.float32), std.astype(np.float32)
+
+class ShardBatchLoader:
+    """
+    Yields (features, one-hot labels) training batches from the shards of a feature store split without loading
+    the split into memory. Rows are read from memory-mapped shards a block at a time by a thread pool, standardized
+    with the given mean and standard deviation (missing values become 0, i.e. the mean), and shuffled within a
+    buffer of bounded size; a background thread keeps a few batches ready while the current one trains. Rows
+    without a label are skipped.
+
+    Memory use is about shuffle_buffer rows plus (prefetch + workers) batches or blocks, whatever the size of the
+    split.
+    """
+
+    def __init__(self, store_dir, split, columns, classes, mean, std, batch_size=32, shuffle=True,
+                 shuffle_buffer=10000, block_size=4096, prefetch=4, workers=2, expand_dims=False, seed=None):
+        """
+        Parameters:
+            store_dir (String): path to the feature store directory
+            split (String): name of the split
+            columns (list of ints): indices of the features to use
+            classes (list of Strings): label names, in the order of the one-hot columns
+            mean, std (numpy arrays): the standardization of each feature (see compute_feature_stats)
+            batch_size (int): number of rows per batch
+            shuffle (bool): True if the shard order and the rows within the buffer should be shuffled
+            shuffle_buffer (int): number of rows shuffled together
+            block_size (int): number of rows read from a shard at a time
+            prefetch (int): number of batches kept ready
+            workers (int): number of threads reading blocks
+            expand_dims (bool): True if the features should have shape (batch, features, 1), as for Conv1D
+            seed (int): seed of the shuffling
+        """
+        manifest = load_manifest(store_dir)
+        self.store_dir = store_dir
+        self.session_ids = list(manifest['splits'][split])
+        self.columns = list(columns)
+        self.mean, self.std = np.asarray(mean, dtype=np.float32), np.asarray(std, dtype=np.float32)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(shuffle_buffer, batch_size)
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.workers = workers
+        self.expand_dims = expand_dims
+        self.rng = np.random.default_rng(seed)
+
+        #maps the store's label codes to one-hot columns; codes of other labels (and -1) map to -1
+        self.classes = list(classes)
+        self.code_to_class = np.full(len(manifest['labels']) + 1, -1, dtype=np.int64)
+        for code, name in enumerate(manifest['labels']):
+            if name in self.classes:
+                self.code_to_class[code] = self.classes.index(name)
+
+        #the memory-mapped shards, opened once
+        self.shards = {session_id: open_shard(store_dir, session_id) for session_id in self.session_ids}
+        self.num_rows = sum(int((self.code_to_class[labels] >= 0).sum()) for _, labels, _ in self.shards.values())
+
+    def __len__(self):
+        """
+        Returns:
+            int: the number of batches per epoch
+        """
+        return -(-self.num_rows // self.batch_size)
+
+    def read_block(self, session_id, start):
+        """
+        Reads, standardizes and labels one block of rows of a shard.
+
+        Returns:
+            numpy array: the standardized features (float32)
+            numpy array: the one-hot column of each row
+        """
+        features, labels, _ = self.shards[session_id]
+        classes = self.code_to_class[labels[start:start + self.block_size]]
+        labeled = classes >= 0
+        block = features[start:start + self.block_size, self.columns][labeled]
+        block = (block - self.mean) / self.std
+        np.nan_to_num(block, copy=False)
+        return block.astype(np.float32, copy=False), classes[labeled]
+
+    def iter_blocks(self):
+        session_ids = list(self.session_ids)
+        if self.shuffle:
+            self.rng.shuffle(session_ids)
+        blocks = []
+        for session_id in session_ids:
+            num_rows = len(self.shards[session_id][1])
+            blocks.extend((session_id, start) for start in range(0, num_rows, self.block_size))
+
+        #reads up to `workers` blocks ahead of the one being consumed
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for block in blocks:
+                pending.append(executor.submit(self.read_block, *block))
+                if len(pending) > self.workers:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def make_batch(self, features, classes):
+        one_hot = np.zeros((len(classes), len(self.classes)), dtype=np.float32)
+        one_hot[np.arange(len(classes)), classes] = 1
+        if self.expand_dims:
+            features = features[:, :, np.newaxis]
+        return features, one_hot
+
+    def iter_batches(self):
+        """
+        Yields the batches of one epoch, without prefetching.
+        """
+        buffer_features = np.zeros((0, len(self.columns)), dtype=np.float32)
+        buffer_classes = np.zeros(0, dtype=np.int64)
+        for block_features, block_classes in self.iter_blocks():
+            buffer_features = np.concatenate((buffer_features, block_features))
+            buffer_classes = np.concatenate((buffer_classes, block_classes))
+            if len(buffer_classes) < self.shuffle_buffer:
+                continue
+            #emits every full batch from the shuffled buffer and carries the rest over
+            if self.shuffle:
+                order = self.rng.permutation(len(buffer_classes))
+                buffer_features, buffer_classes = buffer_features[order], buffer_classes[order]
+            end = len(buffer_classes) - len(buffer_classes) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                yield self.make_batch(buffer_features[start:start + self.batch_size],
+                                      buffer_classes[start:start + self.batch_size])
+            buffer_features, buffer_classes = buffer_features[end:], buffer_classes[end:]
+
+        if self.shuffle:
+            order = self.rng.permutation(len(buffer_classes))
+            buffer_features, buffer_classes = buffer_features[order], buffer_classes[order]
+        for start in range(0, len(buffer_classes), self.batch_size):
+            yield self.make_batch(buffer_features[start:start + self.batch_size],
+                                  buffer_classes[start:start + self.batch_size])
+
+    def __iter__(self):
+        """
+        Yields the batches of one epoch, prepared by a background thread.
+        """
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            #gives up once the consumer has stopped, so an abandoned epoch does not leave the thread blocked
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for batch in self.iter_batches():
+                    if not put(batch):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
+    def repeat(self):
+        """
+        Yields batches forever, one epoch after another (for keras' fit with steps_per_epoch=len(loader)).
+        """
+        while True:
+            for batch in self:
+                yield batch
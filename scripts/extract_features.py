@@ -0,0 +1,205 @@
+import argparse, json, os, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from process_video import get_features
+
+#the run metrics are shared with opengaze_implementation
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'opengaze_implementation'))
+import run_metrics
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+
+def find_videos(video_folder, extensions=VIDEO_EXTENSIONS):
+    """
+    Lists the videos in a folder.
+
+    Parameters:
+        video_folder (String): path to the folder containing the videos
+        extensions (tuple of Strings): file extensions (lower case) that count as videos
+
+    Returns:
+        list of Strings: sorted paths to the videos
+    """
+    return sorted(os.path.join(video_folder, name) for name in os.listdir(video_folder)
+                  if name.lower().endswith(extensions))
+
+def output_path(video_path, out_dir):
+    """
+    Returns the path of the features CSV that FeatureExtraction writes for a video.
+
+    Parameters:
+        video_path (String): path to the video
+        out_dir (String): directory the features are written to
+    """
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(video_path))[0] + '.csv')
+
+def is_up_to_date(video_path, out_dir, state):
+    """
+    Checks whether a video's features are already extracted: its output CSV exists and is newer than the
+    video, and (if the video is in the state) the last extraction of this exact video succeeded. A video
+    whose extraction was still running when a run was stopped stays "running" in the state, so its partial
+    CSV is not taken as done.
+
+    Parameters:
+        video_path (String): path to the video
+        out_dir (String): directory the features are written to
+        state (dict): the scheduler state, as read by load_state
+    """
+    features_path = output_path(video_path, out_dir)
+    if not os.path.isfile(features_path):
+        return False
+    video_stat = os.stat(video_path)
+    if os.stat(features_path).st_mtime_ns < video_stat.st_mtime_ns:
+        return False
+    job = state.get(os.path.abspath(video_path))
+    if job is None:
+        return True  # extracted before the state file existed
+    return (job['status'] == 'done' and job['video_size'] == video_stat.st_size
+            and job['video_mtime_ns'] == video_stat.st_mtime_ns)
+
+def load_state(state_path):
+    """
+    Reads the scheduler state: a JSON file mapping the absolute path of each video to the result of its last
+    extraction (status, return code, duration, and the size and modification time the video had). The status
+    is "running" while an extraction is in progress.
+
+    Parameters:
+        state_path (String): path to the state file
+
+    Returns:
+        dict: the state (empty if the file does not exist yet)
+    """
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    """
+    Writes the scheduler state atomically, so that an interrupted run never leaves a partial state file.
+
+    Parameters:
+        state_path (String): path to the state file
+        state (dict): the scheduler state
+    """
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+def extract_video(video_path, feature_extraction_exe, out_dir, timeout=None):
+    """
+    Runs FeatureExtraction on one video, catching failures.
+
+    Parameters:
+        video_path (String): path to the video
+        feature_extraction_exe (String): path to the FeatureExtraction executable (or any executable that
+            takes the same "-f [video] -out_dir [directory]" arguments)
+        out_dir (String): directory to write the features to
+        timeout (float): number of seconds after which the extraction is stopped (default is no timeout)
+
+    Returns:
+        dict: the job result (status is "done", "failed" or "timeout")
+    """
+    video_stat = os.stat(video_path)
+    job = {'video_size': video_stat.st_size, 'video_mtime_ns': video_stat.st_mtime_ns, 'returncode': None}
+    start = time.time()
+    try:
+        job['returncode'] = get_features(video_path, feature_extraction_exe, out_dir, timeout)
+        if job['returncode'] != 0:
+            job['status'] = 'failed'
+        elif not os.path.isfile(output_path(video_path, out_dir)):
+            job['status'] = 'failed'
+            job['error'] = 'no output written'
+        else:
+            job['status'] = 'done'
+    except subprocess.TimeoutExpired:
+        job['status'] = 'timeout'
+    except OSError as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    job['seconds'] = round(time.time() - start, 3)
+    return job
+
+def run_extraction(video_paths, feature_extraction_exe, out_dir, state_path, workers=2, timeout=None,
+                   retry_failed=True):
+    """
+    Extracts the features of every video with a bounded pool of workers, skipping videos whose features are
+    already up to date. The state file is updated after every job, so an interrupted run resumes where it
+    stopped when it is started again.
+
+    Parameters:
+        video_paths (list of Strings): paths to the videos
+        feature_extraction_exe (String): path to the FeatureExtraction executable
+        out_dir (String): directory to write the features to
+        state_path (String): path to the JSON state file
+        workers (int): number of extractions to run at the same time
+        timeout (float): number of seconds after which an extraction is stopped (default is no timeout)
+        retry_failed (bool): True if videos whose last extraction failed or timed out should be tried again
+
+    Returns:
+        dict: the state after the run
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(state_path)
+    lock = threading.Lock()
+
+    pending = []
+    for video_path in video_paths:
+        job = state.get(os.path.abspath(video_path))
+        if is_up_to_date(video_path, out_dir, state):
+            continue
+        if not retry_failed and job is not None and job['status'] in ('failed', 'timeout'):
+            continue
+        pending.append(video_path)
+    print('Extracting', len(pending), 'of', len(video_paths), 'videos...')
+
+    def run_job(video_path):
+        #the video is marked as running first, so that a run stopped during the extraction redoes it
+        video_stat = os.stat(video_path)
+        with lock:
+            state[os.path.abspath(video_path)] = {'status': 'running', 'video_size': video_stat.st_size,
+                                                  'video_mtime_ns': video_stat.st_mtime_ns, 'returncode': None}
+            save_state(state_path, state)
+        job = extract_video(video_path, feature_extraction_exe, out_dir, timeout)
+        with lock:
+            state[os.path.abspath(video_path)] = job
+            save_state(state_path, state)
+        print(job['status'] + ':', video_path, '(' + str(job['seconds']) + ' s)')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run_job, pending))
+    return state
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument('video_folder', type=str, help='The path to the folder containing the videos.')
+    argparser.add_argument('feature_extraction_exe', type=str,
+                           help='The path to the FeatureExtraction executable (or a stand-in with the same arguments).')
+    argparser.add_argument('--out-dir', type=str,
+                           default=os.path.dirname(os.path.realpath(__file__)) + '/processed/',
+                           help='The directory to write the features to. (default is processed/ next to this '
+                                'script, where reformat_data looks for them)')
+    argparser.add_argument('--state', type=str, default=None,
+                           help='The path to the JSON state file. (default is extraction_state.json in the output '
+                                'directory)')
+    argparser.add_argument('--workers', type=int, default=2, help='The number of parallel extractions. (default is 2)')
+    argparser.add_argument('--timeout', type=float, default=None,
+                           help='The number of seconds after which an extraction is stopped. (default is no timeout)')
+    argparser.add_argument('--skip-failed', action='store_true',
+                           help='Do not retry videos whose last extraction failed or timed out.')
+    run_metrics.add_arguments(argparser, hot_stage='extract')
+    parsed_args = argparser.parse_args(sys.argv[1:])
+
+    state_path = parsed_args.state or os.path.join(parsed_args.out_dir, 'extraction_state.json')
+    with run_metrics.RunMetrics('extract_features', parsed_args.metrics, parsed_args.profile) as metrics:
+        metrics.info['video_folder'] = os.path.abspath(parsed_args.video_folder)
+        videos = find_videos(parsed_args.video_folder)
+        with metrics.stage('extract', rows=len(videos)):
+            state = run_extraction(videos, parsed_args.feature_extraction_exe, parsed_args.out_dir, state_path,
+                                   parsed_args.workers, parsed_args.timeout, not parsed_args.skip_failed)
+    jobs = [(video_path, state.get(os.path.abspath(video_path))) for video_path in videos]
+    failed = [video_path for video_path, job in jobs if job is not None and job['status'] != 'done']
+    if failed:
+        print('Not extracted:', ', '.join(failed))
+    print("Done! State saved to '" + state_path + "'")
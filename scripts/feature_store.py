@@ -0,0 +1,195 @@
+import glob, json, os
+import numpy as np
+import pandas as pd
+
+from openface_loader import load_openface
+
+MANIFEST_FILE = 'manifest.json'
+LABEL_COLUMN = 'trackname'
+#columns that index the rows of a session rather than describe them
+INDEX_COLUMNS = ['frame']
+
+def load_manifest(store_dir):
+    """
+    Reads the manifest of a feature store: the feature column names, the label names (a label code is an index
+    into this list, -1 for a missing label), the shards by session ID (number of rows and source file), and the
+    splits (lists of session IDs by split name).
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+
+    Returns:
+        dict: the manifest (an empty one if the store does not exist yet)
+    """
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return {'feature_columns': None, 'labels': [], 'shards': {}, 'splits': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(store_dir, manifest):
+    """
+    Writes the manifest of a feature store atomically.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        manifest (dict): the manifest
+    """
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def shard_path(store_dir, session_id, kind):
+    """
+    Returns the path of one array of a shard.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        session_id (String): ID of the session
+        kind (String): 'features' (float32 rows x features), 'labels' (int8 label codes) or 'frames' (int32
+            frame numbers)
+    """
+    return os.path.join(store_dir, session_id + '.' + kind + '.npy')
+
+def write_shard(store_dir, session_id, tsv_path, manifest):
+    """
+    Converts the gaze data TSV of one session (OpenFace features plus a trackname column) into a shard, and
+    adds it to the manifest (which is not saved). Every numeric column except the frame number is a feature;
+    the first shard written fixes the feature columns, and later shards must have them all.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        session_id (String): ID of the session
+        tsv_path (String): path to the gaze data TSV of the session
+        manifest (dict): the manifest, as returned by load_manifest
+    """
+    data = load_openface(tsv_path, delimiter='\t')
+    if manifest['feature_columns'] is None:
+        manifest['feature_columns'] = [name for name in data.columns if name not in INDEX_COLUMNS
+                                       and name != LABEL_COLUMN and pd.api.types.is_numeric_dtype(data[name])]
+    missing = set(manifest['feature_columns']) - set(data.columns)
+    if missing:
+        raise ValueError(tsv_path + ' is missing feature columns: ' + ', '.join(sorted(missing)))
+
+    features = data[manifest['feature_columns']].to_numpy(dtype=np.float32)
+    if 'frame' in data.columns:
+        frames = data['frame'].to_numpy(dtype=np.int32)
+    else:
+        frames = np.arange(len(data), dtype=np.int32)
+
+    #label codes are indices into the manifest's label list, which grows as new labels are seen
+    labels = np.full(len(data), -1, dtype=np.int8)
+    if LABEL_COLUMN in data.columns:
+        names = data[LABEL_COLUMN]
+        for name in names.dropna().unique():
+            if name not in manifest['labels']:
+                manifest['labels'].append(name)
+            labels[(names == name).to_numpy()] = manifest['labels'].index(name)
+
+    np.save(shard_path(store_dir, session_id, 'features'), features)
+    np.save(shard_path(store_dir, session_id, 'labels'), labels)
+    np.save(shard_path(store_dir, session_id, 'frames'), frames)
+    manifest['shards'][session_id] = {'rows': len(data), 'source': os.path.abspath(tsv_path)}
+
+def build_store(path, store_dir, train_num=None):
+    """
+    Converts every gaze data TSV in a folder into a shard of a feature store (the session ID is the file name
+    without extension). Replaces combine_data: instead of copying the data into train.tsv and test.tsv, the
+    first train_num sessions are listed in the "train" split of the manifest, and the rest in the "test" split.
+
+    Parameters:
+        path (String): path to the folder containing all the gaze data files
+        store_dir (String): path to the feature store directory
+        train_num (int): number of sessions in the train split (default is no splits)
+
+    Returns:
+        dict: the manifest
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = load_manifest(store_dir)
+    tsv_paths = sorted(glob.glob(os.path.join(path, '*.tsv')))
+    session_ids = [os.path.splitext(os.path.basename(tsv_path))[0] for tsv_path in tsv_paths]
+    for session_id, tsv_path in zip(session_ids, tsv_paths):
+        write_shard(store_dir, session_id, tsv_path, manifest)
+    if train_num is not None:
+        manifest['splits']['train'] = session_ids[:train_num]
+        manifest['splits']['test'] = session_ids[train_num:]
+    save_manifest(store_dir, manifest)
+    return manifest
+
+def set_split(store_dir, split, session_ids):
+    """
+    Defines (or replaces) a split of a feature store as a list of session IDs.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        split (String): name of the split (e.g. 'train')
+        session_ids (list of Strings): IDs of the sessions in the split
+    """
+    manifest = load_manifest(store_dir)
+    unknown = set(session_ids) - set(manifest['shards'])
+    if unknown:
+        raise ValueError('Sessions not in the store: ' + ', '.join(sorted(unknown)))
+    manifest['splits'][split] = list(session_ids)
+    save_manifest(store_dir, manifest)
+
+def open_shard(store_dir, session_id, mmap=True):
+    """
+    Opens the arrays of one shard.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        session_id (String): ID of the session
+        mmap (bool): True if the arrays should be memory-mapped (read-only) instead of read into memory
+
+    Returns:
+        tuple: the features, labels and frames arrays
+    """
+    mmap_mode = 'r' if mmap else None
+    return tuple(np.load(shard_path(store_dir, session_id, kind), mmap_mode=mmap_mode)
+                 for kind in ('features', 'labels', 'frames'))
+
+def iter_split(store_dir, split, mmap=True):
+    """
+    Opens the shards of a split one at a time.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        split (String): name of the split
+        mmap (bool): True if the arrays should be memory-mapped
+
+    Yields:
+        tuple: the session ID, and the features, labels and frames arrays of the session
+    """
+    for session_id in load_manifest(store_dir)['splits'][split]:
+        yield (session_id,) + open_shard(store_dir, session_id, mmap)
+
+def load_split_frame(store_dir, split, exclude=None):
+    """
+    Loads a split into one DataFrame, in the layout of the train.tsv and test.tsv files of combine_data (the
+    feature columns and a trackname column), only reading the shards in the split.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        split (String): name of the split
+        exclude (list of Strings): feature columns to leave out
+
+    Returns:
+        pandas DataFrame: the rows of all sessions in the split
+    """
+    manifest = load_manifest(store_dir)
+    excluded = set(exclude or [])
+    keep = [i for i, name in enumerate(manifest['feature_columns']) if name not in excluded]
+    label_names = np.array(manifest['labels'] + [None], dtype=object)  #code -1 becomes None
+
+    features, labels = [], []
+    for _, shard_features, shard_labels, _ in iter_split(store_dir, split):
+        features.append(shard_features[:, keep])
+        labels.append(shard_labels)
+    features = np.concatenate(features) if features else np.zeros((0, len(keep)), dtype=np.float32)
+    labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int8)
+
+    data = pd.DataFrame(features, columns=[manifest['feature_columns'][i] for i in keep])
+    data[LABEL_COLUMN] = label_names[labels]
+    return data
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+#compact dtypes for the OpenFace columns that are not float features; every other numeric column is read as
+#FEATURE_DTYPE. timestamp stays float64 so that times are written back out exactly.
+COLUMN_DTYPES = {'frame': np.int32, 'face_id': np.int32, 'success': np.uint8, 'timestamp': np.float64}
+FEATURE_DTYPE = np.float32
+
+#number of rows read to find out which columns are numeric
+SNIFF_ROWS = 100
+
+def read_header(csv_path, delimiter=','):
+    """
+    Reads the column names of an OpenFace CSV (or of a TSV of OpenFace features).
+
+    Parameters:
+        csv_path (String): path to the file
+        delimiter (String): column separator; spaces after it are skipped
+
+    Returns:
+        list of Strings: the column names
+    """
+    return list(pd.read_csv(csv_path, sep=delimiter, skipinitialspace=True, nrows=0).columns)
+
+def select_columns(header, columns=None, exclude=None):
+    """
+    Picks the columns to read.
+
+    Parameters:
+        header (list of Strings): all column names, as returned by read_header
+        columns (list of Strings or function): names of the columns to read, or a function that takes a column
+            name and returns True if it should be read (default is every column)
+        exclude (list of Strings or function): names of columns not to read, or a function that returns True
+            for them
+
+    Returns:
+        list of Strings: the selected column names, in file order
+    """
+    if columns is None:
+        selected = list(header)
+    elif callable(columns):
+        selected = [name for name in header if columns(name)]
+    else:
+        missing = set(columns) - set(header)
+        if missing:
+            raise ValueError('Columns not in file: ' + ', '.join(sorted(missing)))
+        wanted = set(columns)
+        selected = [name for name in header if name in wanted]
+
+    if exclude is not None:
+        excluded = exclude if callable(exclude) else set(exclude).__contains__
+        selected = [name for name in selected if not excluded(name)]
+    return selected
+
+def get_dtypes(csv_path, columns, delimiter=',', dtypes=None):
+    """
+    Builds the dtype map for the selected columns: COLUMN_DTYPES for the known OpenFace columns, FEATURE_DTYPE
+    for the other numeric columns, and no conversion for text columns (e.g. trackname).
+
+    Parameters:
+        csv_path (String): path to the file
+        columns (list of Strings): the selected column names
+        delimiter (String): column separator
+        dtypes (dict): dtypes that override the defaults, by column name
+
+    Returns:
+        dict: the dtype of each numeric column
+    """
+    sample = pd.read_csv(csv_path, sep=delimiter, skipinitialspace=True, usecols=columns, nrows=SNIFF_ROWS)
+    dtype_map = {}
+    for name in columns:
+        if dtypes is not None and name in dtypes:
+            dtype_map[name] = dtypes[name]
+        elif pd.api.types.is_numeric_dtype(sample[name]):
+            dtype_map[name] = COLUMN_DTYPES.get(name, FEATURE_DTYPE)
+    return dtype_map
+
+def load_openface(csv_path, columns=None, exclude=None, delimiter=',', dtypes=None, chunksize=None):
+    """
+    Loads OpenFace output (or a TSV of OpenFace features) with pandas' C parser, reading only the requested
+    columns with compact dtypes (see get_dtypes).
+
+    Parameters:
+        csv_path (String): path to the file
+        columns, exclude (list of Strings or function): the columns to read, as in select_columns
+        delimiter (String): column separator (',' for OpenFace CSVs, whose ', ' separators are handled by
+            skipping the space; '\t' for TSVs)
+        dtypes (dict): dtypes that override the defaults, by column name
+        chunksize (int): if given, the number of rows per chunk
+
+    Returns:
+        pandas DataFrame: the data, or an iterator of DataFrames with chunksize rows each if chunksize is given
+    """
+    selected = select_columns(read_header(csv_path, delimiter), columns, exclude)
+    dtype_map = get_dtypes(csv_path, selected, delimiter, dtypes)
+    return pd.read_csv(csv_path, sep=delimiter, skipinitialspace=True, usecols=selected, dtype=dtype_map,
+                       chunksize=chunksize)
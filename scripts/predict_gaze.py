@@ -1,19 +1,37 @@
-import pandas as pd
+import argparse
+import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-from keras.preprocessing import sequence
-from keras.models import Sequential
-from keras.layers import Dense, Dropout, Activation, Flatten, BatchNormalization
-from keras.layers import Embedding
-from keras.layers import Conv1D, MaxPooling1D
-from sklearn import preprocessing
-from keras.callbacks import CSVLogger
-import statsmodels.api as sm
+import pandas as pd
+
+from batch_loader import ShardBatchLoader, compute_feature_stats
+from feature_store import load_manifest, load_split_frame
+from openface_loader import load_openface
+from prune_features import correlation_from_array, correlation_from_store, find_correlated_columns
+
+#the run metrics are shared with opengaze_implementation
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'opengaze_implementation'))
+import run_metrics
+
 
+# dropped features for training
+COLUMNS_TO_DROP = ['trackname', 'frame', 'face_id', 'timestamp', 'confidence', 'success', 'AU01_r',
+                   'AU02_r', 'AU04_r', 'AU05_r', 'AU06_r', 'AU07_r', 'AU09_r', 'AU10_r',
+                   'AU12_r', 'AU14_r', 'AU15_r', 'AU17_r', 'AU20_r', 'AU23_r', 'AU25_r',
+                   'AU26_r', 'AU45_r', 'AU01_c', 'AU02_c', 'AU04_c', 'AU05_c', 'AU06_c',
+                   'AU07_c', 'AU09_c', 'AU10_c', 'AU12_c', 'AU14_c', 'AU15_c', 'AU17_c',
+                   'AU20_c', 'AU23_c', 'AU25_c', 'AU26_c', 'AU28_c', 'AU45_c']
+NOT_LOADED = [column for column in COLUMNS_TO_DROP if column != 'trackname']
 
+# the files of a saved model artifact
+MODEL_FILE = 'model.h5'
+PREPROCESSING_FILE = 'preprocessing.json'
 
-def format_train_test_data(train_tsv_path, test_tsv_path, show_corr_map=False):
+
+def format_train_test_data(train_tsv_path, test_tsv_path, show_corr_map=False, correlation_threshold=0.9,
+                           absolute_correlation=False):
 
     # #path to directory that holds output of running OpenFace
     # processed_directory = os.path.dirname(os.path.realpath(__file__)) + '/processed/'
@@ -24,50 +42,55 @@ def format_train_test_data(train_tsv_path, test_tsv_path, show_corr_map=False):
 
     # original_df = pd.read_csv(original_tsv_path, engine='python', delimiter = '\t')
 
-    # read/clean data
-    train_df = pd.read_csv(train_tsv_path, engine='python', delimiter = '\t', header=0)
-    train_df.fillna(method='ffill', inplace=True)
-    test_df = pd.read_csv(test_tsv_path, engine='python', delimiter = '\t', header=0)
-    test_df.dropna()
+    # read data; the labels are read along with the features, everything else that is dropped is never loaded
+    train_df = load_openface(train_tsv_path, exclude=NOT_LOADED, delimiter='\t')
+    test_df = load_openface(test_tsv_path, exclude=NOT_LOADED, delimiter='\t')
+    return format_features(train_df, test_df, show_corr_map, correlation_threshold, absolute_correlation)
+
+
+def format_store_data(store_dir, train_split='train', test_split='test', show_corr_map=False,
+                      correlation_threshold=0.9, absolute_correlation=False):
 
-    # create y labels
-    y_train = pd.get_dummies(train_df.loc[:, 'trackname']).to_numpy()
-    y_test = pd.get_dummies(test_df.loc[:, 'trackname']).to_numpy()
+    # read data from the feature store (see feature_store.py), only loading the shards of the two splits
+    train_df = load_split_frame(store_dir, train_split, exclude=NOT_LOADED)
+    test_df = load_split_frame(store_dir, test_split, exclude=NOT_LOADED)
+    return format_features(train_df, test_df, show_corr_map, correlation_threshold, absolute_correlation)
 
 
-    # dropped features for training
-    columns_to_drop = ['trackname', 'frame', 'face_id', 'timestamp', 'confidence', 'success', 'AU01_r',
-                       'AU02_r', 'AU04_r', 'AU05_r', 'AU06_r', 'AU07_r', 'AU09_r', 'AU10_r',
-                       'AU12_r', 'AU14_r', 'AU15_r', 'AU17_r', 'AU20_r', 'AU23_r', 'AU25_r',
-                       'AU26_r', 'AU45_r', 'AU01_c', 'AU02_c', 'AU04_c', 'AU05_c', 'AU06_c',
-                       'AU07_c', 'AU09_c', 'AU10_c', 'AU12_c', 'AU14_c', 'AU15_c', 'AU17_c',
-                       'AU20_c', 'AU23_c', 'AU25_c', 'AU26_c', 'AU28_c', 'AU45_c']
+def format_features(train_df, test_df, show_corr_map=False, correlation_threshold=0.9, absolute_correlation=False):
 
-    train_df = train_df.drop(columns_to_drop, axis=1)
-    test_df = test_df.drop(columns_to_drop, axis=1)
+    # clean data
+    train_df.ffill(inplace=True)
+    test_df.dropna()
+
+    # create y labels; the test labels use the same one-hot columns as the training labels
+    classes = sorted(train_df['trackname'].dropna().unique())
+    y_train = pd.get_dummies(pd.Categorical(train_df['trackname'], categories=classes)).to_numpy()
+    y_test = pd.get_dummies(pd.Categorical(test_df['trackname'], categories=classes)).to_numpy()
+
+    train_df = train_df.drop('trackname', axis=1)
+    test_df = test_df.drop('trackname', axis=1)
 
-    # removing features with high correlation
-    corr = train_df.corr()
-    columns = np.full((corr.shape[0],), True, dtype=bool)
-    for i in range(1, corr.shape[0]):
-        for j in range(i + 1, corr.shape[0]):
-            if corr.iloc[i, j] >= 0.9: # should this be absolute value?
-                if columns[j]:
-                    columns[j] = False
+    # removing features with high correlation (the correlation matrix is accumulated in chunks of rows)
+    corr = correlation_from_array(train_df.to_numpy(dtype=np.float64))
+    columns = find_correlated_columns(corr, correlation_threshold, absolute_correlation)
 
     selected_columns = train_df.columns[columns]
     train_df = train_df[selected_columns]
     test_df = test_df[selected_columns]
 
-    #create x labels
-    x_train = train_df.to_numpy()
-    x_train = preprocessing.scale(x_train)
-    x_test = test_df.to_numpy()
-    x_test = preprocessing.scale(x_test)
+    #create x labels; the test set is scaled with the training set's statistics, as at prediction time
+    x_train = train_df.to_numpy(dtype=np.float64)
+    mean, std = get_scaling(x_train)
+    preprocessing = {'feature_columns': list(selected_columns), 'mean': mean.tolist(), 'std': std.tolist(),
+                     'classes': classes}
+    x_train = (x_train - mean) / std
+    x_test = apply_preprocessing(preprocessing, test_df)
     print(x_train.shape, x_test.shape, y_train.shape, y_test.shape)
 
     # correlation map
     if show_corr_map:
+        import matplotlib.pyplot as plt
         corr_map = plt.figure(figsize=(9, 10))
         plt.matshow(train_df.corr(), fignum=corr_map.number)
         plt.xticks(range(0, train_df.shape[1], 20), rotation=45)
@@ -77,30 +100,39 @@ def format_train_test_data(train_tsv_path, test_tsv_path, show_corr_map=False):
         plt.title('Correlation Matrix', fontsize=16)
         plt.show()
 
-    return x_train, y_train, x_test, y_test
+    return x_train, y_train, x_test, y_test, preprocessing
 
 
-def train_model(x_train, y_train, x_test, y_test):
+def get_scaling(x):
 
-    # set parameters:
-    batch_size = 32
-    filters = 250
-    kernel_size = 3
-    epochs = 10
+    # the mean and standard deviation of each feature, as used by sklearn's preprocessing.scale
+    # (features with no spread are not scaled)
+    mean = np.nanmean(x, axis=0)
+    std = np.nanstd(x, axis=0)
+    std[~(std > 0)] = 1
+    return mean, std
 
-    print(len(x_train), 'train sequences')
-    print(len(x_test), 'test sequences')
 
-    x_train = np.expand_dims(x_train, axis=2)  # reshape (a, b) to (a, b, 1)
-    x_test = np.expand_dims(x_test, axis=2)  # reshape (a, b) to (a, b, 1)
-    print(x_train.shape)
-    print(x_test.shape)
+def apply_preprocessing(preprocessing, df):
+
+    # selects, cleans and scales the features of new data the same way as the training data
+    x = df[preprocessing['feature_columns']].ffill().to_numpy(dtype=np.float64)
+    x = (x - np.array(preprocessing['mean'])) / np.array(preprocessing['std'])
+    return np.nan_to_num(x)  # values that are still missing get the training mean
+
+
+def build_model(num_features, num_classes, filters=250, kernel_size=3):
+
+    # keras is only imported when a model is needed, so that the rest of this module loads quickly
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout, Activation, Flatten, BatchNormalization
+    from keras.layers import Conv1D, MaxPooling1D
 
     print('Build model...')
     model = Sequential()
 
     #CNN layer
-    model.add(Conv1D(filters, kernel_size, padding='valid', strides=3, input_shape=(x_test.shape[1], 1)))
+    model.add(Conv1D(filters, kernel_size, padding='valid', strides=3, input_shape=(num_features, 1)))
     model.add(BatchNormalization())
     model.add(Activation("relu"))
 
@@ -124,13 +156,33 @@ def train_model(x_train, y_train, x_test, y_test):
     model.add(Activation('relu'))
 
     #output layer
-    model.add(Dense(y_train.shape[1], activation='softmax'))
+    model.add(Dense(num_classes, activation='softmax'))
 
     model.compile(loss='categorical_crossentropy',
                   optimizer='adam',
                   metrics=['accuracy'])
 
     model.summary()
+    return model
+
+
+def train_model(x_train, y_train, x_test, y_test, preprocessing=None, artifact_dir=None):
+
+    # set parameters:
+    batch_size = 32
+    filters = 250
+    kernel_size = 3
+    epochs = 10
+
+    print(len(x_train), 'train sequences')
+    print(len(x_test), 'test sequences')
+
+    x_train = np.expand_dims(x_train, axis=2)  # reshape (a, b) to (a, b, 1)
+    x_test = np.expand_dims(x_test, axis=2)  # reshape (a, b) to (a, b, 1)
+    print(x_train.shape)
+    print(x_test.shape)
+
+    model = build_model(x_test.shape[1], y_train.shape[1], filters, kernel_size)
 
     model.fit(x_train, y_train,
               batch_size=batch_size,
@@ -138,10 +190,165 @@ def train_model(x_train, y_train, x_test, y_test):
               verbose=1,
               validation_data=(x_test, y_test))
 
+    if artifact_dir is not None:
+        save_artifact(artifact_dir, model, preprocessing)
+    return model
+
+
+def train_model_on_store(store_dir, train_split='train', test_split='test', correlation_threshold=0.9,
+                         absolute_correlation=False, batch_size=32, epochs=10, shuffle_buffer=10000, seed=None,
+                         artifact_dir=None):
+
+    # same features as format_train_test_data, picked with one streaming pass over the training shards
+    feature_columns = load_manifest(store_dir)['feature_columns']
+    candidates = [i for i, name in enumerate(feature_columns) if name not in COLUMNS_TO_DROP]
+    corr, _ = correlation_from_store(store_dir, train_split, exclude=COLUMNS_TO_DROP)
+    columns = [i for i, keep in zip(candidates, find_correlated_columns(corr, correlation_threshold,
+                                                                        absolute_correlation)) if keep]
+
+    # the test set is standardized with the training set's statistics, and batches are read from the shards
+    # while the model trains, so only a few batches are in memory at once
+    mean, std = compute_feature_stats(store_dir, train_split, columns)
+    classes = sorted(load_manifest(store_dir)['labels'])
+    train_loader = ShardBatchLoader(store_dir, train_split, columns, classes, mean, std, batch_size=batch_size,
+                                    shuffle_buffer=shuffle_buffer, expand_dims=True, seed=seed)
+    test_loader = ShardBatchLoader(store_dir, test_split, columns, classes, mean, std, batch_size=batch_size,
+                                   shuffle=False, expand_dims=True)
+    print(train_loader.num_rows, 'train sequences')
+    print(test_loader.num_rows, 'test sequences')
+
+    model = build_model(len(columns), len(classes))
+    model.fit(train_loader.repeat(),
+              steps_per_epoch=len(train_loader),
+              epochs=epochs,
+              verbose=1,
+              validation_data=test_loader.repeat(),
+              validation_steps=len(test_loader))
 
-if __name__ =='__main__':
-    train_tsv_path = '~/PycharmProjects/gaze-detection-project/openface_data/train.tsv'
-    test_tsv_path = '~/PycharmProjects/gaze-detection-project/openface_data/test.tsv'
-    x_train, y_train, x_test, y_test = format_train_test_data(train_tsv_path, test_tsv_path, show_corr_map=False)
-    train_model(x_train, y_train, x_test, y_test)
+    if artifact_dir is not None:
+        preprocessing = {'feature_columns': [feature_columns[i] for i in columns], 'mean': mean.tolist(),
+                         'std': std.tolist(), 'classes': classes}
+        save_artifact(artifact_dir, model, preprocessing)
+    return model
+
+
+def save_artifact(artifact_dir, model, preprocessing):
+
+    # the model and everything needed to prepare new data for it (the selected feature columns, their
+    # training mean and standard deviation, and the label of each output) are saved together
+    os.makedirs(artifact_dir, exist_ok=True)
+    model.save(os.path.join(artifact_dir, MODEL_FILE))
+    with open(os.path.join(artifact_dir, PREPROCESSING_FILE), 'w') as f:
+        json.dump(preprocessing, f, indent=2)
+
+
+def load_artifact(artifact_dir):
+
+    from keras.models import load_model
+    with open(os.path.join(artifact_dir, PREPROCESSING_FILE)) as f:
+        preprocessing = json.load(f)
+    return load_model(os.path.join(artifact_dir, MODEL_FILE)), preprocessing
 
+
+def label_changes(times, labels, success, end_time):
+
+    # rows in the Time/Duration/Trackname/Comments format of convert_opengaze_output, at each label change;
+    # frames where OpenFace found no face are labeled 'none'
+    labels = np.where(success != 0, labels, 'none')
+    changes = np.ones(len(labels), dtype=bool)
+    changes[1:] = labels[1:] != labels[:-1]
+    rows = pd.DataFrame({'Time': times[changes], 'Duration': 0, 'Trackname': labels[changes],
+                         'Comments': '(null)'})
+    end = pd.DataFrame([[end_time, 0, 'end', '(null)']], columns=rows.columns)
+    return pd.concat([rows, end], ignore_index=True)
+
+
+def read_openface_csv(preprocessing, csv_path):
+
+    # only the features the model uses, plus the times and whether a face was found
+    return load_openface(csv_path, columns=lambda name: name in preprocessing['feature_columns'] or
+                         name in ('timestamp', 'success'))
+
+
+def predict_labels(model, preprocessing, data, batch_size=8192):
+
+    x = np.expand_dims(apply_preprocessing(preprocessing, data), axis=2)
+    probabilities = model.predict(x, batch_size=batch_size, verbose=0)
+    labels = np.array(preprocessing['classes'])[np.argmax(probabilities, axis=1)]
+
+    times = np.round(data['timestamp'].to_numpy(dtype=np.float64) * 1000).astype(np.int64)  # seconds to ms
+    success = data['success'].to_numpy() if 'success' in data.columns else np.ones(len(data))
+    # the video ends one frame after the last frame starts
+    end_time = int(times[-1] + np.median(np.diff(times))) if len(times) > 1 else int(times[-1]) if len(times) else 0
+    return label_changes(times, labels, success, end_time)
+
+
+def predict_directory(artifact_dir, csv_dir, output_dir, batch_size=8192):
+
+    # the artifact is loaded once, and the next CSV is read while the current one is labeled
+    with run_metrics.stage('load_model'):
+        model, preprocessing = load_artifact(artifact_dir)
+    csv_paths = sorted(os.path.join(csv_dir, name) for name in os.listdir(csv_dir) if name.endswith('.csv'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_data = executor.submit(read_openface_csv, preprocessing, csv_paths[0]) if csv_paths else None
+        for i, csv_path in enumerate(csv_paths):
+            #time spent waiting for a CSV that is still being read
+            with run_metrics.stage('read'):
+                data = next_data.result()
+            if i + 1 < len(csv_paths):
+                next_data = executor.submit(read_openface_csv, preprocessing, csv_paths[i + 1])
+            with run_metrics.stage('label', rows=len(data)):
+                rows = predict_labels(model, preprocessing, data, batch_size)
+
+            name = os.path.splitext(os.path.basename(csv_path))[0]
+            with run_metrics.stage('write', rows=len(rows)):
+                rows.to_csv(os.path.join(output_dir, name + '_predicted.tsv'), index=False, sep='\t')
+            print('Labeled', csv_path)
+
+
+if __name__ =='__main__':
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    subparsers = argparser.add_subparsers(dest='command')
+    train_parser = subparsers.add_parser('train', help='Train on train/test TSVs from process_video.combine_data.')
+    train_parser.add_argument('train_tsv_path', type=str, nargs='?',
+                              default='~/PycharmProjects/gaze-detection-project/openface_data/train.tsv')
+    train_parser.add_argument('test_tsv_path', type=str, nargs='?',
+                              default='~/PycharmProjects/gaze-detection-project/openface_data/test.tsv')
+    train_parser.add_argument('--artifact', type=str, default=None,
+                              help='The directory to save the model and its preprocessing to.')
+    store_parser = subparsers.add_parser('train-store', help='Train on the splits of a feature store.')
+    store_parser.add_argument('store_dir', type=str)
+    store_parser.add_argument('--artifact', type=str, default=None,
+                              help='The directory to save the model and its preprocessing to.')
+    predict_parser = subparsers.add_parser('predict', help='Label a directory of OpenFace CSVs.')
+    predict_parser.add_argument('artifact', type=str, help='The directory the model was saved to.')
+    predict_parser.add_argument('csv_dir', type=str, help='The directory of OpenFace CSVs.')
+    predict_parser.add_argument('--output-dir', type=str, default=None,
+                                help='The directory to save the label TSVs to. (default is csv_dir)')
+    predict_parser.add_argument('--batch-size', type=int, default=8192,
+                                help='The number of frames per prediction batch. (default is 8192)')
+    run_metrics.add_arguments(train_parser, hot_stage='train')
+    run_metrics.add_arguments(store_parser, hot_stage='train')
+    run_metrics.add_arguments(predict_parser, hot_stage='label')
+    parsed_args = argparser.parse_args(sys.argv[1:])
+
+    with run_metrics.RunMetrics('predict_gaze', getattr(parsed_args, 'metrics', None),
+                                getattr(parsed_args, 'profile', None)) as metrics:
+        metrics.info['command'] = parsed_args.command or 'train'
+        if parsed_args.command == 'predict':
+            predict_directory(parsed_args.artifact, parsed_args.csv_dir,
+                              parsed_args.output_dir or parsed_args.csv_dir, parsed_args.batch_size)
+        elif parsed_args.command == 'train-store':
+            with metrics.stage('train'):
+                train_model_on_store(parsed_args.store_dir, artifact_dir=parsed_args.artifact)
+        else:
+            train_tsv_path = getattr(parsed_args, 'train_tsv_path', train_parser.get_default('train_tsv_path'))
+            test_tsv_path = getattr(parsed_args, 'test_tsv_path', train_parser.get_default('test_tsv_path'))
+            with metrics.stage('load') as stage:
+                x_train, y_train, x_test, y_test, preprocessing = format_train_test_data(
+                    train_tsv_path, test_tsv_path, show_corr_map=False)
+                stage.rows = len(x_train) + len(x_test)
+            with metrics.stage('train', rows=len(x_train)):
+                train_model(x_train, y_train, x_test, y_test, preprocessing, getattr(parsed_args, 'artifact', None))
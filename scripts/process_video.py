@@ -1,7 +1,14 @@
-import glob, os
+import glob, os, subprocess, sys
+import numpy as np
 import pandas as pd
 
-def get_features(video_path, feature_extraction_exe):
+from openface_loader import load_openface
+
+#the label TSV reader is shared with opengaze_implementation
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'opengaze_implementation'))
+from label_timeline import LabelTimeline
+
+def get_features(video_path, feature_extraction_exe, out_dir=None, timeout=None):
     """
     Extracts OpenFace features from a video file.
     
@@ -9,10 +16,22 @@ def get_features(video_path, feature_extraction_exe):
         video_path (String): path to the video (includes the video within the path)
         feature_extraction_exe (String): path to FeatureExtraction executable within OpenFace. Format should be
             "path_to_OpenFace/build/bin/FeatureExtraction"
+        out_dir (String): directory to write the output to (default is OpenFace's own default, "processed/"
+            in the working directory)
+        timeout (float): number of seconds after which the extraction is stopped (default is no timeout)
+    
+    Returns:
+        int: return code of the executable
+
+    Raises:
+        subprocess.TimeoutExpired: if the extraction takes longer than timeout (the executable is killed)
     """
-    os.system(feature_extraction_exe + ' -f "' + video_path + '"')
+    command = [feature_extraction_exe, '-f', video_path]
+    if out_dir is not None:
+        command += ['-out_dir', out_dir]
+    return subprocess.run(command, timeout=timeout).returncode
 
-def reformat_data(video_name, directory, human_readable = False):
+def reformat_data(video_name, directory, human_readable = False, processed_directory = None):
     """
     Reformats the CSV output of OpenFace FeatureExtraction into the PsychDS format. Creates a CSV file,
     named [video name]_openface_data.csv, with the newly reformatted data in the parent directory of the video.
@@ -24,40 +43,64 @@ def reformat_data(video_name, directory, human_readable = False):
             True if should output reformatted file in a human_readable format (i.e. each row reflects a
                 change in the trackname)
             False otherwise (i.e. for comparing purposes as in the compare_data function)
+        processed_directory (String): path to directory that holds output of running OpenFace (default is
+            processed/ next to this script)
     """
     #path to directory that holds output of running OpenFace
-    processed_directory = os.path.dirname(os.path.realpath(__file__)) + '/processed/'
+    if processed_directory is None:
+        processed_directory = os.path.dirname(os.path.realpath(__file__)) + '/processed/'
     
-    #finds csv output from running OpenFace
-    data = pd.read_csv(processed_directory + video_name + ".csv", engine='python', delimiter = ', ')   
-    #forms DataFrame in desired output format
-    reformatted_data = pd.DataFrame(columns=['Time', 'Duration', 'Trackname', 'Comments'])
-    #for human_readable = True
-    reformatted_index = 0
-    
-    for index, row in data.iterrows():
-        horizontal_gaze_angle = row['gaze_angle_x']
-        if row['success'] == 0:
-            trackname = 'off'
-        elif row['gaze_0_x'] < row['gaze_1_x']:
-            trackname = 'away'
-        elif horizontal_gaze_angle >= 0.22:
-            trackname = 'left'
-        else:
-            trackname = 'right'
-        
-        if human_readable:
-            if reformatted_index == 0 or reformatted_data.loc[reformatted_index - 1]['Trackname'] != trackname:
-                reformatted_data.loc[reformatted_index] = [row['timestamp'], 0, trackname, '(null)']
-                reformatted_index += 1
-        else:
-            reformatted_data.loc[index] = [row['timestamp'], 0, trackname, '(null)']
+    #finds csv output from running OpenFace; the gaze columns are kept as float64 so the label thresholds
+    #are compared at full precision
+    data = load_openface(os.path.join(processed_directory, video_name + ".csv"),
+                         columns=['timestamp', 'success', 'gaze_0_x', 'gaze_1_x', 'gaze_angle_x'],
+                         dtypes={'gaze_0_x': np.float64, 'gaze_1_x': np.float64, 'gaze_angle_x': np.float64})
+    
+    #labels every frame at once; the conditions are checked in order, like an if/elif chain
+    tracknames = np.select([data['success'].to_numpy() == 0,
+                            data['gaze_0_x'].to_numpy() < data['gaze_1_x'].to_numpy(),
+                            data['gaze_angle_x'].to_numpy() >= 0.22],
+                           ['off', 'away', 'left'], default='right')
+    times = data['timestamp'].to_numpy()
+    
+    #for human_readable = True, only keeps the frames where the trackname changes
+    if human_readable:
+        changes = np.ones(len(tracknames), dtype=bool)
+        changes[1:] = tracknames[1:] != tracknames[:-1]
+        times = times[changes]
+        tracknames = tracknames[changes]
     
+    #forms DataFrame in desired output format
+    reformatted_data = pd.DataFrame({'Time': times, 'Duration': 0, 'Trackname': tracknames, 'Comments': '(null)'})
     reformatted_data.to_csv(directory + video_name + '_openface_data.tsv', index=False, sep='\t')
     
-def compare_data(original_tsv_path, new_tsv_path):
+def find_nearest(target_times, times):
+    """
+    Finds, for each target time, the index of the nearest time in a sorted array of times (on a tie, the
+    later one). Like a pointer that walks forward through the times, the matched index never moves back
+    when the target times are not sorted. Targets past the last time are matched to the last time.
+    
+    Parameters:
+        target_times (numpy array of floats): the times to match
+        times (numpy array of floats): the sorted times to match them to
+    
+    Returns:
+        numpy array of ints: the index in times of the match of each target time
+    """
+    if len(times) == 0:
+        raise ValueError("There are no times to match to")
+    after = np.searchsorted(times, target_times, side='left')
+    if len(after) > 0:
+        after = np.maximum.accumulate(after)
+    after = np.minimum(after, len(times) - 1)
+    before = np.maximum(after - 1, 0)
+    before_is_closer = np.abs(times[after] - target_times) > np.abs(times[before] - target_times)
+    return np.where(before_is_closer, before, after)
+
+def compare_data(original_tsv_path, new_tsv_path, tolerance=None, per_label=False):
     """
-    Compares data in one TSV file to another, and finds accuracy of that TSV file.
+    Compares data in one TSV file to another, and finds accuracy of that TSV file. Each row of the original
+    data is matched to the row of the new data with the nearest time.
     
     Assumes that the TSV file in the original_tsv_path is in the format generated by Khaled's script
     when converting from a Marchman VCX file to a TSV file.
@@ -69,36 +112,37 @@ def compare_data(original_tsv_path, new_tsv_path):
         new_tsv_path (String): path to the TSV file containing the new data (i.e. the data trying to find 
             accuracy of). Should be in the PsychDS format. This the generated TSV file from the reformat_data 
             function.
+        tolerance (float): if given, the largest time difference (in seconds) of a match; original rows 
+            without a new row this close count as incorrect
+        per_label (bool): True if the accuracy of each original label should be returned as well
     
     Returns:
         float: accuracy of data in the new CSV file when compared to the original CSV file
+        dict: (only if per_label is True) the accuracy for the original rows of each label
     """
-    original_df = pd.read_csv(original_tsv_path, engine='python', delimiter = '\t')
-    new_df = pd.read_csv(new_tsv_path, engine='python', delimiter = '\t')
-
-    new_idx = 0 #to keep track of index within new_tsv
-    num_correct = 0
-    count = 0
-    
-    for orig_idx in range(len(original_df)-1): #don't want last entry because signifies end
-        while new_idx < len(new_df) and new_df.iloc[new_idx]['Time'] < original_df.iloc[orig_idx]['Time']/1000:
-            new_idx += 1
-        if abs(new_df.iloc[new_idx]['Time'] - original_df.iloc[orig_idx]['Time']/1000) > abs(new_df.iloc[new_idx-1]['Time'] - original_df.iloc[orig_idx]['Time']/1000):
-            temp_idx = new_idx - 1
-        else:
-            temp_idx = new_idx
-        
-        #to keep track of the accuracy of the new data
-        if new_df.iloc[temp_idx]['Trackname'] == original_df.iloc[orig_idx]['Trackname']:
-            num_correct += 1
-        count += 1
- 
-    return num_correct/count
+    #times are compared in milliseconds; the original data is in milliseconds and the new data in seconds
+    original = LabelTimeline.read_tsv(original_tsv_path)
+    new = LabelTimeline.read_tsv(new_tsv_path, time_scale=1000)
+    
+    #don't want last entry because signifies end
+    original_times, _, original_labels = original.segments()
+    
+    matches = find_nearest(original_times, new.times)
+    correct = new.labels[matches] == original_labels
+    if tolerance is not None:
+        correct &= np.abs(new.times[matches] - original_times) <= tolerance * 1000
+    accuracy = float(correct.sum() / len(correct))
+    
+    if not per_label:
+        return accuracy
+    label_accuracies = {str(label): float(correct[original_labels == label].mean()) for label in np.unique(original_labels)}
+    return accuracy, label_accuracies
 
 def combine_data(path, train_num):
     """
     Merges the gaze data files so that train_num number of files are merged into train.tsv, and the rest are
-    merged into test.tsv.
+    merged into test.tsv. For large corpora, use feature_store.build_store instead, which stores each file
+    as a binary shard and defines the train/test split by session ID without copying the data.
     
     Parameters:
         path (String): path to the folder containing all the gaze data files.
@@ -0,0 +1,140 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+from feature_store import iter_split, load_manifest
+from openface_loader import load_openface
+
+class StreamingCorrelation:
+    """
+    Accumulates the pairwise correlation matrix of the columns of a data set one chunk of rows at a time, so that
+    the data never has to be in memory at once. Like pandas' DataFrame.corr, each pair of columns only uses the
+    rows where both are present (not NaN), and constant columns get NaN correlations.
+
+    Each column is shifted by its mean in the first chunk before the sums are taken, which keeps the sums small
+    and the result accurate when a column's mean is large compared to its spread.
+    """
+
+    def __init__(self, num_columns):
+        """
+        Parameters:
+            num_columns (int): number of columns in the data
+        """
+        self.shift = None
+        self.count = np.zeros((num_columns, num_columns))
+        self.sums = np.zeros((num_columns, num_columns))  #sums[i, j]: sum of column i where j is present
+        self.squares = np.zeros((num_columns, num_columns))  #squares[i, j]: sum of column i squared, likewise
+        self.products = np.zeros((num_columns, num_columns))
+
+    def update(self, chunk):
+        """
+        Adds a chunk of rows.
+
+        Parameters:
+            chunk (numpy array): rows x columns
+        """
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self.shift is None:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  #columns that are all NaN so far are not shifted
+                self.shift = np.nan_to_num(np.nanmean(chunk, axis=0)) if len(chunk) > 0 else np.zeros(chunk.shape[1])
+        present = ~np.isnan(chunk)
+        values = np.where(present, chunk - self.shift, 0)
+        present = present.astype(np.float64)
+        self.count += present.T @ present
+        self.sums += values.T @ present
+        self.squares += (values * values).T @ present
+        self.products += values.T @ values
+
+    def correlation(self):
+        """
+        Returns:
+            numpy array: the columns x columns correlation matrix of all rows added so far
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = self.count * self.products - self.sums * self.sums.T
+            variance = self.count * self.squares - self.sums ** 2
+            corr = covariance / np.sqrt(variance * variance.T)
+        corr[self.count < 2] = np.nan
+        return np.clip(corr, -1, 1)
+
+def find_correlated_columns(corr, threshold=0.9, absolute=False):
+    """
+    Picks the columns to keep when pruning highly correlated features: column j is dropped if its correlation with
+    any earlier column i (i >= 1; the first column is never compared) is at least the threshold, whether or not
+    column i is dropped itself. This is the selection predict_gaze has always made.
+
+    Parameters:
+        corr (numpy array): the columns x columns correlation matrix
+        threshold (float): the smallest correlation at which a column is dropped
+        absolute (bool): True if strong negative correlations should count as well
+
+    Returns:
+        numpy array of bools: True for each column to keep
+    """
+    corr = np.asarray(corr)
+    if absolute:
+        corr = np.abs(corr)
+    with np.errstate(invalid='ignore'):
+        correlated = np.triu(corr >= threshold, k=1)
+    correlated[:1] = False
+    return ~correlated.any(axis=0)
+
+def correlation_from_array(data, chunksize=100000):
+    """
+    Computes the correlation matrix of an in-memory (or memory-mapped) array in chunks of rows.
+
+    Parameters:
+        data (numpy array): rows x columns
+        chunksize (int): number of rows per chunk
+    """
+    stats = StreamingCorrelation(data.shape[1])
+    for start in range(0, max(len(data), 1), chunksize):
+        stats.update(data[start:start + chunksize])
+    return stats.correlation()
+
+def correlation_from_tsv(tsv_path, columns=None, exclude=None, chunksize=100000):
+    """
+    Computes the correlation matrix of the numeric columns of a large TSV (e.g. a train.tsv from combine_data),
+    reading it in chunks.
+
+    Parameters:
+        tsv_path (String): path to the TSV
+        columns, exclude (list of Strings or function): the columns to use, as in openface_loader.select_columns
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        numpy array: the correlation matrix
+        list of Strings: the names of its columns
+    """
+    stats, names = None, None
+    for chunk in load_openface(tsv_path, columns, exclude, delimiter='\t', chunksize=chunksize):
+        if stats is None:
+            names = [name for name in chunk.columns if pd.api.types.is_numeric_dtype(chunk[name])]
+            stats = StreamingCorrelation(len(names))
+        stats.update(chunk[names].to_numpy(dtype=np.float64))
+    return stats.correlation(), names
+
+def correlation_from_store(store_dir, split, exclude=None, chunksize=100000):
+    """
+    Computes the correlation matrix of the features of a split of a feature store, reading memory-mapped shards
+    in chunks.
+
+    Parameters:
+        store_dir (String): path to the feature store directory
+        split (String): name of the split
+        exclude (list of Strings): feature columns to leave out
+        chunksize (int): number of rows per chunk
+
+    Returns:
+        numpy array: the correlation matrix
+        list of Strings: the names of its columns
+    """
+    feature_columns = load_manifest(store_dir)['feature_columns']
+    excluded = set(exclude or [])
+    keep = [i for i, name in enumerate(feature_columns) if name not in excluded]
+    stats = StreamingCorrelation(len(keep))
+    for _, features, _, _ in iter_split(store_dir, split):
+        for start in range(0, len(features), chunksize):
+            stats.update(features[start:start + chunksize, keep])
+    return stats.correlation(), [feature_columns[i] for i in keep]
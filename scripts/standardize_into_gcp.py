@@ -1,45 +1,165 @@
+import hashlib
+import inspect
+import json
+import numpy as np
 import pandas as pd
-import random
 import os
+import sys
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
-def standardize_files(video_folder, data_path, video_path_prepend, output_csv, stand_func):
+#the label TSV reader is shared with opengaze_implementation
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'opengaze_implementation'))
+from label_timeline import LabelTimeline
+
+def standardize_files(video_folder, data_path, video_path_prepend, output_csv, stand_func, processes=None, seed=None,
+                      incremental=False):
     """
     Creates a CSV file that GCP can process by merging PsychDS standard gaze files. Puts the new CSV file
-    in the folder data_folder.
+    in the folder data_folder. The videos are standardized in parallel by a pool of worker processes, and the
+    CSV file is replaced atomically, so it is never left half-written.
     
     Parameters:
         video_folder (String): path to the folder containing all the videos
         data_path (String): path to the folder in which all the PsychDS standard gaze files are in.
         video_path_prepend (String): folder in GCP where the videos are kept (e.g. 'gs://gaze-coding/videos/')
         output_csv (String): name of output CSV file to put newly formatted data (e.g. all.csv)
-        stand_func (function): standardization function to use; chosen from standardize, 
-                   standardize_multi, and standardize_filter.
+        stand_func (function): standardization function to use; chosen from standardize and
+                   standardize_multi.
+        processes (int): number of worker processes (default is the number of CPUs)
+        seed (int): for standardize_multi, the seed from which the random intervals of every video are derived,
+                   so that the output is the same from run to run (default is different intervals every run);
+                   ignored by standardize
+        incremental (bool): True if only videos whose gaze data file is new or changed since the last run should
+                   be standardized; the rows of the other videos are taken from an index file next to the CSV
+                   file ([output_csv].index.json), and videos no longer in video_folder are dropped
     """    
     time_conv = 1/1000 #time conversion factor; time in PsychDS format is in milliseconds, and we want to convert it into seconds
     possible_labels = {"left", "right", "away"}
     
-    video_files = os.listdir(video_folder) #list of videos within the folder video_folder
-    
-    video_paths = []
-    labels = []
-    start_times = []
-    end_times = []
+    video_files = sorted(os.listdir(video_folder)) #list of videos within the folder video_folder
     
     constants = (time_conv, video_path_prepend, possible_labels)
-    csv_data = (video_paths, labels, start_times, end_times)
     
-    for video_file in video_files:
-        video_name = video_file.split('_')[-2]
-        data_path = data_path + video_name + '_timecourse_data.tsv'
-        data = pd.read_csv(data_path, delimiter="\t")
-        video_data = (video_file, data)
-        
-        stand_func(constants, csv_data, video_data)
+    #only the standardization functions that take a seed get one (standardize has no random intervals)
+    if 'seed' not in inspect.signature(stand_func).parameters:
+        seed = None
+    
+    #with incremental=True, the rows of videos whose gaze data file has the same hash as last time are reused
+    index_path = data_path + output_csv + '.index.json'
+    settings = {'stand_func': stand_func.__name__, 'seed': seed, 'video_path_prepend': video_path_prepend}
+    index = load_index(index_path, settings) if incremental else {'settings': settings, 'videos': {}}
+    if incremental:
+        hashes = {video_file: hash_file(get_data_file(data_path, video_file)) for video_file in video_files}
+        changed = [video_file for video_file in video_files
+                   if index['videos'].get(video_file, {}).get('hash') != hashes[video_file]]
+    else:
+        hashes = {}
+        changed = video_files
+    
+    #each worker fills its own csv_data lists for one video; they are concatenated once at the end
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        changed_csv_data = executor.map(standardize_video,
+                                        [(constants, data_path, video_file, stand_func, seed) for video_file in changed],
+                                        chunksize=16)
+        for video_file, csv_data in zip(changed, changed_csv_data):
+            index['videos'][video_file] = {'hash': hashes.get(video_file), 'csv_data': [list(column) for column in csv_data]}
+    index['videos'] = {video_file: index['videos'][video_file] for video_file in video_files}
+    video_csv_data = [index['videos'][video_file]['csv_data'] for video_file in video_files]
     
     #creates the csv file in the same folder as the data
-    d = {'video_path': video_paths, 'label': labels, 'start_time': start_times, 'end_time': end_times}
+    d = {column: [value for csv_data in video_csv_data for value in csv_data[i]]
+         for i, column in enumerate(['video_path', 'label', 'start_time', 'end_time'])}
     df_output = pd.DataFrame(data = d)
-    df_output.to_csv(data_path + output_csv, index=False, header=False)
+    output_path = data_path + output_csv
+    df_output.to_csv(output_path + '.tmp', index=False, header=False)
+    os.replace(output_path + '.tmp', output_path)
+    if incremental:
+        save_index(index_path, index)
+    print('Standardized', len(changed), 'of', len(video_files), 'videos')
+
+def get_data_file(data_path, video_file):
+    """
+    Returns the path to the gaze data file of a video.
+    
+    Parameters:
+        data_path (String): path to the folder in which all the PsychDS standard gaze files are in.
+        video_file (String): name of the video file
+    """
+    return data_path + video_file.split('_')[-2] + '_timecourse_data.tsv'
+
+def hash_file(path):
+    """
+    Returns the SHA-1 hash of the contents of a file.
+    
+    Parameters:
+        path (String): path to the file
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def load_index(index_path, settings):
+    """
+    Reads the index of an incremental build: the settings of the build, and the hash of the gaze data file and
+    the csv_data lists of each video. The index is discarded (so every video is standardized again) if it was
+    made with other settings.
+    
+    Parameters:
+        index_path (String): path to the index file
+        settings (dict): the standardization function name, seed and video_path_prepend of this build
+    """
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('settings') == settings:
+            return index
+    return {'settings': settings, 'videos': {}}
+
+def save_index(index_path, index):
+    """
+    Writes the index of an incremental build atomically.
+    
+    Parameters:
+        index_path (String): path to the index file
+        index (dict): the index
+    """
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+def standardize_video(args):
+    """
+    Reads the gaze data file of one video and standardizes it with stand_func.
+    
+    Parameters:
+        args (tuple): constants (as specified in the code of standardize_files), data_path, video_file,
+            stand_func and seed
+    
+    Returns:
+        tuple: the csv_data lists (video paths, labels, start times and end times) of the video
+    """
+    constants, data_path, video_file, stand_func, seed = args
+    data = LabelTimeline.read_tsv(get_data_file(data_path, video_file))
+    csv_data = ([], [], [], [])
+    if seed is None:
+        stand_func(constants, csv_data, (video_file, data))
+    else:
+        stand_func(constants, csv_data, (video_file, data), seed=video_seed(seed, video_file))
+    return csv_data
+
+def video_seed(seed, video_file):
+    """
+    Derives the seed of one video from the global seed and the name of the video, so that a video gets the
+    same intervals no matter which other videos are processed, or in what order.
+    
+    Parameters:
+        seed (int): the global seed
+        video_file (String): name of the video file
+    """
+    return [seed, zlib.crc32(video_file.encode('utf-8'))]
     
 def standardize(constants, csv_data, video_data):
     """
@@ -54,73 +174,79 @@ def standardize(constants, csv_data, video_data):
     video_paths, labels, start_times, end_times = csv_data
     video_file, data = video_data
     
-    #goes through each row in the gaze file (skipping the last one, since the last label is "end")
-    for idx in range(len(data)-1):
-        row = data.iloc[idx]
-        next_row = data.iloc[idx+1]
-            
-        start_time = round(time_conv * row['Time'], 3)
-        end_time = round(time_conv * (next_row['Time'] - 1), 3) #one millisecond before the start time of the next row
-        
-        #makes sure that the start and end times are valid
-        if end_time <= start_time: continue
-        #this is the last row with a label, so we will specify the end time as the end of the video
-        #(which is denoted by 'inf' in GCP)
-        if idx == len(data) - 2:
-            end_time = 'inf'
-            
-        video_paths.append(video_path_prepend + video_file)
-        start_times.append(start_time)
-        end_times.append(end_time)
-        
-        #labels anything that is not left, right, or away as None_of_the_above (e.g. peek)
-        if row['Trackname'] in possible_labels:
-            labels.append(row['Trackname'])
-        else:
-            labels.append('None_of_the_above')
+    #every row in the gaze file (skipping the last one, since the last label is "end") starts at its own
+    #time and ends one millisecond before the start time of the next row
+    starts, durations, tracknames = data.segments()
+    row_start_times = np.round(time_conv * starts, 3)
+    row_end_times = np.round(time_conv * (starts + durations - 1), 3)
+    
+    #makes sure that the start and end times are valid
+    valid = row_end_times > row_start_times
+    #the last row with a label ends at the end of the video (which is denoted by 'inf' in GCP)
+    row_end_times = row_end_times.astype(object)
+    if len(row_end_times) > 0:
+        row_end_times[-1] = 'inf'
+    
+    #labels anything that is not left, right, or away as None_of_the_above (e.g. peek)
+    row_labels = np.where(np.isin(tracknames, list(possible_labels)), tracknames, 'None_of_the_above')
+    
+    video_paths.extend([video_path_prepend + video_file] * int(valid.sum()))
+    labels.extend(row_labels[valid].tolist())
+    start_times.extend(row_start_times[valid].tolist())
+    end_times.extend(row_end_times[valid].tolist())
 
-def standardize_multi(constants, csv_data, video_data):
+def standardize_multi(constants, csv_data, video_data, seed=None):
     """
-    Separates the gaze data file of a video into intervals of 1-5 seconds randomly, giving each of 
+    Separates the gaze data file of a video into intervals of 1-5 seconds randomly, giving each interval
+    every label that is active at some point during it (including the label already active when the interval
+    starts).
     
     Parameters:
         constants, csv_data, video_data (tuples): tuples containing the necessary information, as specified
             in the code of standardize_files
+        seed (int or list of ints): seed of the interval lengths (default is different intervals every run)
     """
     #separates out the variables within each of the tuples
     time_conv, video_path_prepend, possible_labels = constants
     video_paths, labels, start_times, end_times = csv_data
     video_file, data = video_data
     
-    video_length = round(data.iloc[len(data)-1]['Time']/1000, 3) #finds video length from the last row (labeled "end")
-    start_time = 0 #start time of current interval considering
-    idx = 0 #keeps track of current row in gaze data file
-    
-    while start_time < video_length:
-        interval_length = random.randint(1,5)
-        
-        #find end time of interval
-        if start_time + interval_length < video_length:
-            #the start time of the next interval is start_time + interval_length, so the end time of the
-            #current interval is one millisecond before that
-            end_time = start_time + interval_length - 0.001
-        else:
-            end_time = float('inf')
-        
-        labels_set = set() #set of labels within the interval
-        #find all labels within the interval
-        while round(time_conv * data.iloc[idx]['Time'], 3) < end_time and data.iloc[idx]['Trackname'] != 'end':
-            #labels anything that is not left, right, or away as None_of_the_above (e.g. peek)
-            if data.iloc[idx]['Trackname'] in possible_labels:
-                labels_set.add(data.iloc[idx]['Trackname'])
-            else:
-                labels_set.add('None_of_the_above')
-            idx += 1
-        
-        video_paths.extend([video_path_prepend + video_file] * len(labels_set))
-        start_times.extend([start_time] * len(labels_set))
-        end_times.extend([end_time if end_time != float('inf') else 'inf'] * len(labels_set))
-        labels.extend(list(labels_set))
-        
-        #next interval start time
-        start_time += interval_length
\ No newline at end of file
+    #finds video length from the last row (labeled "end")
+    video_length = round((data.end if data.end is not None else data.times[-1])/1000, 3)
+    
+    #draws every interval length up front: at least one second each, so video_length + 1 intervals always
+    #cover the video; the intervals that start after the end of the video are dropped
+    interval_lengths = np.random.default_rng(seed).integers(1, 6, size=int(video_length) + 1)
+    interval_ends = np.cumsum(interval_lengths)
+    interval_starts = interval_ends - interval_lengths
+    covered = interval_starts < video_length
+    interval_starts, interval_ends = interval_starts[covered], interval_ends[covered]
+    #the start time of the next interval is start_time + interval_length, so the end time of the current
+    #interval is one millisecond before that; the last interval lasts until the end of the video
+    interval_end_times = np.where(interval_ends < video_length, interval_ends - 0.001, np.inf)
+    
+    #the label change points, up to the "end" row
+    tracknames = data.labels
+    num_changes = int(np.argmax(tracknames == 'end')) if (tracknames == 'end').any() else len(tracknames)
+    change_times = np.round(time_conv * data.times[:num_changes], 3)
+    #labels anything that is not left, right, or away as None_of_the_above (e.g. peek)
+    change_labels = np.where(np.isin(tracknames[:num_changes], list(possible_labels)),
+                             tracknames[:num_changes], 'None_of_the_above')
+    label_names, label_codes = np.unique(change_labels.astype(str), return_inverse=True)
+    
+    #the change points active during each interval: from the one active at its start (the last one at or
+    #before it) up to the last one before its end
+    first = np.maximum(np.searchsorted(change_times, interval_starts, side='right') - 1, 0)
+    last = np.searchsorted(change_times, interval_end_times, side='left')
+    counts = np.maximum(last - first, 0)
+    interval_of = np.repeat(np.arange(len(counts)), counts)
+    change_of = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+    
+    #one row per distinct label in each interval, in interval order and then label name order
+    pairs = np.unique(interval_of * max(len(label_names), 1) + label_codes[change_of])
+    interval_of, label_of = np.divmod(pairs, max(len(label_names), 1))
+    
+    video_paths.extend([video_path_prepend + video_file] * len(pairs))
+    start_times.extend(interval_starts[interval_of].tolist())
+    end_times.extend(['inf' if np.isinf(end_time) else end_time for end_time in interval_end_times[interval_of].tolist()])
+    labels.extend(label_names[label_of].tolist())
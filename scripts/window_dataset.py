@@ -0,0 +1,161 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from feature_store import load_manifest, open_shard
+
+def find_valid_windows(frames, success, labels, window, align='center', stride=1):
+    """
+    Finds the windows of a session that can be used for training: every frame in the window was tracked
+    (success != 0), the frame numbers are consecutive (no frames are missing from the session), and the frame the
+    window is aligned to has a label.
+
+    Parameters:
+        frames (numpy array of ints): the frame number of each row of the session
+        success (numpy array of bools): True for each row where OpenFace tracked the face
+        labels (numpy array of ints): the label code of each row (-1 for no label)
+        window (int): number of consecutive frames per window
+        align (String): 'center' to label a window with the label of its middle frame, 'end' with its last frame
+        stride (int): step between the first frames of consecutive windows
+
+    Returns:
+        numpy array of ints: the index of the first row of each valid window
+        numpy array of ints: the row each of those windows takes its label from
+    """
+    num_windows = len(frames) - window + 1
+    if num_windows <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if align == 'center':
+        offset = window // 2
+    elif align == 'end':
+        offset = window - 1
+    else:
+        raise ValueError("align should be 'center' or 'end', not " + str(align))
+
+    #a window is untracked if it contains an untracked frame: counts untracked frames with a running sum
+    untracked = np.concatenate(([0], np.cumsum(~np.asarray(success, dtype=bool))))
+    tracked = untracked[window:] - untracked[:num_windows] == 0
+    frames = np.asarray(frames)
+    consecutive = frames[window - 1:] - frames[:num_windows] == window - 1
+    starts = np.arange(num_windows)
+    labeled = np.asarray(labels)[starts + offset] >= 0
+
+    valid = tracked & consecutive & labeled
+    valid[starts % stride != 0] = False
+    starts = starts[valid]
+    return starts, starts + offset
+
+class WindowDataset:
+    """
+    Sliding windows of consecutive frames over the sessions of a feature store split, for sequence models. The
+    windows of a session are a read-only view (sliding_window_view) over its memory-mapped feature shard, so no
+    window is copied until it is put into a batch; only the indices of the valid windows (see find_valid_windows)
+    are kept in memory. Windows never cross session boundaries or untracked frames.
+    """
+
+    def __init__(self, store_dir, split, window, columns=None, align='center', stride=1, success_column='success'):
+        """
+        Parameters:
+            store_dir (String): path to the feature store directory
+            split (String): name of the split
+            window (int): number of consecutive frames per window
+            columns (list of ints): indices of the features to use (default is every feature)
+            align (String): 'center' or 'end', see find_valid_windows
+            stride (int): step between the first frames of consecutive windows
+            success_column (String): the feature telling whether a frame was tracked (every frame counts as
+                tracked if the store has no such feature)
+        """
+        manifest = load_manifest(store_dir)
+        self.window = window
+        self.labels = manifest['labels']
+        success_index = (manifest['feature_columns'].index(success_column)
+                         if success_column in manifest['feature_columns'] else None)
+
+        self.views = []  #per session: view of shape (windows, window, features)
+        self.window_labels = []  #per session: label code of each valid window
+        self.window_starts = []  #per session: first row of each valid window
+        for session_id in manifest['splits'][split]:
+            features, labels, frames = open_shard(store_dir, session_id)
+            success = features[:, success_index] != 0 if success_index is not None else np.ones(len(frames), bool)
+            starts, anchors = find_valid_windows(frames, success, labels, window, align, stride)
+            if len(features) >= window:
+                view = sliding_window_view(features, window, axis=0).transpose(0, 2, 1)
+            else:
+                view = np.zeros((0, window, features.shape[1]), dtype=features.dtype)
+            self.views.append(view)
+            self.window_starts.append(starts)
+            self.window_labels.append(np.asarray(labels)[anchors])
+        self.columns = None if columns is None else np.asarray(columns)  #picked when windows are gathered
+
+        #maps a dataset index to (session, window) without materializing the windows
+        self.session_of = np.repeat(np.arange(len(self.views)), [len(starts) for starts in self.window_starts])
+        self.start_of = (np.concatenate(self.window_starts) if self.window_starts
+                         else np.zeros(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.start_of)
+
+    def get_windows(self, indices, mean=None, std=None):
+        """
+        Gathers windows into an array (the only copy that is made).
+
+        Parameters:
+            indices (numpy array of ints): dataset indices of the windows
+            mean, std (numpy arrays): if given, the features are standardized with them (missing values become 0)
+
+        Returns:
+            numpy array: float32 windows, of shape (len(indices), window, features)
+            numpy array: the label code of each window
+        """
+        indices = np.asarray(indices)
+        sessions = self.session_of[indices]
+        starts = self.start_of[indices]
+        windows = []
+        labels = []
+        for session in np.unique(sessions):
+            in_session = sessions == session
+            session_windows = self.views[session][starts[in_session]]
+            if self.columns is not None:
+                session_windows = session_windows[:, :, self.columns]
+            windows.append(session_windows)
+            position = np.searchsorted(self.window_starts[session], starts[in_session])
+            labels.append(self.window_labels[session][position])
+
+        #puts the windows back in the requested order
+        order = np.argsort(np.argsort(sessions, kind='stable'), kind='stable')
+        num_features = self.views[0].shape[2] if self.columns is None else len(self.columns)
+        windows = (np.concatenate(windows)[order] if windows
+                   else np.zeros((0, self.window, num_features), dtype=np.float32))
+        labels = np.concatenate(labels)[order] if labels else np.zeros(0, dtype=np.int8)
+        windows = windows.astype(np.float32)
+        if mean is not None:
+            windows = (windows - mean) / std
+            np.nan_to_num(windows, copy=False)
+        return windows, labels
+
+    def iter_batches(self, batch_size=32, classes=None, shuffle=True, mean=None, std=None, seed=None):
+        """
+        Yields batches of windows with one-hot labels.
+
+        Parameters:
+            batch_size (int): number of windows per batch
+            classes (list of Strings): label names, in the order of the one-hot columns (default is every label
+                in the store, sorted); windows with other labels are skipped
+            shuffle (bool): True if the windows should be in random order
+            mean, std (numpy arrays): see get_windows
+            seed (int): seed of the shuffling
+
+        Yields:
+            numpy array: float32 windows, of shape (batch, window, features)
+            numpy array: float32 one-hot labels, of shape (batch, classes)
+        """
+        classes = sorted(self.labels) if classes is None else list(classes)
+        code_to_class = np.array([classes.index(name) if name in classes else -1 for name in self.labels] + [-1])
+        label_codes = np.concatenate(self.window_labels) if self.window_labels else np.zeros(0, dtype=np.int8)
+        indices = np.flatnonzero(code_to_class[label_codes] >= 0)
+        if shuffle:
+            np.random.default_rng(seed).shuffle(indices)
+        for start in range(0, len(indices), batch_size):
+            windows, labels = self.get_windows(indices[start:start + batch_size], mean, std)
+            one_hot = np.zeros((len(labels), len(classes)), dtype=np.float32)
+            one_hot[np.arange(len(labels)), code_to_class[labels]] = 1
+            yield windows, one_hot